@@ -0,0 +1,119 @@
+"""CLI startup benchmark, with an import-time budget check.
+
+Job scripts call `tad4bj set/get/setnow` many times, so their startup time
+shows in the wall-clock time of the jobs. This measures:
+
+ - the time to import the CLI module (best of several fresh interpreters),
+ - the modules that a plain `set` loads (yaml, pickle, json, argparse and
+   pandas must not be among them),
+ - the wall-clock time of `set`, `get` and `setnow` invocations, against
+   the startup time of a bare interpreter.
+
+It exits with status 1 if the import time is above the budget or if a
+forbidden module is loaded.
+
+    python benchmarks/bench_cli_startup.py --budget-ms 30
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+FORBIDDEN_MODULES = ("yaml", "pickle", "json", "argparse", "pandas", "numpy")
+
+SCHEMA = {"fields": [["id", "integer"], ["start", "timestamp"],
+                     ["description", "text"], ["json_item", "json"]]}
+
+
+def _env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    return env
+
+
+def _python(code, env):
+    return subprocess.check_output([sys.executable, "-c", code], env=env)
+
+
+def import_time(env, repeat):
+    code = ("from timeit import default_timer as t; s = t(); "
+            "import tad4bj.__main__; print(t() - s)")
+    return min(float(_python(code, env)) for _ in range(repeat))
+
+
+def loaded_modules(db_path, env):
+    code = ("import sys; sys.argv = ['tad4bj', '-d', %r, '-t', 'bench', 'set', "
+            "'-j', '1', 'description', 'x']\n"
+            "from tad4bj.__main__ import main; main()\n"
+            "print(' '.join(sorted(sys.modules)))" % db_path)
+    return _python(code, env).decode().split()
+
+
+def invocation_time(argv, env, repeat):
+    timings = list()
+    for _ in range(repeat):
+        start = default_timer()
+        subprocess.check_call(argv, env=env, stdout=subprocess.DEVNULL)
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def run(repeat=10):
+    env = _env()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "bench.db")
+        schema_path = os.path.join(tmpdir, "schema.json")
+        with open(schema_path, "w") as f:
+            json.dump(SCHEMA, f)
+        cli = [sys.executable, "-m", "tad4bj", "-d", db_path, "-t", "bench"]
+        subprocess.check_call(cli + ["init", schema_path], env=env)
+
+        modules = set(loaded_modules(db_path, env))
+        baseline = invocation_time([sys.executable, "-c", "pass"], env, repeat)
+        results = {
+            "import_seconds": import_time(env, repeat),
+            "forbidden_modules_loaded": sorted(
+                m for m in FORBIDDEN_MODULES if m in modules),
+            "interpreter_seconds": baseline,
+        }
+        for name, argv in [("set", ["set", "-j", "1", "description", "x"]),
+                           ("get", ["get", "-j", "1", "description"]),
+                           ("setnow", ["setnow", "-j", "1", "start"])]:
+            seconds = invocation_time(cli + argv, env, repeat)
+            results[name] = {
+                "seconds": seconds,
+                "overhead_seconds": seconds - baseline,
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=30.0,
+                        help="Maximum import time of the CLI, in milliseconds")
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    results["budget_seconds"] = args.budget_ms / 1000.0
+    print(json.dumps(results, indent=2))
+
+    if results["forbidden_modules_loaded"]:
+        print("FAIL: `set` loads %s" % ", ".join(results["forbidden_modules_loaded"]),
+              file=sys.stderr)
+        sys.exit(1)
+    if results["import_seconds"] > results["budget_seconds"]:
+        print("FAIL: import time %.1f ms above the %.1f ms budget"
+              % (results["import_seconds"] * 1000, args.budget_ms), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
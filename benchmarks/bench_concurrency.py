@@ -0,0 +1,95 @@
+"""Contention benchmark: N writer processes against one database file.
+
+Every process opens its own DataStorage (as the jobs of an array do) and
+writes its share of the jobs with set_values. It reports the throughput and
+the retries, waits and failures counted by the DataStorage stats, for each
+number of processes and concurrency profile.
+
+    python benchmarks/bench_concurrency.py --processes 1 4 16 --profiles default concurrent
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from timeit import default_timer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from tad4bj import DataSchema, DataStorage  # noqa: E402
+
+SCHEMA = DataSchema({
+    "fields": [["id", "integer"], ["worker", "integer"], ["accuracy", "real"],
+               ["status", "text"]]
+})
+
+
+def writer(args):
+    path, profile, worker, jobids = args
+    ds = DataStorage("bench", path, profile=profile)
+    failures = 0
+    for jobid in jobids:
+        try:
+            ds.set_values(jobid, ["worker", "accuracy", "status"],
+                          [worker, 0.5, "done"])
+        except Exception:
+            failures += 1
+    stats = dict(ds.stats)
+    ds.close()
+    stats["lost_writes"] = failures
+    return stats
+
+
+def run(process_counts=(1, 4, 16), profiles=("default", "concurrent"),
+        writes_per_process=200):
+    # Fresh interpreters, like independent jobs
+    context = multiprocessing.get_context("spawn")
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for profile in profiles:
+            for processes in process_counts:
+                path = os.path.join(tmpdir, "bench_%s_%d.db" % (profile, processes))
+                ds = DataStorage("bench", path, profile=profile)
+                ds.prepare(SCHEMA)
+                ds.close()
+
+                tasks = [(path, profile, worker,
+                          range(worker * writes_per_process,
+                                (worker + 1) * writes_per_process))
+                         for worker in range(processes)]
+                with context.Pool(processes) as pool:
+                    # Start the workers before timing
+                    pool.map(abs, range(processes))
+                    start = default_timer()
+                    stats = pool.map(writer, tasks)
+                    seconds = default_timer() - start
+
+                writes = processes * writes_per_process
+                results["%s_%d_processes" % (profile, processes)] = {
+                    "processes": processes,
+                    "writes": writes,
+                    "seconds": seconds,
+                    "writes_per_second": writes / seconds,
+                    "retries": sum(s["write_retries"] for s in stats),
+                    "retry_wait_seconds": sum(s["write_wait"] for s in stats),
+                    "lost_writes": sum(s["lost_writes"] for s in stats),
+                }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--profiles", nargs="+", default=["default", "concurrent"])
+    parser.add_argument("--writes", type=int, default=200,
+                        help="Writes per process")
+    args = parser.parse_args()
+    print(json.dumps(run(args.processes, args.profiles, args.writes), indent=2))
+
+
+if __name__ == "__main__":
+    main()
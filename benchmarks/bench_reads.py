@@ -0,0 +1,119 @@
+"""Read benchmark over tables of growing size.
+
+For each table size it measures:
+
+ - `get_value` and `__getitem__` latency, on a fixed number of random ids,
+ - a full `__iter__` (all the ids) and a full `iter_rows`,
+ - `to_dataframe` of the whole table (if pandas is installed).
+
+Point reads should stay flat as the table grows (they go through the
+primary key), and full reads should grow linearly.
+
+    python benchmarks/bench_reads.py --sizes 1000 10000 100000 1000000
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tad4bj import DataSchema, DataStorage  # noqa: E402
+
+SCHEMA = DataSchema({
+    "fields": [
+        ["id", "integer"],
+        ["start", "timestamp"],
+        ["description", "text"],
+        ["accuracy", "real"],
+        ["config", "json"],
+    ]
+})
+
+
+def populate(path, rows):
+    ds = DataStorage("bench", path)
+    ds.prepare(SCHEMA)
+    now = datetime.now()
+    ds.set_many(
+        (i, {
+            "start": now,
+            "description": "execution number %d" % i,
+            "accuracy": (i % 1000) / 1000.0,
+            "config": {"lr": 0.01 * (i % 5), "optimizer": "adam"},
+        })
+        for i in range(1, rows + 1)
+    )
+    ds.close()
+
+
+def _best(func, repeat):
+    timings = list()
+    for _ in range(repeat):
+        start = default_timer()
+        func()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def run(sizes=(1000, 10000, 100000), lookups=1000, repeat=3):
+    try:
+        import pandas  # noqa: F401
+        has_pandas = True
+    except ImportError:
+        has_pandas = False
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for rows in sizes:
+            path = os.path.join(tmpdir, "bench_%d.db" % rows)
+            start = default_timer()
+            populate(path, rows)
+            populate_seconds = default_timer() - start
+
+            ids = [random.randint(1, rows) for _ in range(lookups)]
+            ds = DataStorage("bench", path)
+            result = {"populate_seconds": populate_seconds}
+
+            seconds = _best(lambda: [ds.get_value(i, "accuracy") for i in ids], repeat)
+            result["get_value_us"] = seconds / lookups * 1e6
+            seconds = _best(lambda: [ds[i] for i in ids], repeat)
+            result["getitem_us"] = seconds / lookups * 1e6
+
+            seconds = _best(lambda: sum(1 for _ in ds), repeat)
+            result["iter_ids_seconds"] = seconds
+            result["iter_ids_per_second"] = rows / seconds
+            seconds = _best(lambda: sum(1 for _ in ds.iter_rows()), repeat)
+            result["iter_rows_seconds"] = seconds
+            result["iter_rows_rows_per_second"] = rows / seconds
+
+            if has_pandas:
+                seconds = _best(ds.to_dataframe, repeat)
+                result["to_dataframe_seconds"] = seconds
+                result["to_dataframe_rows_per_second"] = rows / seconds
+            else:
+                result["to_dataframe_seconds"] = None
+            ds.close()
+            os.remove(path)
+            results["%d_rows" % rows] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=1000,
+                        help="Random ids read by the point read benchmarks")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(run(args.sizes, args.lookups, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Full-table read benchmark: RowDecoder plans against the previous read path.
+
+The previous path let sqlite3 run the converters (detect_types), then went
+through the table with one `SELECT *` per id and dispatched each field
+through a per-value Python lookup. This benchmark emulates it on the same
+data and compares it against `DataStorage.__getitem__` and
+`DataStorage.iter_rows`, which use the precompiled decoding plans.
+
+    python benchmarks/bench_row_decode.py --rows 20000
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tad4bj import DataSchema, DataStorage, transformers  # noqa: E402
+from tad4bj.handlers import NULL_FIELD  # noqa: E402
+
+SCHEMA = DataSchema({
+    "fields": [
+        ["id", "integer"],
+        ["start", "timestamp"],
+        ["description", "text"],
+        ["flag", "integer"],
+        ["pickled_item", "pickle"],
+        ["json_item", "json"],
+    ]
+})
+
+
+def populate(path, table, rows):
+    ds = DataStorage(table, path)
+    ds.prepare(SCHEMA)
+    now = datetime.now()
+    ds.set_many(
+        (i, {
+            "start": now,
+            "description": "execution number %d" % i,
+            "flag": i % 7 if i % 3 else NULL_FIELD,
+            "pickled_item": {"values": list(range(10)), "name": "item%d" % i},
+            "json_item": {"lr": 0.01 * (i % 5), "layers": [64, 64]},
+        })
+        for i in range(rows)
+    )
+    ds.close()
+
+
+def read_legacy(path, table):
+    transformers.register_converters()
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    cursor = conn.cursor()
+    field_transformers = dict()
+    ids = [r[0] for r in cursor.execute("SELECT id FROM `%s`" % table).fetchall()]
+    count = 0
+    for jobid in ids:
+        cursor.execute("SELECT * FROM `%s` WHERE id = ?" % table, (jobid,))
+        row = cursor.fetchone()
+        fields = [d[0] for d in cursor.description]
+        values = list()
+        for field, value in zip(fields, row):
+            if value is not None:
+                values.append(field_transformers.setdefault(
+                    field, transformers.identity_adapter)(value))
+            else:
+                values.append(NULL_FIELD)
+        count += 1
+    conn.close()
+    return count
+
+
+def read_getitem(path, table):
+    ds = DataStorage(table, path)
+    count = sum(1 for jobid in ds if ds[jobid] is not None)
+    ds.close()
+    return count
+
+
+def read_iter_rows(path, table):
+    ds = DataStorage(table, path)
+    count = sum(1 for _ in ds.iter_rows())
+    ds.close()
+    return count
+
+
+def run(rows=20000, repeat=3):
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.db")
+        populate(path, "bench", rows)
+        for name, func in [("legacy", read_legacy),
+                           ("getitem", read_getitem),
+                           ("iter_rows", read_iter_rows)]:
+            timings = list()
+            for _ in range(repeat):
+                start = default_timer()
+                assert func(path, "bench") == rows
+                timings.append(default_timer() - start)
+            results[name] = {
+                "rows": rows,
+                "best_seconds": min(timings),
+                "rows_per_second": rows / min(timings),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(run(args.rows, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Write benchmark: set_value, set_values and JobHandler batches.
+
+Each job writes the same number of fields through each of the paths, for
+several numbers of fields per job, so the cost of a commit per value
+(set_value), per row (set_values) and per batch (JobHandler.batch) can be
+compared.
+
+    python benchmarks/bench_writes.py --jobs 200 --fields 1 10 50
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tad4bj import DataSchema, DataStorage  # noqa: E402
+
+
+def _schema(field_count):
+    return DataSchema({
+        "fields": [["id", "integer"]] +
+                  [["field%d" % i, "real"] for i in range(field_count)]
+    })
+
+
+def write_set_value(ds, jobs, fields):
+    for jobid in range(jobs):
+        for field in fields:
+            ds.set_value(jobid, field, 0.5)
+
+
+def write_set_values(ds, jobs, fields):
+    values = [0.5] * len(fields)
+    for jobid in range(jobs):
+        ds.set_values(jobid, fields, values)
+
+
+def write_handler_batch(ds, jobs, fields):
+    for jobid in range(jobs):
+        h = ds.get_handler(jobid)
+        with h.batch:
+            for field in fields:
+                h[field] = 0.5
+        h.close()
+
+
+WRITERS = [
+    ("set_value", write_set_value),
+    ("set_values", write_set_values),
+    ("handler_batch", write_handler_batch),
+]
+
+
+def run(jobs=200, field_counts=(1, 10, 50), repeat=3, profile=None):
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for field_count in field_counts:
+            fields = ["field%d" % i for i in range(field_count)]
+            for name, writer in WRITERS:
+                timings = list()
+                for attempt in range(repeat):
+                    path = os.path.join(tmpdir, "bench_%s_%d_%d.db"
+                                        % (name, field_count, attempt))
+                    ds = DataStorage("bench", path, profile=profile)
+                    ds.prepare(_schema(field_count))
+                    start = default_timer()
+                    writer(ds, jobs, fields)
+                    ds.close()
+                    timings.append(default_timer() - start)
+                best = min(timings)
+                results["%s_%d_fields" % (name, field_count)] = {
+                    "jobs": jobs,
+                    "fields": field_count,
+                    "best_seconds": best,
+                    "values_per_second": jobs * field_count / best,
+                }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--fields", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--profile", default=None,
+                        help="Concurrency profile of the DataStorage")
+    args = parser.parse_args()
+    print(json.dumps(run(args.jobs, args.fields, args.repeat, args.profile), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Run the benchmark suite and save the results as a single JSON document.
+
+The document has the results of each benchmark under its name, plus the
+environment of the run (tad4bj commit, Python and SQLite versions,
+platform), so runs on different commits or machines can be compared:
+
+    python benchmarks/run_all.py --output results/$(git rev-parse --short HEAD).json
+    python benchmarks/run_all.py --quick --only writes reads
+    python benchmarks/run_all.py --compare results/old.json results/new.json
+
+`--quick` uses small sizes, to check that the suite works rather than to
+measure it. The full read benchmark includes a table of 1M rows and takes
+a few minutes.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_cli_startup  # noqa: E402
+import bench_concurrency  # noqa: E402
+import bench_reads  # noqa: E402
+import bench_row_decode  # noqa: E402
+import bench_writes  # noqa: E402
+
+# name -> (run, arguments of a full run, arguments of a quick run)
+BENCHMARKS = {
+    "writes": (bench_writes.run,
+               dict(jobs=200, field_counts=(1, 10, 50)),
+               dict(jobs=20, field_counts=(1, 10), repeat=1)),
+    "reads": (bench_reads.run,
+              dict(sizes=(1000, 10000, 100000, 1000000)),
+              dict(sizes=(1000, 10000), lookups=100, repeat=1)),
+    "row_decode": (bench_row_decode.run,
+                   dict(rows=20000),
+                   dict(rows=1000)),
+    "cli": (bench_cli_startup.run,
+            dict(repeat=10),
+            dict(repeat=2)),
+    "concurrency": (bench_concurrency.run,
+                    dict(process_counts=(1, 4, 16)),
+                    dict(process_counts=(1, 4), writes_per_process=20)),
+}
+
+
+def environment():
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=bench_cli_startup.ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "date": datetime.now().isoformat(),
+        "revision": revision,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run(names, quick=False):
+    results = {"environment": environment(), "quick": quick}
+    for name in names:
+        func, full_kwargs, quick_kwargs = BENCHMARKS[name]
+        print("Running %s..." % name, file=sys.stderr)
+        results[name] = func(**(quick_kwargs if quick else full_kwargs))
+    return results
+
+
+def _leaves(document, prefix=""):
+    for key, value in document.items():
+        if isinstance(value, dict):
+            for leaf in _leaves(value, "%s%s." % (prefix, key)):
+                yield leaf
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(old, new):
+    """Print the relative change of every number present in both runs."""
+    old_values = dict(_leaves(old))
+    for key, value in _leaves(new):
+        if key.startswith("environment.") or not old_values.get(key):
+            continue
+        print("%-60s %14.6g %14.6g %+7.1f%%"
+              % (key, old_values[key], value,
+                 (value - old_values[key]) / old_values[key] * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS),
+                        help="Benchmarks to run (default: all)")
+    parser.add_argument("--quick", action="store_true",
+                        help="Small sizes, to check that the suite works")
+    parser.add_argument("-o", "--output",
+                        help="File for the results (default: standard output)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="Compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare(old, new)
+        return
+
+    results = run(args.only or sorted(BENCHMARKS), args.quick)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
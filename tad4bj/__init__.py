@@ -1,5 +1,10 @@
 from .dbconn import DataStorage, DataSchema
-from .__main__ import main
+
+
+def main():
+    # Imported here, so that `import tad4bj` does not pay for the CLI
+    from .__main__ import main
+    return main()
 
 __all__ = ["DataStorage", "DataSchema"]
 
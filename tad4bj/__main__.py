@@ -1,17 +1,13 @@
 from __future__ import print_function
 
-import argparse
-import json
+# Job scripts call `tad4bj set` and friends a lot, so everything that is not
+# needed by those commands is imported inside the functions that need it.
+import os
 import sys
-from datetime import datetime
 
-try:
-    import yaml
-except ImportError:
-    yaml = None
-
-from . import schedulers
-from .dbconn import DummyDataStorage, DataStorage, DataSchema
+from . import schedulers, transformers
+from .dbconn import DummyDataStorage, DataStorage, DataSchema, get_data_storage
+from .handlers import NULL_FIELD
 
 
 def init(args):
@@ -24,6 +20,13 @@ def update(args):
     args.data_storage.update(ds)
 
 
+def migrate(args):
+    if args.data_storage.migrate():
+        print("Table %s has been migrated" % args.table)
+    else:
+        print("Table %s is already up to date" % args.table)
+
+
 def clear(args):
     args.data_storage.clear(remove_tables=args.remove_tables)
 
@@ -37,7 +40,8 @@ def _sanitize_job_id(args):
 
 def get(args):
     job_id = _sanitize_job_id(args)
-    value = args.data_storage.get_value(job_id, args.field, raw_return=True)
+    value = args.data_storage.get_value(job_id, args.field,
+                                        raw_return=not args.decode)
     print(value)
 
 
@@ -52,39 +56,412 @@ def set(args):
 
 
 def setnow(args):
+    from datetime import datetime
+
     job_id = _sanitize_job_id(args)
     args.data_storage.set_value(job_id, args.field, datetime.now())
 
 
+def _load_dict(path, dialect=None):
+    if path == '-':
+        fp = sys.stdin
+        if dialect is None:
+            dialect = 'json'
+    else:
+        fp = open(path, 'rb')
+        if dialect is None:
+            if path.endswith(".yaml"):
+                dialect = 'yaml'
+            else:
+                dialect = 'json'
+
+    with fp:
+        if dialect == 'json':
+            import json
+            return json.load(fp)
+        elif dialect == 'yaml':
+            return transformers.load_yaml_module().safe_load(fp)
+
+
 def setdict(args):
     job_id = _sanitize_job_id(args)
+    d = _load_dict(args.file, args.dialect)
+
+    fields, values = zip(*(d.items()))
+    args.data_storage.set_values(job_id, fields, values, raw_parameters=True)
+
+
+_BATCH_COMMANDS = {
+    # command: positional arguments
+    'get': ('field',),
+    'set': ('field', 'value'),
+    'setnow': ('field',),
+    'setdict': ('file',),
+}
+
+
+def _parse_batch_line(line):
+    """Parse a batch line into (command, jobid or None, positionals)."""
+    import shlex
+
+    tokens = shlex.split(line, comments=True)
+    if not tokens:
+        return None
+    command = tokens.pop(0)
+    if command not in _BATCH_COMMANDS:
+        raise ValueError("Unknown command %s" % command)
+
+    jobid = None
+    dialect = None
+    while tokens and tokens[0] in ('--jobid', '-j', '--dialect', '-d'):
+        if len(tokens) < 2:
+            raise ValueError("Missing value for %s" % tokens[0])
+        option, value = tokens.pop(0), tokens.pop(0)
+        if option in ('--jobid', '-j'):
+            jobid = int(value)
+        elif command == 'setdict':
+            dialect = value
+        else:
+            raise ValueError("Option %s is only valid for setdict" % option)
+
+    if len(tokens) != len(_BATCH_COMMANDS[command]):
+        raise ValueError("%s expects %s" % (command, " ".join(_BATCH_COMMANDS[command])))
+    return command, jobid, tokens, dialect
+
+
+def batch(args):
+    """Run many commands with a single process and a single transaction.
+
+    All the lines are parsed first (nothing is written if one is wrong).
+    Writes are coalesced per job and written together at the end; `get`
+    sees the writes of previous lines.
+    """
+    from collections import OrderedDict
+    from datetime import datetime
+
+    default_jobid = int(args.jobid) if args.jobid else None
 
     if args.file == '-':
-        fp = sys.stdin
-        if args.dialect is None:
-            args.dialect = 'json'
+        lines = sys.stdin.readlines()
     else:
-        fp = open(args.file, 'rb')
-        if args.dialect is None:
-            if args.file.endswith(".json"):
-                args.dialect = 'json'
-            elif args.file.endswith(".yaml"):
-                args.dialect = 'pickle'
+        with open(args.file, 'r') as f:
+            lines = f.readlines()
+
+    commands = list()
+    for lineno, line in enumerate(lines, 1):
+        try:
+            parsed = _parse_batch_line(line)
+        except ValueError as e:
+            raise ValueError("Line %d: %s" % (lineno, e)) from None
+        if parsed is not None:
+            commands.append(parsed)
+
+    # jobid -> {field: raw value}
+    pending = OrderedDict()
+    for command, jobid, positionals, dialect in commands:
+        if jobid is None:
+            if default_jobid is None:
+                default_jobid = schedulers.auto_detect_job_id()
+            jobid = default_jobid
+        row = pending.setdefault(jobid, OrderedDict())
+
+        if command == 'get':
+            field, = positionals
+            if field in row:
+                value = row[field]
+                print(value if value is not None else NULL_FIELD)
             else:
-                args.dialect = 'json'
+                print(args.data_storage.get_value(jobid, field, raw_return=True))
+        elif command == 'set':
+            field, value = positionals
+            row[field] = value
+        elif command == 'setnow':
+            field, = positionals
+            row[field] = datetime.now()
+        elif command == 'setdict':
+            path, = positionals
+            if path.startswith('{'):
+                import json
+                d = json.loads(path)
+            else:
+                d = _load_dict(path, dialect)
+            row.update(d)
+
+    rows = [(jobid, row) for jobid, row in pending.items() if row]
+    if rows:
+        # A single chunk, i.e. a single transaction
+        args.data_storage.set_many(rows, raw_parameters=True, chunk_size=len(rows))
+
+
+def _import_records(fp, dialect):
+    if dialect == 'csv':
+        import csv
+        for record in csv.DictReader(fp):
+            # CSV cannot tell apart NULL from empty strings, empty means NULL
+            yield {k: (v if v != '' else None) for k, v in record.items()}
+    elif dialect == 'jsonl':
+        import json
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+    elif dialect == 'yaml':
+        yaml = transformers.load_yaml_module()
+        for document in yaml.safe_load_all(fp):
+            if document is not None:
+                yield document
+
+
+def import_(args):
+    import io
+
+    if args.dialect is None:
+        if args.file.endswith(".csv"):
+            args.dialect = 'csv'
+        elif args.file.endswith((".yaml", ".yml")):
+            args.dialect = 'yaml'
+        else:
+            args.dialect = 'jsonl'
 
-    if args.dialect == 'json':
-        d = json.load(fp)
-    elif args.dialect == 'yaml':
-        if yaml is None:
-            raise ImportError("No YAML library available, cannot parse YAML documents")
-        d = yaml.load(fp)
+    if args.file == '-':
+        fp = sys.stdin
+    else:
+        fp = io.open(args.file, 'r', newline='')
+
+    def rows():
+        for number, record in enumerate(_import_records(fp, args.dialect), 1):
+            try:
+                jobid = int(record.pop(args.id_field))
+            except KeyError:
+                raise ValueError("Record %d: no %s field"
+                                 % (number, args.id_field)) from None
+            except (TypeError, ValueError):
+                raise ValueError("Record %d: %s is not an integer"
+                                 % (number, args.id_field)) from None
+            yield jobid, record
+
+    with fp:
+        # CSV only has strings, let SQLite type affinity deal with them
+        count = args.data_storage.set_many(rows(),
+                                           raw_parameters=args.dialect == 'csv',
+                                           chunk_size=args.chunk_size)
+    if args.verbose:
+        print("Imported %d rows" % count, file=sys.stderr)
+
+
+def export(args):
+    import io
+    from . import exporters
+
+    if args.dialect is None:
+        args.dialect = exporters.guess_format(args.output)
+
+    after_id = args.after_id
+    if after_id is None and args.watermark_file:
+        try:
+            with open(args.watermark_file, 'r') as f:
+                after_id = int(f.read().strip())
+        except IOError:
+            # First export, everything goes
+            pass
+
+    if args.dialect == 'parquet':
+        if args.output == '-':
+            raise ValueError("Parquet cannot be exported to stdout, give a path")
+        output = args.output
+    elif args.output == '-':
+        output = sys.stdout
+    else:
+        output = io.open(args.output, 'w', newline='')
+
+    try:
+        count, max_id = exporters.export(args.data_storage, output, args.dialect,
+                                         fields=args.field, where=args.where,
+                                         after_id=after_id,
+                                         batch_size=args.chunk_size)
+    finally:
+        if output is not sys.stdout and args.dialect != 'parquet':
+            output.close()
+
+    if args.watermark_file and max_id is not None:
+        with open(args.watermark_file, 'w') as f:
+            f.write("%d\n" % max_id)
+    if args.verbose:
+        print("Exported %d rows (last id: %s)" % (count, max_id), file=sys.stderr)
+
+
+def _parse_predicate(text):
+    """Parse a `FIELD OP VALUE` filter of the command line into a predicate.
+
+    VALUE is read as JSON if possible (numbers, "quoted strings", null...)
+    and as a plain string otherwise. The operands of in and between can also
+    be given as comma-separated values.
+    """
+    import argparse
+    import json
+    import re
+
+    match = (re.match(r"\s*([^\s=!<>]+)\s*(<=|>=|!=|<>|==|=|<|>)\s*(.*?)\s*$", text) or
+             re.match(r"\s*(\S+)\s+(not\s+like|like|glob|not\s+in|in|is\s+not|is|between)"
+                      r"\s+(.*?)\s*$", text, re.IGNORECASE))
+    if match is None:
+        raise argparse.ArgumentTypeError("invalid filter %r, expected FIELD OP VALUE"
+                                         % text)
+    field, op, value = match.groups()
+    op = " ".join(op.lower().split())
+
+    def parse(value):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    if op in ('in', 'not in', 'between'):
+        value = parse(value)
+        if not isinstance(value, list):
+            value = [parse(v.strip()) for v in str(value).split(',') if v.strip()]
+    else:
+        value = parse(value)
+    return field, op, value
 
-    fields, values = zip(*(d.items()))
-    args.data_storage.set_values(job_id, fields, values, raw_parameters=True)
 
+def query(args):
+    from . import exporters
+
+    where = args.where or []
+    order_by = [field for value in args.order_by or () for field in value.split(',')]
+
+    rows = args.data_storage.iter_rows(fields=args.field, where=where,
+                                       order_by=order_by, limit=args.limit,
+                                       offset=args.offset)
+    fields = args.field or list(dict(args.data_storage.get_schema().fields).keys())
+    exporters.TABLE_WRITERS[args.format](sys.stdout, fields,
+                                         exporters._batches(rows, 1000))
+
+
+def _parse_metric(text):
+    """Parse a `FIELD[:FUNCTION,...]` metric of the command line."""
+    field, colon, functions = text.rpartition(':')
+    if not colon:
+        return text, ['mean', 'min', 'max']
+    return field, [function.strip() for function in functions.split(',')]
+
+
+def summary(args):
+    from . import exporters
+
+    metrics = dict()
+    for text in args.metric or ():
+        field, functions = _parse_metric(text)
+        metrics.setdefault(field, []).extend(functions)
+    order_by = None
+    if args.order_by:
+        order_by = [field for value in args.order_by for field in value.split(',')]
+
+    rows = args.data_storage.aggregate(group_by=args.group_by, metrics=metrics,
+                                       where=args.where or None, order_by=order_by,
+                                       limit=args.limit)
+    # The actual names, not the namedtuple fields (made valid identifiers)
+    fields = list(args.group_by or ()) + [
+        "%s_%s" % (field, function)
+        for field, functions in metrics.items() for function in functions
+    ] + ['count']
+    exporters.TABLE_WRITERS[args.format](sys.stdout, fields, [rows])
+
+
+def serve(args):
+    from .server import serve as serve_forever
+
+    if args.socket:
+        address = args.socket
+    else:
+        address = "%s:%d" % (args.host, args.port)
+    serve_forever(address, path=args.database,
+                  flush_interval=args.flush_interval, flush_size=args.flush_size)
+
+
+def merge(args):
+    from .spool import merge as merge_spool
+
+    spool_dir = args.spool_dir or os.getenv("TAD4BJ_SPOOL")
+    if not spool_dir:
+        raise ValueError("No spool directory, use --spool-dir or $TAD4BJ_SPOOL")
+    journals, rows = merge_spool(args.data_storage, spool_dir, keep=args.keep,
+                                 min_age=args.min_age, chunk_size=args.chunk_size)
+    if args.verbose:
+        print("Merged %d journals (%d rows)" % (journals, rows), file=sys.stderr)
+
+
+def gc(args):
+    from .blobs import collect_garbage
+
+    removed, freed = collect_garbage(args.database or DataStorage.DATABASE_DEFAULT_PATH,
+                                     min_age=args.min_age, dry_run=args.dry_run)
+    print("%s %d unreferenced blobs (%d bytes)"
+          % ("Would remove" if args.dry_run else "Removed", removed, freed))
+
+
+class _FastArgs(object):
+    """Parsed arguments of the fast path, same attributes as argparse's."""
+    database = None
+    table = None
+    verbose = None
+    no_op = False
+    jobid = None
+    decode = False
+    job_command = True
+
+
+_FAST_COMMANDS = {
+    # command: (function, positional arguments)
+    'get': (get, ('field',)),
+    'set': (set, ('field', 'value')),
+    'setnow': (setnow, ('field',)),
+}
+
+
+def _fast_parse(argv):
+    """Parse the most frequent command lines without building the parser.
+
+    Only plain invocations of get, set and setnow are recognized (options
+    given as separate words, no help, no verbosity, no no-op...); for
+    anything else None is returned and argparse takes over.
+    """
+    args = _FastArgs()
+    argv = list(argv)
+    while argv and argv[0] in ('--database', '-d', '--table', '-t'):
+        if len(argv) < 2:
+            return None
+        option, value = argv.pop(0), argv.pop(0)
+        if option in ('--database', '-d'):
+            args.database = value
+        else:
+            args.table = value
+
+    if not argv or argv[0] not in _FAST_COMMANDS:
+        return None
+    args.func, positionals = _FAST_COMMANDS[argv.pop(0)]
+
+    if argv and argv[0] in ('--jobid', '-j'):
+        if len(argv) < 2:
+            return None
+        argv.pop(0)
+        args.jobid = argv.pop(0)
+
+    if len(argv) != len(positionals):
+        return None
+    for name, value in zip(positionals, argv):
+        # A lone '-' is a value (stdin), anything else that looks like an
+        # option needs the real parser
+        if value.startswith('-') and value != '-':
+            return None
+        setattr(args, name, value)
+    return args
+
+
+def build_parser():
+    import argparse
+    from . import exporters
 
-def main():
     parser = argparse.ArgumentParser("tad4bj")
     parser.add_argument('--database', '-d', action='store',
                         help='path to database file. Default: value of the environment '
@@ -112,6 +489,11 @@ def main():
     parser_init.add_argument('schema', action='store',
                              help='Schema file for the table that will be initialized')
 
+    parser_migrate = subparsers.add_parser('migrate', help="Rebuild a table created by "
+                                                           "an older tad4bj version "
+                                                           "with `id` as primary key")
+    parser_migrate.set_defaults(func=migrate)
+
     parser_clear = subparsers.add_parser('clear')
     parser_clear.set_defaults(func=clear)
     parser_clear.add_argument('--remove-tables', '-r', action='store_true',
@@ -129,13 +511,17 @@ def main():
     }
 
     parser_get = subparsers.add_parser('get')
-    parser_get.set_defaults(func=get)
+    parser_get.set_defaults(func=get, job_command=True)
     parser_get.add_argument(*jobid_args, **jobid_kwargs)
+    parser_get.add_argument('--decode', action='store_true',
+                            help='Decode the value according to the type of the '
+                                 'field (e.g. decompress a json+lzma field) instead '
+                                 'of printing it as stored')
     parser_get.add_argument('field', action='store',
                             help='Name of the field that will be retrieved')
 
     parser_set = subparsers.add_parser('set')
-    parser_set.set_defaults(func=set)
+    parser_set.set_defaults(func=set, job_command=True)
     parser_set.add_argument(*jobid_args, **jobid_kwargs)
     parser_set.add_argument('field', action='store',
                             help='Name of the field that will be set')
@@ -143,7 +529,7 @@ def main():
                             help='Value that will be assigned to the field')
 
     parser_setdict = subparsers.add_parser('setdict')
-    parser_setdict.set_defaults(func=setdict)
+    parser_setdict.set_defaults(func=setdict, job_command=True)
     parser_setdict.add_argument(*jobid_args, **jobid_kwargs)
     parser_setdict.add_argument('--dialect', '-d', choices=['yaml', 'json'],
                                 help='Serialization format of the dictionary used')
@@ -151,21 +537,178 @@ def main():
                                 help='Path containing a file with a dictionary that will '
                                      'be used to assign values to fields')
 
+    parser_import = subparsers.add_parser('import', help="Bulk import rows from a CSV, "
+                                                         "JSON-lines or YAML file")
+    parser_import.set_defaults(func=import_)
+    parser_import.add_argument('--dialect', '-d', choices=['csv', 'jsonl', 'yaml'],
+                               help='Format of the file. Default: guessed from the '
+                                    'extension, JSON-lines if unknown')
+    parser_import.add_argument('--id-field', '-i', action='store', default='id',
+                               help='Field of each record used as job identifier. '
+                                    'Default: id')
+    parser_import.add_argument('--chunk-size', '-c', action='store', type=int,
+                               help='Rows written per transaction. Default: %d'
+                                    % DataStorage.BULK_CHUNK_SIZE)
+    parser_import.add_argument('file', action='store',
+                               help='Path to the file with one record per row (CSV), '
+                                    'per line (JSON-lines) or per document (YAML); '
+                                    '- for stdin')
+
+    parser_export = subparsers.add_parser('export', help="Export the table to a CSV, "
+                                                         "JSON-lines or Parquet file")
+    parser_export.set_defaults(func=export)
+    parser_export.add_argument('--dialect', '-d', choices=exporters.EXPORT_FORMATS,
+                               help='Output format. Default: guessed from the '
+                                    'extension, JSON-lines if unknown')
+    parser_export.add_argument('--field', '-f', action='append',
+                               help='Field to export (can be repeated). '
+                                    'Default: all of them')
+    parser_export.add_argument('--where', '-w', action='store',
+                               help='SQL expression to filter the exported rows, '
+                                    'e.g. "flag = 42"')
+    parser_export.add_argument('--after-id', '-a', action='store', type=int,
+                               help='Only export rows with an id above this one')
+    parser_export.add_argument('--watermark-file', '-W', action='store',
+                               help='File holding the last exported id. Only rows '
+                                    'above it are exported, and it is updated '
+                                    'afterwards (for incremental exports)')
+    parser_export.add_argument('--chunk-size', '-c', action='store', type=int,
+                               help='Rows processed at once. Default: %d'
+                                    % DataStorage.ITER_CHUNK_SIZE)
+    parser_export.add_argument('output', action='store',
+                               help='Path of the output file; - for stdout')
+
+    parser_query = subparsers.add_parser('query', help="Print the rows that match some "
+                                                       "filters, sorted and limited "
+                                                       "by SQLite")
+    parser_query.set_defaults(func=query)
+    parser_query.add_argument('--field', '-f', action='append',
+                              help='Field to print (can be repeated). Default: all')
+    parser_query.add_argument('--where', '-w', action='append', type=_parse_predicate,
+                              help='Filter as FIELD OP VALUE, e.g. "lr<0.01" or '
+                                   '"status in done,failed" (can be repeated, all '
+                                   'must hold). OP is one of =, !=, <, <=, >, >=, '
+                                   'like, not like, glob, in, not in, between, is, '
+                                   'is not')
+    parser_query.add_argument('--order-by', '-o', action='append',
+                              help='Field to sort by, descending if prefixed with '
+                                   '"-" as in --order-by=-lr (can be repeated or '
+                                   'comma-separated)')
+    parser_query.add_argument('--limit', '-l', action='store', type=int,
+                              help='Print at most LIMIT rows')
+    parser_query.add_argument('--offset', action='store', type=int,
+                              help='Skip the first OFFSET rows')
+    parser_query.add_argument('--format', '-F', action='store', default='tsv',
+                              choices=('tsv', 'csv', 'json', 'jsonl'),
+                              help='Output format. Default: tsv, with a header')
+
+    parser_summary = subparsers.add_parser('summary', help="Print aggregates of some "
+                                                           "fields by groups, computed "
+                                                           "by SQLite")
+    parser_summary.set_defaults(func=summary)
+    parser_summary.add_argument('--group-by', '-g', action='append',
+                                help='Field to group by (can be repeated). Fields '
+                                     'can be paths inside json fields, like '
+                                     'config.optimizer')
+    parser_summary.add_argument('--metric', '-m', action='append',
+                                help='Field to aggregate, as FIELD:FUNCTION,... with '
+                                     'functions among count, sum, mean, min, max, '
+                                     'var and std (can be repeated). Default '
+                                     'functions: mean,min,max')
+    parser_summary.add_argument('--where', '-w', action='append', type=_parse_predicate,
+                                help='Filter of the rows, as in query')
+    parser_summary.add_argument('--order-by', '-o', action='append',
+                                help='Result column to sort by (e.g. '
+                                     '--order-by=-accuracy_mean). Default: the '
+                                     'group fields')
+    parser_summary.add_argument('--limit', '-l', action='store', type=int,
+                                help='Print at most LIMIT groups')
+    parser_summary.add_argument('--format', '-F', action='store', default='tsv',
+                                choices=('tsv', 'csv', 'json', 'jsonl'),
+                                help='Output format. Default: tsv, with a header')
+
     parser_setnow = subparsers.add_parser('setnow')
-    parser_setnow.set_defaults(func=setnow)
+    parser_setnow.set_defaults(func=setnow, job_command=True)
     parser_setnow.add_argument(*jobid_args, **jobid_kwargs)
     parser_setnow.add_argument('field', action='store',
                                help='Name of the (timestamp-)field that will be set to "now"')
 
-    args = parser.parse_args()
+    parser_batch = subparsers.add_parser('batch', help="Run many get/set/setnow/setdict "
+                                                       "commands (one per line) in a "
+                                                       "single process and transaction")
+    parser_batch.set_defaults(func=batch, job_command=True)
+    parser_batch.add_argument('--jobid', '-j', action='store',
+                              help='Default job identifier for the commands without '
+                                   'their own --jobid. If not present, it is '
+                                   'autodetected as in the other commands.')
+    parser_batch.add_argument('file', action='store', nargs='?', default='-',
+                              help='File with the commands, e.g. "set -j 42 flag 1". '
+                                   'Default: - (stdin)')
+
+    parser_merge = subparsers.add_parser('merge', help="Merge the journals of the spool "
+                                                       "directory ($TAD4BJ_SPOOL) into "
+                                                       "the table")
+    parser_merge.set_defaults(func=merge)
+    parser_merge.add_argument('--spool-dir', '-s', action='store',
+                              help='Spool directory. Default: $TAD4BJ_SPOOL')
+    parser_merge.add_argument('--keep', '-k', action='store_true', default=False,
+                              help='Keep the merged journals (renamed to *.merged)')
+    parser_merge.add_argument('--min-age', '-m', action='store', type=float, default=0,
+                              help='Skip journals modified in the last MIN_AGE '
+                                   'seconds, i.e. from jobs that may still be running')
+    parser_merge.add_argument('--chunk-size', '-c', action='store', type=int,
+                              help='Rows written per transaction. Default: %d'
+                                   % DataStorage.BULK_CHUNK_SIZE)
+
+    parser_serve = subparsers.add_parser('serve', help="Run a daemon that owns the "
+                                                       "database, for jobs that have "
+                                                       "$TAD4BJ_SERVER set")
+    parser_serve.set_defaults(func=serve, standalone=True)
+    parser_serve.add_argument('--socket', '-s', action='store',
+                              help='Path of the Unix domain socket to listen on')
+    parser_serve.add_argument('--host', action='store', default='127.0.0.1',
+                              help='Host to listen on (TCP). Default: 127.0.0.1')
+    parser_serve.add_argument('--port', '-p', action='store', type=int, default=7455,
+                              help='Port to listen on (TCP), if no --socket is '
+                                   'given. Default: 7455')
+    parser_serve.add_argument('--flush-interval', action='store', type=float,
+                              help='Seconds between group commits. Default: %s'
+                                   % DataStorage.FLUSH_INTERVAL_DEFAULT)
+    parser_serve.add_argument('--flush-size', action='store', type=int,
+                              help='Buffered values that force a group commit. '
+                                   'Default: %s' % DataStorage.FLUSH_SIZE_DEFAULT)
+
+    parser_gc = subparsers.add_parser('gc', help="Remove the blobs (values stored out "
+                                                 "of the database) that no row "
+                                                 "references, from all the tables")
+    parser_gc.set_defaults(func=gc, standalone=True)
+    parser_gc.add_argument('--min-age', '-m', action='store', type=float, default=3600,
+                           help='Keep blobs stored in the last MIN_AGE seconds, as '
+                                'their rows may not be committed yet. Default: 3600')
+    parser_gc.add_argument('--dry-run', '-n', action='store_true', default=False,
+                           help='Only report what would be removed')
+
+    return parser
+
+
+def main():
+    args = _fast_parse(sys.argv[1:])
+    if args is None:
+        args = build_parser().parse_args()
 
-    if args.no_op:
+    if getattr(args, 'standalone', False):
+        pass
+    elif args.no_op:
         args.data_storage = DummyDataStorage()
     else:
         if not args.table:
             args.table = schedulers.auto_detect_table_name()
 
-        args.data_storage = DataStorage(args.table, path=args.database)
+        if getattr(args, 'job_command', False):
+            # Goes through the daemon if there is one
+            args.data_storage = get_data_storage(args.table, path=args.database)
+        else:
+            args.data_storage = DataStorage(args.table, path=args.database)
 
     args.func(args)
 
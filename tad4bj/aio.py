@@ -0,0 +1,285 @@
+"""Asyncio interface to DataStorage, for event-loop based workflow drivers.
+
+Calling DataStorage from a coroutine blocks the event loop while SQLite
+commits (or while `execute_with_retry` sleeps on a locked database). An
+AsyncDataStorage does all the work in a thread of its own, and its methods
+only queue a request and await its result:
+
+    async with AsyncDataStorage("mytable") as d:
+        await d.set_value(123, "status", "running")
+        h = d.get_handler(123)
+        async with h.batch:
+            await h.set("start", datetime.now())
+
+Requests are served in order, so a read sees the writes queued before it.
+Consecutive writes that are waiting in the queue are coalesced into a single
+transaction (for all their jobs and fields), so hundreds of coroutines
+annotating at once cost a few commits, not hundreds.
+"""
+import asyncio
+import queue
+from threading import Thread
+
+from .dbconn import DataStorage, _coalesce_writes
+from .handlers import NULL_FIELD, _ChangeTracking
+
+# Method of the requests that write values, which can be coalesced
+_WRITE = "write"
+_STOP = "stop"
+
+
+def _set_future(future, result, exc):
+    if future.done():
+        # Cancelled by whoever was waiting for it
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+def _resolve(future, result=None, exc=None):
+    try:
+        future.get_loop().call_soon_threadsafe(_set_future, future, result, exc)
+    except RuntimeError:
+        # The event loop is closed, nobody is waiting anymore
+        pass
+
+
+class AsyncDataStorage(object):
+    """DataStorage whose methods are coroutines, served by a worker thread.
+
+    :param table_name:
+    :param path:
+    :param max_batch: Maximum number of write requests coalesced into a
+    single transaction. Default: MAX_BATCH_DEFAULT.
+    :param kwargs: Other arguments for the DataStorage (write_behind,
+    profile...).
+    """
+    MAX_BATCH_DEFAULT = 1000
+
+    def __init__(self, table_name, path=None, max_batch=None, **kwargs):
+        self._storage = DataStorage(table_name, path, **kwargs)
+        self._max_batch = max_batch or AsyncDataStorage.MAX_BATCH_DEFAULT
+        self._queue = queue.Queue()
+        self._closed = False
+        self._child_handlers = list()
+        self.stats = self._storage.stats
+        self.stats.setdefault("coalesced_writes", 0)
+        self._thread = Thread(target=self._run, name="tad4bj-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        request = None
+        while True:
+            if request is None:
+                request = self._queue.get()
+            method, args, future = request
+            request = None
+
+            if method is _STOP:
+                try:
+                    self._storage.close()
+                except Exception as e:
+                    _resolve(future, exc=e)
+                else:
+                    _resolve(future)
+                return
+
+            if method is not _WRITE:
+                try:
+                    name, call_args, call_kwargs = args
+                    result = getattr(self._storage, name)(*call_args, **call_kwargs)
+                except Exception as e:
+                    _resolve(future, exc=e)
+                else:
+                    _resolve(future, result)
+                continue
+
+            writes = [(args, future)]
+            while len(writes) < self._max_batch:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request[0] is not _WRITE:
+                    # Served in the next iteration, after these writes
+                    break
+                writes.append((request[1], request[2]))
+                request = None
+            self._write(writes)
+
+    def _write(self, writes):
+        try:
+            for raw, rows in _coalesce_writes(args for args, _ in writes):
+                self._storage.set_many(rows, raw_parameters=raw)
+        except Exception as e:
+            if len(writes) == 1:
+                _resolve(writes[0][1], exc=e)
+                return
+            # Some request is wrong: serve each on its own, so that only
+            # its own future fails
+            for (jobid, values, raw), future in writes:
+                try:
+                    self._storage.set_many([(jobid, values)], raw_parameters=raw)
+                except Exception as request_error:
+                    _resolve(future, exc=request_error)
+                else:
+                    _resolve(future)
+        else:
+            self.stats["coalesced_writes"] += len(writes) - 1
+            for _, future in writes:
+                _resolve(future)
+
+    def _submit(self, method, args):
+        if self._closed:
+            raise ConnectionError("The AsyncDataStorage has already been closed")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put((method, args, future))
+        return future
+
+    def _call(self, name, *args, **kwargs):
+        return self._submit(name, (name, args, kwargs))
+
+    async def get_value(self, jobid, field, raw_return=False):
+        return await self._call("get_value", jobid, field, raw_return=raw_return)
+
+    async def get_values(self, jobid, fields=None, raw_return=False):
+        return await self._call("get_values", jobid, fields, raw_return=raw_return)
+
+    async def set_value(self, jobid, field, parameter, raw_parameter=False):
+        await self._submit(_WRITE, (jobid, {field: parameter}, raw_parameter))
+
+    async def set_values(self, jobid, fields, parameters, raw_parameters=False):
+        await self._submit(_WRITE, (jobid, dict(zip(fields, parameters)),
+                                    raw_parameters))
+
+    async def query(self, fields=None, where=None, params=None, order_by=None,
+                    limit=None, offset=None):
+        """Same as `DataStorage.query`."""
+        return await self._call("query", fields, where, params, order_by=order_by,
+                                limit=limit, offset=offset)
+
+    async def aggregate(self, group_by=None, metrics=None, where=None, **kwargs):
+        """Same as `DataStorage.aggregate`."""
+        return await self._call("aggregate", group_by, metrics, where, **kwargs)
+
+    async def flush(self):
+        """Wait for the queued requests, and commit any write-behind buffer."""
+        await self._call("flush")
+
+    async def close(self):
+        """Write the changes of the handlers, serve the queued requests and
+        close the DataStorage."""
+        if self._closed:
+            return
+        try:
+            for h in self._child_handlers:
+                await h.close()
+        finally:
+            self._child_handlers = list()
+            future = self._submit(_STOP, None)
+            self._closed = True
+            await future
+
+    def get_handler(self, jobid):
+        h = AsyncJobHandler(self, jobid)
+        self._child_handlers.append(h)
+        return h
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AsyncBatchHandler(object):
+    """Async version of `handlers.BatchHandler`."""
+    def __init__(self, parent_jobhandler):
+        self._h = parent_jobhandler
+
+    async def __aenter__(self):
+        self._h._defer_write = True
+        return self._h
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._h._closed:
+            raise ConnectionError("The handler has already been closed")
+        self._h._defer_write = False
+        await self._h.write_all()
+
+
+class AsyncJobHandler(_ChangeTracking):
+    """Async version of `handlers.JobHandler`, for an AsyncDataStorage.
+
+    The item syntax cannot be awaited, so fields are read with `get` and
+    `setdefault`, written with `set` and deleted (set to NULL) with
+    `delete`. As in JobHandler, values are kept in memory, and `write_all`
+    (on batch exit and on close) writes the fields that have been assigned
+    or changed in place.
+    """
+
+    def __init__(self, datastorage, jobid):
+        self._id = jobid
+        self._data = datastorage
+        self._inmemory_objects = dict()
+        self._dirty = set()
+        self._digests = dict()
+        self.batch = AsyncBatchHandler(self)
+        self._defer_write = False
+        self._closed = False
+
+    async def _fetch(self, field):
+        try:
+            return self._inmemory_objects[field]
+        except KeyError:
+            pass
+        value = await self._data.get_value(self._id, field)
+        # Assigned meanwhile by another coroutine?
+        if field in self._inmemory_objects:
+            return self._inmemory_objects[field]
+        self._inmemory_objects[field] = value
+        self._mark_clean(field, value)
+        return value
+
+    async def get(self, field, default=None):
+        value = await self._fetch(field)
+        return default if value is NULL_FIELD else value
+
+    async def contains(self, field):
+        return await self._fetch(field) is not NULL_FIELD
+
+    async def set(self, field, value):
+        self._inmemory_objects[field] = value
+        if self._defer_write:
+            self._dirty.add(field)
+        else:
+            await self._data.set_value(self._id, field, value)
+            self._mark_clean(field, value)
+
+    async def delete(self, field):
+        await self.set(field, NULL_FIELD)
+
+    async def setdefault(self, field, default=None):
+        value = await self._fetch(field)
+        if value is NULL_FIELD:
+            await self.set(field, default)
+            return default
+        return value
+
+    async def write_all(self):
+        if self._closed:
+            raise ConnectionError("This handler has already been closed")
+        changed = [field for field in self._inmemory_objects
+                   if self._has_changed(field)]
+        if changed:
+            values = [self._inmemory_objects[field] for field in changed]
+            await self._data.set_values(self._id, changed, values)
+            for field, value in zip(changed, values):
+                self._mark_clean(field, value)
+
+    async def close(self):
+        if not self._closed:
+            await self.write_all()
+            self._closed = True
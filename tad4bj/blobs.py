@@ -0,0 +1,147 @@
+"""Content-addressed store for large values, next to the database.
+
+When a DataStorage has a blob threshold (see its `blob_threshold`), the
+encoded values of serialized fields (pickle, json+lzma...) that reach that
+size are written to `<database>.blobs/<sha256[:2]>/<sha256[2:]>` instead of
+the table, and the row only holds a small reference. References are
+resolved when the value is decoded, by memory-mapping the blob; raw reads
+(`raw_return`, `to_dataframe(decode=False)`...) return the reference as is.
+
+Blobs are shared by all the tables of the database. `collect_garbage`
+(`tad4bj gc`) removes the ones that no row references anymore.
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+import tempfile
+from time import time
+
+from .dbconn import quote_identifier
+from .transformers import BLOB_REF_MAGIC
+
+BLOBS_SUFFIX = ".blobs"
+
+
+def is_blob_ref(value):
+    return isinstance(value, bytes) and value.startswith(BLOB_REF_MAGIC)
+
+
+class BlobStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def for_database(cls, path):
+        return cls(path + BLOBS_SUFFIX)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def put(self, data):
+        """Store data (bytes or str) and get the reference to it."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+
+        if os.path.exists(path):
+            # Already there; refresh it so that a concurrent gc leaves it be
+            os.utime(path)
+        else:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    # The row that references it may be committed right away
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        return BLOB_REF_MAGIC + digest.encode("ascii")
+
+    def get(self, ref):
+        """Get a read-only memoryview of the blob of a reference.
+
+        The blob is memory-mapped, so it is only read as it is accessed and
+        the pages stay in the page cache, not in the heap of the process.
+        """
+        digest = ref[len(BLOB_REF_MAGIC):].decode("ascii")
+        with open(self._path(digest), "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __iter__(self):
+        """Iterate over the (digest, path) of the stored blobs."""
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in sorted(os.listdir(self.directory)):
+            directory = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".tmp"):
+                    continue
+                yield prefix + name, os.path.join(directory, name)
+
+
+def referenced_digests(conn):
+    """Get the digests of all the blobs referenced from a database."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    tables = [name for name, in cursor.fetchall()]
+
+    digests = set()
+    for table in tables:
+        cursor.execute("PRAGMA table_info(%s)" % quote_identifier(table))
+        for column in [quote_identifier(row[1]) for row in cursor.fetchall()]:
+            cursor.execute(
+                "SELECT {0} FROM {1} WHERE typeof({0}) = 'blob' "
+                "AND substr({0}, 1, {2}) = ?".format(
+                    column, quote_identifier(table), len(BLOB_REF_MAGIC)),
+                (BLOB_REF_MAGIC,)
+            )
+            digests.update(value[len(BLOB_REF_MAGIC):].decode("ascii")
+                           for value, in cursor.fetchall())
+    return digests
+
+
+def collect_garbage(path, min_age=3600, dry_run=False):
+    """Remove the blobs of a database that are not referenced by any row.
+
+    :param path: Database path.
+    :param min_age: Skip blobs stored less than min_age seconds ago, which
+    may belong to rows not committed yet (e.g. pending in write-behind mode).
+    :param dry_run: Only count what would be removed.
+    :return: Tuple (number of blobs removed, bytes freed).
+    """
+    store = BlobStore.for_database(path)
+    if not os.path.isdir(store.directory):
+        return 0, 0
+
+    conn = sqlite3.connect(path)
+    try:
+        referenced = referenced_digests(conn)
+    finally:
+        conn.close()
+
+    now = time()
+    removed = freed = 0
+    for digest, blob_path in store:
+        if digest in referenced:
+            continue
+        stat = os.stat(blob_path)
+        if now - stat.st_mtime < min_age:
+            continue
+        if not dry_run:
+            os.unlink(blob_path)
+        removed += 1
+        freed += stat.st_size
+    return removed, freed
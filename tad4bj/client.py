@@ -0,0 +1,136 @@
+"""Client side of the `tad4bj serve` daemon.
+
+RemoteDataStorage has the same job-level interface as DataStorage, but all
+the operations are sent to the daemon that owns the database instead of
+opening the SQLite file. It is used when $TAD4BJ_SERVER is set, see
+`dbconn.get_data_storage`.
+"""
+import os
+from multiprocessing.connection import Client
+from threading import RLock
+
+from . import handlers
+
+AUTHKEY_DEFAULT_PATH = "~/.tad4bj.key"
+
+
+def parse_address(address):
+    """Get the (address, family) of a server address string.
+
+    "host:port" (or just ":port", meaning localhost) is a TCP address,
+    anything else is the path to a Unix domain socket.
+    """
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port)), "AF_INET"
+    return os.path.expanduser(address), "AF_UNIX"
+
+
+def get_authkey(create=False):
+    """Get the shared secret used to authenticate clients of the daemon.
+
+    It comes from $TAD4BJ_AUTHKEY or, if not set, from the file in
+    $TAD4BJ_AUTHKEY_FILE (default ~/.tad4bj.key), which is created (only
+    readable by the user) if create is True and it does not exist.
+    """
+    key = os.getenv("TAD4BJ_AUTHKEY")
+    if key:
+        return key.encode("utf-8")
+
+    path = os.path.expanduser(os.getenv("TAD4BJ_AUTHKEY_FILE",
+                                        AUTHKEY_DEFAULT_PATH))
+    if create and not os.path.exists(path):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32).hex().encode("ascii"))
+
+    with open(path, "rb") as f:
+        return f.read().strip()
+
+
+class RemoteError(Exception):
+    """An error raised by the daemon that could not be sent back as is."""
+
+
+class RemoteDataStorage(object):
+    """DataStorage look-alike that talks to a `tad4bj serve` daemon."""
+
+    def __init__(self, table_name, address=None):
+        """
+        :param table_name:
+        :param address: Address of the daemon. Default: $TAD4BJ_SERVER.
+        """
+        if address is None:
+            address = os.environ["TAD4BJ_SERVER"]
+
+        self.lock = RLock()
+        self._table = table_name
+        address, family = parse_address(address)
+        self._conn = Client(address, family=family, authkey=get_authkey())
+        self._child_handlers = list()
+
+    def _call(self, method, *args, **kwargs):
+        with self.lock:
+            if self._conn is None:
+                raise ConnectionError("The connection to the server is closed")
+            self._conn.send((method, self._table, args, kwargs))
+            status, result = self._conn.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def close(self):
+        for h in self._child_handlers:
+            h.close()
+
+        with self.lock:
+            if self._conn is not None:
+                self._call("flush")
+                self._conn.close()
+                self._conn = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except (OSError, EOFError):
+            # The daemon is gone, nothing to do
+            pass
+
+    def flush(self):
+        self._call("flush")
+
+    def get_value(self, jobid, field, raw_return=False):
+        return self._call("get_value", jobid, field, raw_return=raw_return)
+
+    def get_values(self, jobid, fields=None, raw_return=False):
+        return self._call("get_values", jobid,
+                          None if fields is None else list(fields),
+                          raw_return=raw_return)
+
+    def set_value(self, jobid, field, parameter, raw_parameter=False):
+        self._call("set_value", jobid, field, parameter,
+                   raw_parameter=raw_parameter)
+
+    def set_values(self, jobid, fields, parameters, raw_parameters=False):
+        self._call("set_values", jobid, list(fields), list(parameters),
+                   raw_parameters=raw_parameters)
+
+    def set_many(self, rows, raw_parameters=False, chunk_size=None):
+        return self._call("set_many", list(rows), raw_parameters=raw_parameters,
+                          chunk_size=chunk_size)
+
+    def append_series(self, rows):
+        return self._call("append_series", list(rows))
+
+    def last_series_step(self, jobid, series):
+        return self._call("last_series_step", jobid, series)
+
+    def get_series(self, series, jobids=None):
+        if jobids is not None and not isinstance(jobids, int):
+            jobids = list(jobids)
+        return self._call("get_series", series, jobids)
+
+    def get_handler(self, jobid, prefetch=None):
+        h = handlers.JobHandler(self, jobid, prefetch=prefetch)
+        self._child_handlers.append(h)
+        return h
@@ -1,17 +1,14 @@
-import json
+import atexit
 import os
 import sqlite3
-from collections import namedtuple
+import weakref
+from collections import OrderedDict, namedtuple
 from collections.abc import Mapping
-from functools import wraps
-from random import random
-from threading import RLock
-from time import sleep
-
-try:
-    import yaml
-except ImportError:
-    yaml = None
+from contextlib import contextmanager
+from functools import partial, wraps
+from itertools import groupby
+from threading import RLock, Timer
+from time import sleep, time
 
 from . import handlers, transformers
 from .handlers import NULL_FIELD
@@ -34,6 +31,273 @@ def protect_method_mt(method):
     return wrapper
 
 
+def _env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# DataStorage instances with write-behind enabled, closed (hence flushed) at
+# interpreter exit
+# (keyed by id, as Mapping instances are not hashable)
+_write_behind_storages = weakref.WeakValueDictionary()
+
+
+# All the open DataStorage instances, which forked children must reset
+_storages = weakref.WeakValueDictionary()
+# Connections inherited from the parent process. SQLite connections must
+# not be used across a fork, and closing one may roll back (i.e. write) what
+# the parent is doing, so they are kept open (and unused) forever.
+_inherited_connections = list()
+
+
+def _reset_storages_after_fork():
+    for storage in list(_storages.values()):
+        storage._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_storages_after_fork)
+
+
+@atexit.register
+def _flush_write_behind_storages():
+    for storage in list(_write_behind_storages.values()):
+        try:
+            storage.close()
+        except Exception:
+            # Nothing sensible can be done at exit time, keep flushing the rest
+            pass
+
+
+# Filesystems where SQLite WAL mode is unsafe (shared memory across nodes)
+NETWORK_FILESYSTEMS = {
+    "nfs", "nfs4", "lustre", "gpfs", "cifs", "smb3", "smbfs", "beegfs",
+    "ceph", "cephfs", "panfs", "afs", "fuse.sshfs", "glusterfs",
+    "fuse.glusterfs",
+}
+
+
+def _filesystem_type(path):
+    """Return the type of the filesystem containing path (None if unknown)."""
+    path = os.path.realpath(path)
+    best_mount, best_type = "", None
+    try:
+        with open("/proc/self/mounts", "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mount_point = parts[1].replace("\\040", " ")
+                if path == mount_point or path.startswith(
+                        mount_point.rstrip("/") + "/"):
+                    if len(mount_point) > len(best_mount):
+                        best_mount, best_type = mount_point, parts[2]
+    except (IOError, OSError):
+        return None
+    return best_type
+
+
+def _is_lock_error(exc):
+    message = str(exc).lower()
+    return "locked" in message or "busy" in message
+
+
+class ConcurrencyProfile(object):
+    """Connection setup and retry policy used by DataStorage.
+
+    :param journal_mode: SQLite journal mode to set on connection (e.g. "wal"),
+    or None to leave it untouched. WAL is skipped on network filesystems.
+    :param busy_timeout: Seconds that SQLite itself waits on a locked database.
+    :param immediate: Use BEGIN IMMEDIATE for write transactions, so the write
+    lock is taken upfront instead of failing halfway through.
+    :param max_retries: Times that a write transaction is retried after a
+    "database is locked" error.
+    :param backoff_base: Upper bound of the first retry delay, in seconds.
+    :param backoff_cap: Upper bound of any retry delay, in seconds.
+    """
+
+    def __init__(self, journal_mode=None, busy_timeout=5.0, immediate=False,
+                 max_retries=5, backoff_base=0.05, backoff_cap=3.0):
+        self.journal_mode = journal_mode
+        self.busy_timeout = busy_timeout
+        self.immediate = immediate
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    def backoff_delay(self, attempt):
+        """Exponential backoff with full jitter for the given retry attempt."""
+        from random import random
+        return random() * min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+
+
+PROFILES = {
+    # Same connection setup as always
+    "default": ConcurrencyProfile(),
+    # Many writers (e.g. job arrays) sharing the same database file
+    "concurrent": ConcurrencyProfile(
+        journal_mode="wal",
+        busy_timeout=30.0,
+        immediate=True,
+        max_retries=10,
+        backoff_base=0.01,
+        backoff_cap=2.0,
+    ),
+}
+
+
+def _dataframe_column(pd, decltype, values, decode, resolve=None,
+                      writable_arrays=False):
+    """Convert the raw values of a column into a pandas Series."""
+    base = transformers.base_decltype(decltype) or ""
+    try:
+        if base in ("timestamp", "datetime", "date"):
+            return pd.to_datetime(pd.Series(values, dtype=object), format="ISO8601")
+        if "int" in base:
+            return pd.Series(pd.array(values, dtype="Int64"))
+        if any(t in base for t in ("real", "floa", "doub")):
+            return pd.Series(values, dtype="float64")
+    except (TypeError, ValueError):
+        # SQLite is dynamically typed, some values do not match their column
+        return pd.Series(values, dtype=object)
+
+    if decode:
+        values = transformers.decode_column(decltype, values, resolve=resolve,
+                                            writable_arrays=writable_arrays)
+    return pd.Series(values, dtype=object)
+
+
+def quote_identifier(name):
+    """Quote a table or field name to use it in SQL statements.
+
+    Backticks (unlike double quotes) never fall back to a string literal,
+    so a misspelled field is an error instead of a constant.
+    """
+    return "`%s`" % name.replace("`", "``")
+
+
+# Operators of the predicates of DataStorage filters (see `_where_clause`)
+QUERY_OPERATORS = ("=", "==", "!=", "<>", "<", "<=", ">", ">=", "like",
+                   "not like", "glob", "in", "not in", "between", "is", "is not")
+
+
+def _is_operator_tuple(value):
+    return (isinstance(value, tuple) and len(value) == 2
+            and isinstance(value[0], str) and value[0].lower() in QUERY_OPERATORS)
+
+
+def _fetch_chunk(cursor, chunk_size):
+    return cursor.fetchmany(chunk_size)
+
+
+def _json_extract_sql(column, path):
+    """SQL expression of a JSON path inside a column.
+
+    NULL for values that are not valid JSON (instead of an error, which
+    would make writes fail when it is a generated column).
+    """
+    return "(CASE WHEN json_valid({0}) THEN json_extract({0}, '{1}') END)".format(
+        quote_identifier(column), path.replace("'", "''"))
+
+
+class _Variance(object):
+    """Sample variance (NULL for less than two values), like in pandas.
+
+    SQLite aggregate, with Welford's algorithm: the textbook one-pass
+    formula loses all the precision for large values close together.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            # As in avg(), values that are not numbers count as 0
+            value = 0.0
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self):
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+
+class _StandardDeviation(_Variance):
+    def finalize(self):
+        variance = _Variance.finalize(self)
+        return None if variance is None else variance ** 0.5
+
+
+def _register_aggregates(conn):
+    conn.create_aggregate("tad4bj_var", 1, _Variance)
+    conn.create_aggregate("tad4bj_std", 1, _StandardDeviation)
+
+
+def _connect_reader(path, timeout):
+    from . import pool
+    conn = pool.connect_reader(path, timeout)
+    _register_aggregates(conn)
+    return conn
+
+
+# Aggregate functions of DataStorage.aggregate: SQL over the field (as {0})
+# and function applied to the result, if any.
+AGGREGATES = {
+    "count": ("count({0})", None),
+    "sum": ("sum({0})", None),
+    "mean": ("avg({0})", None),
+    "min": ("min({0})", None),
+    "max": ("max({0})", None),
+    "var": ("tad4bj_var({0})", None),
+    "std": ("tad4bj_std({0})", None),
+}
+
+
+def _coalesce_writes(writes):
+    """Merge writes for `set_many`, where each field keeps its latest value.
+
+    :param writes: Iterable of (jobid, {field: value}, raw_parameters).
+    :return: List of (raw_parameters, rows) for set_many calls.
+    """
+    rows = {False: OrderedDict(), True: OrderedDict()}
+    for jobid, values, raw in writes:
+        raw = bool(raw)
+        older = rows[not raw].get(jobid)
+        if older:
+            for field in values:
+                older.pop(field, None)
+        rows[raw].setdefault(jobid, dict()).update(values)
+    return [(raw, [(jobid, values) for jobid, values in raw_rows.items() if values])
+            for raw, raw_rows in rows.items() if raw_rows]
+
+
+def _identifier(name):
+    """Name with "_" in place of the characters not valid in identifiers."""
+    return "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+
+
+def _column_type(field_type):
+    """Declared type as it goes in a column definition.
+
+    Chains of codecs (e.g. pickle+zlib) are not valid SQL type names unless
+    quoted; SQLite still reports them unquoted.
+    """
+    if "+" in field_type and field_type[0] not in "\"'`":
+        return '"%s"' % field_type
+    return field_type
+
+
 class DataSchema:
     def __init__(self, dict):
         self._dict = dict
@@ -41,6 +305,16 @@ class DataSchema:
     def __getattr__(self, name):
         return self._dict[name]
 
+    @property
+    def indexes(self):
+        """Index specs, or None if the schema does not declare them.
+
+        Each spec is a field name, a list of field names or a mapping with
+        "fields" and optionally "name" and "unique". A field can also be a
+        path inside a json field, as `config.optimizer` or `config.layers[0]`.
+        """
+        return self._dict.get("indexes")
+
     @classmethod
     def load_from_file(cls, path):
         """
@@ -49,13 +323,16 @@ class DataSchema:
         """
         with open(path, "r") as f:
             if path.endswith(".json"):
+                import json
                 dict_data = json.load(f)
             elif path.endswith(".yaml"):
-                if not yaml:
+                try:
+                    import yaml
+                except ImportError:
                     raise ImportError(
                         "No YAML available --could not load %s file" % path
                     )
-                dict_data = yaml.load(f)
+                dict_data = yaml.safe_load(f)
             else:
                 raise NotImplementedError(
                     "File type not recognized, unable to read %s" % path
@@ -70,115 +347,1043 @@ class DataStorage(Mapping):
     This class will use a SQLite file and present it with more general
     interface to avoid having to cope with SQL and its internals.
 
-    DISCLAIMER: I am using %s string formatting instead of the SQL intended ?
-    because there where some issues in certain places (like table name) and
-    the user has already access to the database itself, so there's no security
-    issue.
+    Values always go to SQLite as ? parameters. Table and field names cannot
+    be parameters, so they are put in the statements through
+    `quote_identifier`; only a `where` given as a SQL string is used as is.
     """
 
     DATABASE_DEFAULT_PATH = os.path.expanduser(
         os.getenv("TAD4BJ_DATABASE", "~/tad4bj.db")
     )
 
-    def __init__(self, table_name, path=None):
+    FLUSH_INTERVAL_DEFAULT = 5.0
+    FLUSH_SIZE_DEFAULT = 500
+    BULK_CHUNK_SIZE = 5000
+    ITER_CHUNK_SIZE = 1000
+
+    def __init__(self, table_name, path=None, write_behind=None,
+                 flush_interval=None, flush_size=None, profile=None,
+                 blob_threshold=None, pool_size=None, writable_arrays=False):
         """
         :param table_name:
         :param path:
+        :param write_behind: Buffer writes in memory and commit them in groups.
+        Defaults to the $TAD4BJ_WRITE_BEHIND environment variable (off).
+        :param flush_interval: Maximum seconds that a buffered write may wait
+        before being committed. Defaults to $TAD4BJ_FLUSH_INTERVAL or 5.
+        :param flush_size: Number of buffered field values that triggers a
+        commit. Defaults to $TAD4BJ_FLUSH_SIZE or 500.
+        :param profile: ConcurrencyProfile instance or name of one in PROFILES.
+        Defaults to $TAD4BJ_PROFILE or "default".
+        :param blob_threshold: Size (in bytes) from which the encoded values
+        of serialized fields are stored out of the table, in the blob store
+        of the database (see `blobs`). Defaults to $TAD4BJ_BLOB_THRESHOLD or
+        0, which disables it.
+        :param pool_size: Enable the pooled mode (see `pool`), with at most
+        this number of reading connections, so that reads from many threads
+        run in parallel. Defaults to $TAD4BJ_POOL_SIZE or 0, which disables
+        it (all the operations then share a single connection).
+        :param writable_arrays: Decode the values of ndarray fields as
+        writable copies, instead of read-only views of the stored value.
+
+        With write-behind, a write that `set_value` or `set_values` has
+        returned from is only in memory until the next flush. Flushes happen
+        when flush_size values are pending, flush_interval seconds after the
+        first pending write, before reads of pending values (see
+        `_has_pending`), on `flush`, on `close` and at interpreter exit. A crash, a SIGKILL or a scheduler time limit
+        loses whatever was pending at that moment; committed writes are as
+        durable as always. All buffered writes are committed in a single
+        transaction, so a flush is atomic.
         """
         if not path:
             path = DataStorage.DATABASE_DEFAULT_PATH
 
-        self.lock = RLock()
-
-        transformers.register_converters()
-        self._conn = sqlite3.connect(
-            path,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-            check_same_thread=False,
-        )
-        self._cursor = self._conn.cursor()
+        if write_behind is None:
+            write_behind = _env_flag("TAD4BJ_WRITE_BEHIND")
+        if flush_interval is None:
+            flush_interval = float(os.getenv("TAD4BJ_FLUSH_INTERVAL",
+                                             DataStorage.FLUSH_INTERVAL_DEFAULT))
+        if flush_size is None:
+            flush_size = int(os.getenv("TAD4BJ_FLUSH_SIZE",
+                                       DataStorage.FLUSH_SIZE_DEFAULT))
+
+        if blob_threshold is None:
+            blob_threshold = int(os.getenv("TAD4BJ_BLOB_THRESHOLD", 0))
+        if pool_size is None:
+            pool_size = int(os.getenv("TAD4BJ_POOL_SIZE", 0))
+        if path == ":memory:":
+            # Each connection would have its own database
+            pool_size = 0
+
+        if profile is None:
+            profile = os.getenv("TAD4BJ_PROFILE", "default")
+        if not isinstance(profile, ConcurrencyProfile):
+            try:
+                profile = PROFILES[profile]
+            except KeyError:
+                raise ValueError("Unknown concurrency profile: %s" % profile)
+
+        # Counters to tune the concurrency profile
+        self.stats = {
+            "write_transactions": 0,
+            "write_time": 0.0,
+            "write_retries": 0,
+            "write_wait": 0.0,
+            "write_failures": 0,
+            "write_dropped": 0,
+        }
+
+        self._profile = profile
+        self._path = path
+        # Set in forked children, until they reconnect
+        self._forked = False
+        self._connect()
+
+        self._pool_size = pool_size
+        self._setup_lock_and_pool()
+        if pool_size:
+            # Readers only run along the writer with WAL
+            journal_mode = profile.journal_mode or "wal"
+        else:
+            journal_mode = profile.journal_mode
+        self.journal_mode = self._setup_journal_mode(path, journal_mode)
         self._table = table_name
         self._metadata = None
+        # Generated columns (JSON paths of indexes), not in the metadata
+        self._generated_columns = set()
         self._rowtuple = None
+        self._row_decoders = dict()
         self._field_adapters = dict()
         self._always_commit = True
+        # Tables created before `id` was a primary key cannot use UPSERT,
+        # this is set to False when one of them is detected
+        self._upsert = True
+
+        self._write_behind = write_behind
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        # jobid -> {field: adapted value}, in arrival order
+        self._pending = OrderedDict()
+        self._pending_count = 0
+        self._flush_timer = None
+        self._closing = False
+        if write_behind:
+            _write_behind_storages[id(self)] = self
+
+        self._table_sql = quote_identifier(table_name)
+        self._series_table = "%s_series" % table_name
+        self._series_sql = quote_identifier(self._series_table)
+        self._series_ready = False
+
+        self._blob_threshold = blob_threshold if path != ":memory:" else 0
+        self._blob_store = None
+        self._writable_arrays = writable_arrays
 
         self._child_handlers = list()
 
+    def _connect(self):
+        # No detect_types: values are decoded by the RowDecoder plans
+        self._connection = sqlite3.connect(
+            self._path,
+            check_same_thread=False,
+            timeout=self._profile.busy_timeout,
+            isolation_level="IMMEDIATE" if self._profile.immediate else "",
+        )
+        _register_aggregates(self._connection)
+        self._main_cursor = self._connection.cursor()
+        _storages[id(self)] = self
+
+    def _setup_lock_and_pool(self):
+        if self._pool_size:
+            from . import pool
+            # Only the writes (and schema changes) take the lock
+            self.lock = pool.ContentionLock(self.stats)
+            self._pool = pool.ConnectionPool(
+                partial(_connect_reader, self._path, self._profile.busy_timeout),
+                self._pool_size, self.stats)
+        else:
+            self.lock = RLock()
+            self._pool = None
+
+    def _after_fork(self):
+        """Forget what is shared with the parent, in a forked child.
+
+        The lock may be held by a thread that only exists in the parent, and
+        the connections cannot be used by both processes; new ones are
+        opened if (and when) the child uses this DataStorage. Writes pending
+        in write-behind mode are left for the parent to commit.
+        """
+        if self._connection is None:
+            # Closed
+            return
+        _inherited_connections.append((self._connection, self._pool))
+        self._forked = True
+        self._connection = self._main_cursor = None
+        self._setup_lock_and_pool()
+        self._pending = OrderedDict()
+        self._pending_count = 0
+        self._flush_timer = None
+
+    def _reconnect(self):
+        with self.lock:
+            if self._forked:
+                self._connect()
+                self._forked = False
+
+    @property
+    def _conn(self):
+        if self._forked:
+            self._reconnect()
+        return self._connection
+
+    @property
+    def _cursor(self):
+        if self._forked:
+            self._reconnect()
+        return self._main_cursor
+
+    def _setup_journal_mode(self, path, journal_mode):
+        if journal_mode is not None and journal_mode.lower() == "wal":
+            if path == ":memory:" or \
+                    _filesystem_type(os.path.dirname(os.path.abspath(path))) \
+                    in NETWORK_FILESYSTEMS:
+                journal_mode = None
+
+        if journal_mode is None:
+            # Unknown, but not worth a query on every connection
+            return None
+
+        try:
+            self._cursor.execute("PRAGMA journal_mode=%s" % journal_mode)
+            return self._cursor.fetchone()[0]
+        except sqlite3.OperationalError:
+            # Locked by somebody else; the mode will be whatever it was
+            return None
+
+    @protect_method_mt
+    def _load_metadata(self):
+        # table_xinfo also lists the generated (hidden) columns
+        self._cursor.execute("PRAGMA table_xinfo(%s)" % self._table_sql)
+        result = self._cursor.fetchall()
+        self._metadata = {
+            column_name: column_type
+            for _, column_name, column_type, _, _, _, hidden in result
+            if not hidden
+        }
+        self._generated_columns = {
+            column_name for _, column_name, _, _, _, _, hidden in result if hidden
+        }
+        return self._metadata
+
+    def _field_sql(self, field):
+        """SQL expression of a field, which can be a path inside a json field.
+
+        Paths with a generated column (see `_sync_indexes`) use it, so that
+        its index can be used.
+        """
+        metadata = self._metadata
+        if metadata is None:
+            metadata = self._load_metadata()
+        if field in metadata or field in self._generated_columns:
+            return quote_identifier(field)
+        path = self._json_path(field, metadata)
+        if path is None:
+            # Let SQLite complain about it
+            return quote_identifier(field)
+        return _json_extract_sql(*path)
+
+    def _invalidate_metadata(self):
+        """Forget everything derived from the table schema."""
+        self._metadata = None
+        self._rowtuple = None
+        self._row_decoders = dict()
+        self._field_adapters = dict()
+
     def _get_row_namedtuple(self):
         if self._rowtuple is not None:
             return self._rowtuple
 
-        if not self._cursor.description:
-            raise RuntimeError("Could not get row schema --empty cursor")
+        metadata = self._metadata
+        if metadata is None:
+            metadata = self._load_metadata()
+        if not metadata:
+            raise RuntimeError("Could not get row schema --no table %s" % self._table)
 
-        self._rowtuple = namedtuple(
-            "Row%s" % self._table, (s[0] for s in self._cursor.description)
-        )
+        self._rowtuple = namedtuple("Row%s" % self._table, metadata.keys(), rename=True)
         return self._rowtuple
 
+    @protect_method_mt
+    def get_schema(self):
+        """Get the DataSchema of the table as it is in the database."""
+        return DataSchema({"fields": list(self._load_metadata().items())})
+
+    def _get_row_decoder(self, fields=None):
+        """Get the (cached) RowDecoder for fields, or for whole rows if None."""
+        try:
+            return self._row_decoders[fields]
+        except KeyError:
+            pass
+        with self.lock:
+            return self._build_row_decoder(fields)
+
+    def _build_row_decoder(self, fields):
+        metadata = self._metadata
+        if metadata is None or (fields is not None and
+                                any(f not in metadata for f in fields)):
+            # Somebody may have added columns meanwhile
+            metadata = self._load_metadata()
+
+        if fields is None:
+            rowtuple = self._get_row_namedtuple()
+            columns = tuple(metadata.keys())
+        else:
+            rowtuple = namedtuple("Row%s" % self._table, fields, rename=True)
+            columns = fields
+
+        decoder = transformers.RowDecoder(
+            rowtuple, [metadata.get(f) for f in columns], NULL_FIELD,
+            self._resolve_blob, columns, self._writable_arrays,
+        )
+        self._row_decoders[fields] = decoder
+        return decoder
+
+    @staticmethod
+    def _predicate(field, op, value, field_sql=quote_identifier):
+        """SQL condition and parameters of a (field, operator, value) predicate."""
+        op = op.lower()
+        if op not in QUERY_OPERATORS:
+            raise ValueError("Unknown operator %r" % op)
+        column = field_sql(field)
+
+        if value is None or value is NULL_FIELD:
+            if op in ("=", "==", "is"):
+                return "%s IS NULL" % column, []
+            if op in ("!=", "<>", "is not"):
+                return "%s IS NOT NULL" % column, []
+            raise ValueError("NULL can only be compared with = or !=")
+
+        if op in ("in", "not in"):
+            values = list(value)
+            if not values:
+                # Nothing is in an empty list
+                return ("0" if op == "in" else "1"), []
+            return ("%s %s (%s)" % (column, op.upper(), ", ".join("?" * len(values))),
+                    values)
+
+        if op == "between":
+            low, high = value
+            return "%s BETWEEN ? AND ?" % column, [low, high]
+
+        if op == "==":
+            op = "="
+        return "%s %s ?" % (column, op.upper()), [value]
+
+    @staticmethod
+    def _where_clause(where, params=None, field_sql=quote_identifier):
+        """Build a WHERE clause and its parameters.
+
+        :param where: One of:
+          - None, for no filter.
+          - A SQL expression string, with ? placeholders filled from params.
+          - A mapping of field names to the values they must be equal to, or
+            to (operator, value) tuples, e.g. {"lr": ("<", 0.1)}.
+          - A list of (field, operator, value) predicates.
+        Predicates are ANDed. The operators are those of QUERY_OPERATORS;
+        "in" takes a list, "between" a (low, high) pair, and None compared
+        with = or != is IS NULL or IS NOT NULL.
+        :param params: Parameters for a SQL string where.
+        :param field_sql: Function that gives the SQL expression of a field.
+        """
+        if where is None:
+            return "", list()
+
+        if isinstance(where, str):
+            return " WHERE " + where, list(params or ())
+
+        if isinstance(where, Mapping):
+            predicates = [
+                (field, value[0], value[1]) if _is_operator_tuple(value)
+                else (field, "=", value)
+                for field, value in where.items()
+            ]
+        else:
+            predicates = where
+
+        conditions = list()
+        params = list()
+        for field, op, value in predicates:
+            condition, condition_params = DataStorage._predicate(field, op, value,
+                                                                 field_sql)
+            conditions.append(condition)
+            params.extend(condition_params)
+        if not conditions:
+            return "", list()
+        return " WHERE " + " AND ".join(conditions), params
+
+    @staticmethod
+    def _order_clause(order_by=None, limit=None, offset=None,
+                      field_sql=quote_identifier):
+        """Build the ORDER BY and LIMIT clauses and their parameters.
+
+        :param order_by: Field name or list of them, descending if prefixed
+        with "-".
+        :param field_sql: Function that gives the SQL expression of a field.
+        """
+        clause = ""
+        params = list()
+        if order_by:
+            if isinstance(order_by, str):
+                order_by = [order_by]
+            terms = list()
+            for field in order_by:
+                if field.startswith("-"):
+                    terms.append("%s DESC" % field_sql(field[1:]))
+                else:
+                    terms.append(field_sql(field))
+            clause += " ORDER BY " + ", ".join(terms)
+
+        if limit is not None or offset:
+            # SQLite needs a LIMIT (negative: none) to have an OFFSET
+            clause += " LIMIT ?"
+            params.append(-1 if limit is None else int(limit))
+            if offset:
+                clause += " OFFSET ?"
+                params.append(int(offset))
+        return clause, params
+
+    @contextmanager
+    def _read_cursor(self, flush=True):
+        """Cursor for a read, after flushing the pending writes.
+
+        In pooled mode, a cursor of a reading connection of the pool;
+        otherwise the main cursor, with the lock held.
+
+        :param flush: Whether the read may see pending writes (see
+        `_has_pending`); otherwise they are left for a group commit.
+        """
+        if self._pool is None:
+            with self.lock:
+                if flush and self._pending:
+                    self.flush()
+                yield self._cursor
+            return
+
+        if flush and self._pending:
+            self.flush()
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def _select(self, cursor, fields, where, params, order_by, limit, offset):
+        """Execute a SELECT on the table, return the RowDecoder of its rows."""
+        where_str, where_params = self._where_clause(where, params, self._field_sql)
+        order_str, order_params = self._order_clause(order_by, limit, offset,
+                                                     self._field_sql)
+        decoder = self._get_row_decoder(fields)
+        select_list = ", ".join(self._field_sql(field) for field in decoder.fields)
+        cursor.execute("SELECT %s FROM %s%s%s"
+                       % (select_list, self._table_sql, where_str, order_str),
+                       where_params + order_params)
+        return decoder
+
+    def _select_chunks(self, fields, where, params, order_by, limit, offset,
+                       chunk_size):
+        """Generator of the RowDecoder of a SELECT, then chunks of its raw rows.
+
+        Rows are fetched as they are asked for, holding the lock (or, in
+        pooled mode, a connection of the pool) only while fetching.
+        """
+        if self._pool is None:
+            with self.lock:
+                self.flush()
+                cursor = self._conn.cursor()
+                decoder = self._select(cursor, fields, where, params,
+                                       order_by, limit, offset)
+            fetch, conn = self._fetch_chunk, None
+        else:
+            if self._pending:
+                self.flush()
+            conn = self._pool.acquire()
+            try:
+                cursor = conn.cursor()
+                decoder = self._select(cursor, fields, where, params,
+                                       order_by, limit, offset)
+            except BaseException:
+                self._pool.release(conn)
+                raise
+            fetch = _fetch_chunk
+
+        try:
+            yield decoder
+            while True:
+                rows = fetch(cursor, chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+            if conn is not None:
+                self._pool.release(conn)
+
+    @staticmethod
+    def _select_list(fields):
+        return ", ".join(quote_identifier(field) for field in fields)
+
+    @protect_method_mt
+    def _fetch_chunk(self, cursor, chunk_size):
+        return cursor.fetchmany(chunk_size)
+
+    def iter_rows(self, fields=None, where=None, params=None, chunk_size=None,
+                  order_by=None, limit=None, offset=None):
+        """Iterate over the (decoded) rows of the table.
+
+        All the rows come from a single query and are fetched in chunks, so
+        the memory used does not depend on the size of the table.
+
+        :param fields: Field names to retrieve. Default: all of them.
+        :param where: Filter, see `_where_clause` for the accepted forms.
+        :param params: Parameters for a SQL string where.
+        :param chunk_size: Rows fetched at once, defaults to ITER_CHUNK_SIZE.
+        :param order_by: Field name or list of them to sort by, descending
+        if prefixed with "-".
+        :param limit: Maximum number of rows.
+        :param offset: Rows to skip (after sorting).
+        :return: A generator of namedtuples, with NULL_FIELD for NULL values.
+        """
+        if chunk_size is None:
+            chunk_size = DataStorage.ITER_CHUNK_SIZE
+
+        if fields is not None:
+            fields = tuple(fields)
+
+        chunks = self._select_chunks(fields, where, params, order_by, limit,
+                                     offset, chunk_size)
+        try:
+            decoder = next(chunks)
+            for rows in chunks:
+                for row in rows:
+                    yield decoder(row)
+        finally:
+            chunks.close()
+
+    def query(self, fields=None, where=None, params=None, order_by=None,
+              limit=None, offset=None):
+        """Get the (decoded) rows that match a filter.
+
+        Filtering, sorting and limiting are done by SQLite, so only the
+        rows asked for are decoded. See `iter_rows` for the parameters.
+
+        :return: A list of namedtuples, with NULL_FIELD for NULL values.
+        """
+        return list(self.iter_rows(fields, where, params, order_by=order_by,
+                                   limit=limit, offset=offset))
+
+    def aggregate(self, group_by=None, metrics=None, where=None, params=None,
+                  order_by=None, limit=None, dataframe=False):
+        """Summarize the table by groups, with the aggregation done by SQLite.
+
+        Only the summary rows come back; no row of the table is decoded.
+
+        :param group_by: Field or list of fields to group by. Default: the
+        whole table is a single group.
+        :param metrics: Mapping of fields to an aggregate function, or a list
+        of them, from AGGREGATES (count, sum, mean, min, max, var, std).
+        Fields (here and in group_by) can be paths inside json fields, like
+        `config.optimizer`.
+        :param where: Filter of the rows, same as in `iter_rows`.
+        :param params: Parameters for a SQL string where.
+        :param order_by: Result columns to sort by, descending if prefixed
+        with "-". Default: the group_by fields.
+        :param limit: Maximum number of groups.
+        :param dataframe: Return a pandas DataFrame instead of a list.
+        :return: A list of namedtuples with the group_by fields, a
+        `<field>_<function>` column per metric and the `count` of rows (with
+        "_" in place of the characters that are not valid in identifiers).
+        """
+        if isinstance(group_by, str):
+            group_by = [group_by]
+        group_by = list(group_by or ())
+
+        columns = list()
+        expressions = list()
+        finishers = list()
+        for field in group_by:
+            columns.append(field)
+            expressions.append(self._field_sql(field))
+            finishers.append(None)
+        for field, functions in (metrics or {}).items():
+            if isinstance(functions, str):
+                functions = [functions]
+            column_sql = self._field_sql(field)
+            for function in functions:
+                try:
+                    aggregate_sql, finish = AGGREGATES[function]
+                except KeyError:
+                    raise ValueError("Unknown aggregate function %r" % function)
+                columns.append("%s_%s" % (field, function))
+                expressions.append(aggregate_sql.format(column_sql))
+                finishers.append(finish)
+        columns.append("count")
+        expressions.append("count(*)")
+        finishers.append(None)
+
+        where_str, where_params = self._where_clause(where, params, self._field_sql)
+        if order_by is None:
+            order_by = group_by
+        # The result columns are aliased, so they can be sorted by name
+        order_str, order_params = self._order_clause(order_by, limit)
+        group_str = ""
+        if group_by:
+            group_str = " GROUP BY " + ", ".join(
+                str(i + 1) for i in range(len(group_by)))
+
+        with self._read_cursor() as cursor:
+            cursor.execute(
+                "SELECT %s FROM %s%s%s%s" % (
+                    ", ".join("%s AS %s" % (expression, quote_identifier(column))
+                              for expression, column in zip(expressions, columns)),
+                    self._table_sql, where_str, group_str, order_str),
+                where_params + order_params)
+            rows = cursor.fetchall()
+
+        if any(finishers):
+            rows = [tuple(value if finish is None else finish(value)
+                          for value, finish in zip(row, finishers))
+                    for row in rows]
+
+        if dataframe:
+            import pandas as pd
+            return pd.DataFrame.from_records(rows, columns=columns)
+
+        # e.g. config.lr_mean -> config_lr_mean (still renamed if invalid)
+        rowtuple = namedtuple("Summary%s" % self._table,
+                              [_identifier(column) for column in columns],
+                              rename=True)
+        return [rowtuple._make(row) for row in rows]
+
     @protect_method_mt
     def close(self):
+        # Everything will be flushed below, no need for more flush timers
+        self._closing = True
         for h in self._child_handlers:
             h.close()
 
-        if self._conn:
-            self._conn.commit()
-            self._conn.close()
-            self._conn = None
+        if self._forked and self._pending:
+            # Only written to (in write-behind mode) in this forked process
+            self._reconnect()
+        if self._forked:
+            # Never used in this (forked) process, nothing to commit
+            self._forked = False
+        elif self._connection:
+            try:
+                self.flush()
+            finally:
+                self._connection.commit()
+                self._connection.close()
+                self._connection = self._main_cursor = None
+        if self._pool is not None:
+            self._pool.close()
 
     def __del__(self):
+        if not hasattr(self, "_child_handlers"):
+            # __init__ failed before the end (where it is set), and close()
+            # cannot work on a half-built instance
+            return
         self.close()
 
+    def _check_fields(self, fields):
+        """Raise the error that SQLite would for fields the table lacks.
+
+        Buffered writes only reach SQLite later, so this lets the caller (and
+        not some later flush) know about the mistake.
+        """
+        metadata = self._metadata
+        if metadata is None or any(field not in metadata for field in fields):
+            # Maybe added since, e.g. by `tad4bj update` in another process
+            self._invalidate_metadata()
+            metadata = self._load_metadata()
+        if not metadata:
+            raise sqlite3.OperationalError("no such table: %s" % self._table)
+        for field in fields:
+            if field not in metadata:
+                raise sqlite3.OperationalError(
+                    "table %s has no column named %s" % (self._table, field))
+
+    def _buffer_write(self, jobid, fields, values):
+        self._check_fields(fields)
+        row = self._pending.setdefault(jobid, dict())
+        for field, value in zip(fields, values):
+            if field not in row:
+                self._pending_count += 1
+            row[field] = value
+
+        if self._pending_count >= self._flush_size:
+            self.flush()
+        elif self._flush_timer is None and not self._closing:
+            self._flush_timer = Timer(self._flush_interval, self._timed_flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _timed_flush(self):
+        with self.lock:
+            self._flush_timer = None
+            if self._connection is None and not self._forked:
+                # Closed
+                return
+            try:
+                self.flush()
+            except Exception:
+                # Nobody to raise it to: writes that failed for a lock are
+                # back in the buffer (try again later), bad ones are dropped
+                if self._pending and self._flush_timer is None:
+                    self._flush_timer = Timer(self._flush_interval,
+                                              self._timed_flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+
     @protect_method_mt
-    def to_dataframe(self):
+    def flush(self):
+        """Commit all the writes buffered by write-behind mode.
+
+        The pending writes are committed in a single transaction. If the
+        database is locked, they are put back in the buffer and the exception
+        is raised. On any other error the rows are written one by one, the
+        ones that fail are dropped (see stats["write_dropped"]) and the
+        first error is raised.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        if not self._pending:
+            return
+
+        rows = [(jobid, list(row.keys()), list(row.values()))
+                for jobid, row in self._pending.items()]
+        self._pending = OrderedDict()
+        self._pending_count = 0
+        try:
+            self._run_with_retry(self._commit_rows, rows)
+        except Exception as e:
+            if _is_lock_error(e):
+                self._requeue(rows)
+                raise
+        else:
+            return
+
+        # Some row cannot be written (e.g. an unknown field): write the rest
+        # one by one, so that a bad row does not block the whole buffer
+        error = None
+        for position, row in enumerate(rows):
+            try:
+                self._run_with_retry(self._commit_rows, [row])
+            except Exception as e:
+                if _is_lock_error(e):
+                    self._requeue(rows[position:])
+                    raise
+                self.stats["write_dropped"] += len(row[1])
+                error = error or e
+        if error is not None:
+            raise error
+
+    def _requeue(self, rows):
+        """Put rows that could not be written back in the write-behind buffer.
+
+        Newer writes (if any) take precedence over them.
+        """
+        pending = OrderedDict()
+        for jobid, fields, values in rows:
+            pending.setdefault(jobid, dict()).update(zip(fields, values))
+        for jobid, row in self._pending.items():
+            pending.setdefault(jobid, dict()).update(row)
+        self._pending = pending
+        self._pending_count = sum(len(row) for row in pending.values())
+
+    def to_dataframe(self, fields=None, where=None, params=None,
+                     chunksize=None, decode=True, order_by=None, limit=None,
+                     offset=None):
+        """Read the table into a pandas DataFrame.
+
+        Rows are fetched in chunks, so the raw values of a chunk can be freed
+        as soon as it has been converted. The columns get a pandas dtype
+        according to their declared type: nullable Int64 for integers,
+        float64 for reals, datetime64 for timestamps and dates, and objects
+        for the rest.
+
+        :param fields: Field names to retrieve. Default: all of them.
+        :param where: Filter, same as in `iter_rows`.
+        :param params: Parameters for a SQL string where.
+        :param chunksize: If given, return an iterator of DataFrames of (at
+        most) chunksize rows instead of a single DataFrame.
+        :param decode: Decode json, yaml and pickle columns into Python
+        objects (otherwise they are left as stored).
+        :param order_by: Sorting, same as in `iter_rows`.
+        :param limit: Maximum number of rows.
+        :param offset: Rows to skip (after sorting).
+        """
         import pandas as pd
 
-        df = pd.read_sql_query("SELECT * FROM `%s`" % self._table, self._conn)
+        chunks = self._iter_dataframes(pd, fields, where, params,
+                                       chunksize or DataStorage.ITER_CHUNK_SIZE,
+                                       decode, order_by, limit, offset)
+        if chunksize:
+            return chunks
+
+        frames = list(chunks)
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
 
-        return df
+    def _iter_dataframes(self, pd, fields, where, params, chunksize, decode,
+                         order_by=None, limit=None, offset=None):
+        if fields is not None:
+            fields = tuple(fields)
+
+        chunks = self._select_chunks(fields, where, params, order_by, limit,
+                                     offset, chunksize)
+        try:
+            fields = next(chunks).fields
+            metadata = self._metadata or self._load_metadata()
+            decltypes = [metadata.get(field) for field in fields]
+
+            empty = True
+            for rows in chunks:
+                empty = False
+                yield self._chunk_dataframe(pd, fields, decltypes, rows, decode)
+            if empty:
+                yield self._chunk_dataframe(pd, fields, decltypes, [], decode)
+        finally:
+            chunks.close()
+
+    def _chunk_dataframe(self, pd, fields, decltypes, rows, decode):
+        columns = list(zip(*rows)) or [()] * len(fields)
+        return pd.DataFrame({
+            field: _dataframe_column(pd, decltype, values, decode,
+                                     self._resolve_blob, self._writable_arrays)
+            for field, decltype, values in zip(fields, decltypes, columns)
+        }, columns=list(fields))
 
     @protect_method_mt
     def clear(self, remove_tables=False):
+        self.flush()
         if remove_tables:
             # Drop them if they exist
-            self._cursor.execute("DROP TABLE IF EXISTS `%s_tamd`" % self._table)
-            self._cursor.execute("DROP TABLE IF EXISTS `%s`" % self._table)
+            self._cursor.execute("DROP TABLE IF EXISTS %s"
+                                 % quote_identifier("%s_tamd" % self._table))
+            self._cursor.execute("DROP TABLE IF EXISTS %s" % self._series_sql)
+            self._cursor.execute("DROP TABLE IF EXISTS %s" % self._table_sql)
+            self._series_ready = False
         else:
             # Application should fail if the table does not exist, as this does:
-            self._cursor.execute("DELETE FROM `%s`" % self._table)
+            self.execute_with_retry("DELETE FROM %s" % self._table_sql)
+            if self._series_table_exists():
+                self.execute_with_retry("DELETE FROM %s" % self._series_sql)
         self._conn.commit()
 
+    @staticmethod
+    def _column_definitions(fields):
+        """Column definitions for a table, with `id` as INTEGER PRIMARY KEY."""
+        definitions = ["`id` INTEGER PRIMARY KEY"]
+        for field_name, field_type in fields:
+            if field_name == "id":
+                continue
+            definitions.append("%s %s" % (quote_identifier(field_name),
+                                          _column_type(field_type)))
+        return ", ".join(definitions)
+
     @protect_method_mt
     def prepare(self, schema):
-        creation_fields = ", ".join(
-            "'%s' %s" % (field_name, field_type)
-            for field_name, field_type in schema.fields
-        )
-        self._cursor.execute("CREATE TABLE `%s` (%s)" % (self._table, creation_fields))
-        self._metadata = dict(schema.fields)
+        creation_fields = self._column_definitions(schema.fields)
+        self._cursor.execute("CREATE TABLE %s (%s)" % (self._table_sql, creation_fields))
+        self._invalidate_metadata()
+        self._upsert = True
+        if schema.indexes:
+            self._sync_indexes(schema.indexes)
         self._conn.commit()
 
+    @staticmethod
+    def _json_path(field, metadata):
+        """Split a `column.path` field into (column, JSON path).
+
+        None if field is not a path inside a json column.
+        """
+        if field in metadata:
+            return None
+        column, dot, path = field.partition(".")
+        if not dot or column not in metadata:
+            return None
+        if transformers.base_decltype(metadata[column]) != "json":
+            raise ValueError("Cannot index %s, only paths inside (uncompressed) "
+                             "json fields can be indexed" % field)
+        return column, "$." + path
+
+    def _sync_indexes(self, indexes):
+        """Create and drop indexes (and JSON path columns) to match the specs.
+
+        Indexes are named `<table>__<name>`; those of the table with that
+        prefix that are not in the specs (or are defined differently) are
+        dropped. Paths inside json fields get a virtual generated column
+        named as the path, so they can also be used in filters.
+
+        Must be called with the lock held.
+        """
+        metadata = self._load_metadata()
+        wanted = OrderedDict()
+        paths = OrderedDict()
+        for spec in indexes:
+            if isinstance(spec, str):
+                spec = {"fields": [spec]}
+            elif not isinstance(spec, Mapping):
+                spec = {"fields": list(spec)}
+            fields = spec["fields"]
+            if isinstance(fields, str):
+                fields = [fields]
+            for field in fields:
+                path = self._json_path(field, metadata)
+                if path is not None:
+                    paths[field] = path
+                elif field not in metadata:
+                    raise ValueError("Cannot index %s, there is no such field" % field)
+            name = "%s__%s" % (self._table, spec.get("name") or "_".join(fields))
+            wanted[name] = "CREATE %sINDEX %s ON %s (%s)" % (
+                "UNIQUE " if spec.get("unique") else "", quote_identifier(name),
+                self._table_sql, self._select_list(fields))
+
+        self._cursor.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = ? AND sql IS NOT NULL", (self._table,))
+        prefix = "%s__" % self._table
+        existing = {name: sql for name, sql in self._cursor.fetchall()
+                    if name.startswith(prefix)}
+        for name, sql in existing.items():
+            if wanted.get(name) != sql:
+                self._cursor.execute("DROP INDEX %s" % quote_identifier(name))
+
+        generated = set(self._generated_columns)
+        for field in generated:
+            if field not in paths and field.partition(".")[0] in metadata:
+                self._cursor.execute("ALTER TABLE %s DROP COLUMN %s"
+                                     % (self._table_sql, quote_identifier(field)))
+        for field, (column, path) in paths.items():
+            if field in generated:
+                continue
+            self._cursor.execute(
+                "ALTER TABLE %s ADD COLUMN %s GENERATED ALWAYS AS %s VIRTUAL"
+                % (self._table_sql, quote_identifier(field),
+                   _json_extract_sql(column, path)))
+
+        for name, sql in wanted.items():
+            if existing.get(name) != sql:
+                self._cursor.execute(sql)
+        self._invalidate_metadata()
+
+    @protect_method_mt
+    def migrate(self):
+        """Rebuild a table created by an older tad4bj with `id` as primary key.
+
+        If the old table has several rows with the same id (which could
+        happen when two writers raced to create the row), they are merged
+        into a single one, keeping the latest non-NULL value of each field.
+        Its indexes, and the JSON path columns of the indexes (see
+        `_sync_indexes`), are recreated on the new table.
+
+        :return: False if the table already had the primary key, True if it
+        has been rebuilt.
+        """
+        self.flush()
+        self._cursor.execute("PRAGMA table_info(%s)" % self._table_sql)
+        columns = [(name, col_type, pk)
+                   for _, name, col_type, _, _, pk in self._cursor.fetchall()]
+        if not columns:
+            raise ValueError("Table %s does not exist" % self._table)
+
+        if any(name == "id" and pk and col_type.upper() == "INTEGER"
+               for name, col_type, pk in columns):
+            return False
+
+        fields = [(name, col_type) for name, col_type, _ in columns]
+        old_fields = [name for name, _ in fields]
+        metadata = self._load_metadata()
+        paths = [(field, self._json_path(field, metadata))
+                 for field in sorted(self._generated_columns)]
+        self._cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = ? AND sql IS NOT NULL", (self._table,))
+        indexes = [sql for sql, in self._cursor.fetchall()]
+        new_table = quote_identifier("%s__migrate" % self._table)
+        fields_str = self._select_list(old_fields)
+        merge_str = ", ".join(
+            "{0} = coalesce(excluded.{0}, {0})".format(quote_identifier(name))
+            for name in old_fields if name != "id"
+        )
+
+        def rebuild():
+            self._cursor.execute("BEGIN IMMEDIATE")
+            try:
+                self._cursor.execute("DROP TABLE IF EXISTS %s" % new_table)
+                self._cursor.execute("CREATE TABLE %s (%s)" % (
+                    new_table, self._column_definitions(fields)))
+                if "id" not in old_fields:
+                    self._cursor.execute(
+                        "INSERT INTO %s (%s) SELECT %s FROM %s"
+                        % (new_table, fields_str, fields_str, self._table_sql))
+                else:
+                    self._cursor.execute(
+                        # Rows without id go last, so they get fresh ids
+                        "INSERT INTO %s (%s) SELECT %s FROM %s WHERE true "
+                        "ORDER BY id IS NULL, rowid ON CONFLICT(id) DO %s"
+                        % (new_table, fields_str, fields_str, self._table_sql,
+                           "UPDATE SET %s" % merge_str if merge_str else "NOTHING"))
+                self._cursor.execute("DROP TABLE %s" % self._table_sql)
+                self._cursor.execute("ALTER TABLE %s RENAME TO %s"
+                                     % (new_table, self._table_sql))
+                for field, path in paths:
+                    if path is not None:
+                        self._cursor.execute(
+                            "ALTER TABLE %s ADD COLUMN %s GENERATED ALWAYS AS %s "
+                            "VIRTUAL" % (self._table_sql, quote_identifier(field),
+                                         _json_extract_sql(*path)))
+                # Dropped with the old table, the new one has the same name
+                for sql in indexes:
+                    self._cursor.execute(sql)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+        self._run_with_retry(rebuild)
+        self._invalidate_metadata()
+        self._upsert = True
+        return True
+
     @protect_method_mt
     def update(self, schema):
-        self._cursor.execute("SELECT * FROM `%s`" % self._table)
+        """Add the new fields of schema to the table, and sync its indexes.
+
+        Indexes are only touched if the schema declares them (even as an
+        empty list, which drops them all).
+        """
+        self._cursor.execute("SELECT * FROM %s" % self._table_sql)
         old_fields = {f[0] for f in self._cursor.description}
         all_fields = {f for f, _ in schema.fields}
         new_fields = all_fields - old_fields
 
-        if not new_fields:
-            return
-
         # Add all new columns
         for field_name, field_type in schema.fields:
             if field_name not in new_fields:
                 continue
             self._cursor.execute(
-                "ALTER TABLE `%s` ADD COLUMN '%s' %s"
-                % (self._table, field_name, field_type)
+                "ALTER TABLE %s ADD COLUMN %s %s"
+                % (self._table_sql, quote_identifier(field_name),
+                   _column_type(field_type))
             )
 
-        self._metadata = dict(schema.fields)
+        if schema.indexes is not None:
+            self._sync_indexes(schema.indexes)
+        self._invalidate_metadata()
         self._conn.commit()
 
     @protect_method_mt
@@ -188,158 +1393,459 @@ class DataStorage(Mapping):
             return self._field_adapters[field_name]
         except KeyError:
             pass
-        if self._metadata is None:
-            self._cursor.execute('PRAGMA table_info("%s")' % (self._table,))
-            result = self._cursor.fetchall()
-            self._metadata = {
-                column_name: column_type
-                for _, column_name, column_type, _, _, _ in result
-            }
+        metadata = self._metadata
+        if metadata is None:
+            metadata = self._load_metadata()
 
-        field_type = self._metadata.get(field_name)
-
-        try:
-            tf = transformers.DECLTYPE_ADAPTERS[field_type]
-        except KeyError:
+        tf = transformers.get_adapter(metadata.get(field_name))
+        if tf is None:
             # Fallback is don't transform it at DataStorage level
             # (adapter machinery may be in place, e.g. the timestamp things)
             tf = transformers.identity_adapter
+        elif self._blob_threshold:
+            tf = self._blob_adapter(tf)
 
         self._field_adapters[field_name] = tf
         return tf
 
-    @protect_method_mt
+    def _get_blob_store(self):
+        if self._blob_store is None:
+            from .blobs import BlobStore
+            self._blob_store = BlobStore.for_database(self._path)
+        return self._blob_store
+
+    def _resolve_blob(self, ref):
+        return self._get_blob_store().get(ref)
+
+    def _blob_adapter(self, adapter):
+        """Wrap an adapter so that big values go to the blob store."""
+        threshold = self._blob_threshold
+
+        def adapt(obj):
+            value = adapter(obj)
+            if len(value) >= threshold:
+                return self._get_blob_store().put(value)
+            return value
+        return adapt
+
+    def _has_pending(self, jobid, fields=None):
+        """Whether some of fields (default: all) of a job have pending writes.
+
+        Reads of a single job only flush in that case, so that jobs reading
+        their configuration do not commit the writes of everyone else.
+        """
+        row = self._pending.get(jobid)
+        if not row:
+            return False
+        # Paths inside a json field are columns generated from it
+        return fields is None or any(
+            field in row or field.partition(".")[0] in row for field in fields)
+
     def get_value(self, jobid, field, raw_return=False):
-        if raw_return:
-            suffix = ' as "[text]"'
-        else:
-            suffix = ""
-        self._cursor.execute(
-            "SELECT `%s`%s FROM `%s` WHERE id=?" % (field, suffix, self._table),
-            (jobid,),
-        )
-        record = self._cursor.fetchone()
+        with self._read_cursor(self._has_pending(jobid, (field,))) as cursor:
+            cursor.execute(
+                "SELECT %s FROM %s WHERE id=?" % (quote_identifier(field),
+                                                  self._table_sql),
+                (jobid,),
+            )
+            record = cursor.fetchone()
         if record is None:
             # The record does not exist, default to NULL
             return NULL_FIELD
         value = record[0]
         if value is None:
             return NULL_FIELD
-        else:
+        elif raw_return:
             return value
+        else:
+            return self._get_row_decoder((field,)).decode_values(record)[0]
+
+    def get_values(self, jobid, fields=None, raw_return=False):
+        """Get several fields of a row with a single query.
+
+        :param fields: Field names to retrieve. Default: the whole row.
+        :return: Dictionary of field names to values, with NULL_FIELD for
+        NULL values (and for all of them if the row does not exist).
+        """
+        if fields is not None:
+            fields = tuple(fields)
+            if not fields:
+                return dict()
+
+        decoder = self._get_row_decoder(fields)
+        with self._read_cursor(self._has_pending(jobid, fields)) as cursor:
+            cursor.execute(
+                "SELECT %s FROM %s WHERE id=?"
+                % (self._select_list(decoder.fields), self._table_sql), (jobid,)
+            )
+            record = cursor.fetchone()
+        if record is None:
+            return dict.fromkeys(decoder.fields, NULL_FIELD)
+        elif raw_return:
+            return {field: NULL_FIELD if value is None else value
+                    for field, value in zip(decoder.fields, record)}
+        else:
+            return dict(zip(decoder.fields, decoder.decode_values(record)))
+
+    def _run_with_retry(self, func, *args, max_retries=None):
+        """Call func, retrying with jittered exponential backoff while locked.
+
+        func must be safe to call again after a failure (e.g. a whole
+        transaction that rolls back on errors).
 
-    def execute_with_retry(self, sql, params=None, max_retries=5):
+        :param max_retries: Override of the max_retries of the profile.
+        """
+        profile = self._profile
+        if max_retries is None:
+            max_retries = profile.max_retries
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                if not _is_lock_error(e):
+                    raise
+                if attempt >= max_retries:
+                    self.stats["write_failures"] += 1
+                    raise
+                delay = profile.backoff_delay(attempt)
+                self.stats["write_retries"] += 1
+                self.stats["write_wait"] += delay
+                sleep(delay)
+                attempt += 1
+
+    def execute_with_retry(self, sql, params=None, max_retries=None):
         """Execute a SQL statement with retries.
 
         :param sql: SQL statement to execute.
         :param params: Parameters for the SQL statement.
-        :param max_retries: Maximum number of retries.
+        :param max_retries: Maximum number of retries. Default: those of the
+        concurrency profile.
         :return: Result of the SQL statement.
         """
-        for i in range(max_retries):
+        return self._run_with_retry(self._cursor.execute, sql, params or (),
+                                    max_retries=max_retries)
+
+    def _upsert_statement(self, fields):
+        fields_str = self._select_list(fields)
+        question_marks = ", ".join(["?"] * (len(fields) + 1))
+        update_str = ", ".join(
+            "{0} = excluded.{0}".format(quote_identifier(field_name))
+            for field_name in fields
+        )
+        return ("INSERT INTO %s (%s, id) VALUES (%s) "
+                "ON CONFLICT(id) DO UPDATE SET %s"
+                % (self._table_sql, fields_str, question_marks, update_str))
+
+    def _write_rows(self, rows):
+        """Write a list of (jobid, fields, values) rows, without committing.
+
+        Values must be already adapted. Consecutive rows with the same fields
+        are written with a single executemany.
+        """
+        if self._upsert:
             try:
-                return self._cursor.execute(sql, params)
+                for fields, group in groupby(rows, key=lambda row: tuple(row[1])):
+                    self._cursor.executemany(
+                        self._upsert_statement(fields),
+                        (list(values) + [jobid] for jobid, _, values in group),
+                    )
+                return
             except sqlite3.OperationalError as e:
-                if i == max_retries - 1:
-                    raise e
-                else:
-                    sleep(1 + random() * 2)
+                # This can only fail before writing anything (when preparing
+                # the first statement), so it is safe to write all of them
+                if "ON CONFLICT clause does not match" not in str(e):
+                    raise
+                # Table from an older tad4bj, `tad4bj migrate` will fix that
+                self._upsert = False
+
+        for jobid, fields, values in rows:
+            self._write_row_legacy(jobid, fields, values)
+
+    def _write_row_legacy(self, jobid, fields, values):
+        set_str = ", ".join("%s = ?" % quote_identifier(field_name)
+                            for field_name in fields)
+
+        ex = self._cursor.execute(
+            "UPDATE %s SET %s WHERE id = ?" % (self._table_sql, set_str),
+            list(values) + [jobid],
+        )
+        if ex.rowcount == 0:
+            fields_str = self._select_list(fields)
+            question_marks = ", ".join(["?"] * (len(fields) + 1))
+            self._cursor.execute(
+                "INSERT INTO %s (%s, id) VALUES (%s)"
+                % (self._table_sql, fields_str, question_marks),
+                list(values) + [jobid],
+            )
+
+    def _commit_rows(self, rows):
+        """Write a list of (jobid, fields, values) in a single transaction."""
+        start = time()
+        try:
+            self._write_rows(rows)
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        finally:
+            self.stats["write_time"] += time() - start
+        self.stats["write_transactions"] += 1
+
+    def _store_row(self, jobid, fields, values):
+        if self._write_behind:
+            self._buffer_write(jobid, fields, values)
+        else:
+            self._run_with_retry(self._commit_rows, [(jobid, fields, values)])
 
     @protect_method_mt
     def set_value(self, jobid, field, parameter, raw_parameter=False):
-        if field is NULL_FIELD:
+        if parameter is NULL_FIELD:
             value = None
         elif raw_parameter:
             value = parameter
         else:
             value = self._get_field_adapter(field)(parameter)
 
-        ex = self.execute_with_retry(
-            "UPDATE `%s` SET `%s` = ? WHERE id = ?" % (self._table, field),
-            (value, jobid),
-        )
-        if ex.rowcount == 0:
-            self._cursor.execute(
-                "INSERT INTO `%s` (id, `%s`) VALUES (?, ?)" % (self._table, field),
-                (jobid, value),
-            )
-        self._conn.commit()
+        self._store_row(jobid, (field,), (value,))
 
     @protect_method_mt
     def set_values(self, jobid, fields, parameters, raw_parameters=False):
-        set_str = ", ".join("`%s` = ?" % field_name for field_name in fields)
+        fields = list(fields)
 
         if raw_parameters:
             values = list(
                 param if param is not NULL_FIELD else None for param in parameters
             )
         else:
-            values = list()
+            values = self._adapt_values(fields, parameters)
 
-            for field, parameter in zip(fields, parameters):
-                if parameter is NULL_FIELD:
-                    values.append(None)
-                else:
-                    values.append(self._get_field_adapter(field)(parameter))
+        self._store_row(jobid, fields, values)
 
-        values.append(jobid)
+    def _adapt_values(self, fields, parameters):
+        values = list()
+        for field, parameter in zip(fields, parameters):
+            if parameter is NULL_FIELD:
+                values.append(None)
+            else:
+                values.append(self._get_field_adapter(field)(parameter))
+        return values
 
-        ex = self.execute_with_retry(
-            "UPDATE `%s` SET %s WHERE id = ?" % (self._table, set_str), values
-        )
-        if ex.rowcount == 0:
-            fields_str = ", ".join("`%s`" % field_name for field_name in fields)
-            question_marks = ", ".join(["?"] * (len(fields) + 1))
-            self.execute_with_retry(
-                "INSERT INTO `%s` (`%s`, id) VALUES (%s)"
-                % (self._table, fields_str, question_marks),
-                values,
+    def set_many(self, rows, raw_parameters=False, chunk_size=None):
+        """Write a lot of rows efficiently.
+
+        The rows are written in transactions of chunk_size rows each, so an
+        error halfway leaves the previous chunks committed.
+
+        :param rows: Iterable of (jobid, mapping) pairs, where mapping goes
+        from field names to values. It is consumed lazily.
+        :param raw_parameters: Same meaning as in `set_values`.
+        :param chunk_size: Rows per transaction, defaults to BULK_CHUNK_SIZE.
+        :return: The number of rows written.
+        """
+        if chunk_size is None:
+            chunk_size = DataStorage.BULK_CHUNK_SIZE
+
+        self.flush()
+        count = 0
+        chunk = list()
+        for jobid, mapping in rows:
+            chunk.append((jobid, list(mapping.keys()), list(mapping.values())))
+            if len(chunk) >= chunk_size:
+                count += self._commit_chunk(chunk, raw_parameters)
+                chunk = list()
+        if chunk:
+            count += self._commit_chunk(chunk, raw_parameters)
+        return count
+
+    @protect_method_mt
+    def _commit_chunk(self, chunk, raw_parameters):
+        if raw_parameters:
+            rows = [(jobid, fields,
+                     [None if value is NULL_FIELD else value for value in values])
+                    for jobid, fields, values in chunk]
+        else:
+            rows = [(jobid, fields, self._adapt_values(fields, values))
+                    for jobid, fields, values in chunk]
+        self._run_with_retry(self._commit_rows, rows)
+        return len(rows)
+
+    def _series_table_exists(self, cursor=None):
+        cursor = cursor or self._cursor
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                       "AND name=?", (self._series_table,))
+        return cursor.fetchone() is not None
+
+    def _commit_series(self, rows):
+        try:
+            if not self._series_ready:
+                # Series are stored by (series, id, step), so that reading
+                # a series of one or all the jobs is a range scan
+                self._cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS %s ("
+                    "id INTEGER NOT NULL, series TEXT NOT NULL, "
+                    "step INTEGER NOT NULL, value, "
+                    "PRIMARY KEY (series, id, step)) WITHOUT ROWID"
+                    % self._series_sql
+                )
+            self._cursor.executemany(
+                "INSERT OR REPLACE INTO %s (id, series, step, value) "
+                "VALUES (?, ?, ?, ?)" % self._series_sql, rows
             )
-        self._conn.commit()
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        self._series_ready = True
+        self.stats["write_transactions"] += 1
 
-    def get_handler(self, jobid):
-        h = handlers.JobHandler(self, jobid)
+    @protect_method_mt
+    def append_series(self, rows):
+        """Add points to the time series of the jobs, in a single transaction.
+
+        Series are kept in the `<table>_series` child table, one row per
+        point, so adding a point does not rewrite the previous ones.
+
+        :param rows: Iterable of (jobid, series name, step, value) tuples.
+        Values must be numbers, strings or None (NumPy scalars are
+        converted); a point with an existing step replaces it.
+        """
+        rows = [(jobid, series, step,
+                 value.item() if hasattr(value, "item") else value)
+                for jobid, series, step, value in rows]
+        if rows:
+            self._run_with_retry(self._commit_series, rows)
+        return len(rows)
+
+    def last_series_step(self, jobid, series):
+        """Get the last step of a series of a job, -1 if it has no points."""
+        # Points are never buffered, no need to flush
+        with self._read_cursor(False) as cursor:
+            if not self._series_ready and not self._series_table_exists(cursor):
+                return -1
+            cursor.execute(
+                "SELECT max(step) FROM %s WHERE series = ? AND id = ?"
+                % self._series_sql, (series, jobid)
+            )
+            step = cursor.fetchone()[0]
+        return -1 if step is None else step
+
+    def get_series(self, series, jobids=None):
+        """Get the points of a series of some jobs (default: all of them).
+
+        :param jobids: A job id or a list of them.
+        :return: List of (jobid, step, value), sorted by jobid and step.
+        """
+        # Points are never buffered, no need to flush
+        with self._read_cursor(False) as cursor:
+            if not self._series_ready and not self._series_table_exists(cursor):
+                return list()
+
+            sql = "SELECT id, step, value FROM %s WHERE series = ?" % self._series_sql
+            if jobids is None:
+                cursor.execute(sql + " ORDER BY id, step", (series,))
+                return cursor.fetchall()
+
+            if isinstance(jobids, int):
+                jobids = [jobids]
+            jobids = sorted(set(jobids))
+            points = list()
+            # Bounded number of parameters per query
+            for i in range(0, len(jobids), 500):
+                chunk = jobids[i:i + 500]
+                cursor.execute(
+                    sql + " AND id IN (%s) ORDER BY id, step"
+                    % ", ".join(["?"] * len(chunk)),
+                    [series] + chunk
+                )
+                points.extend(cursor.fetchall())
+        return points
+
+    def read_series(self, series, jobids=None, dataframe=False):
+        """Read a series of one or many jobs, as NumPy arrays or a DataFrame.
+
+        :param jobids: A job id, a list of them or None for all the jobs.
+        :param dataframe: Return a pandas DataFrame with id, step and value
+        columns instead of arrays.
+        :return: If jobids is a single id, a tuple of arrays (steps, values);
+        otherwise a dict of job id to such tuples.
+        """
+        points = self.get_series(series, jobids)
+
+        if dataframe:
+            import pandas as pd
+            columns = list(zip(*points)) or [(), (), ()]
+            return pd.DataFrame({
+                "id": pd.Series(columns[0], dtype="int64"),
+                "step": pd.Series(columns[1], dtype="int64"),
+                "value": pd.Series(columns[2], dtype=None if points else "float64"),
+            }, columns=["id", "step", "value"])
+
+        import numpy as np
+        arrays = dict()
+        for jobid, job_points in groupby(points, key=lambda point: point[0]):
+            _, steps, values = zip(*job_points)
+            arrays[jobid] = (np.array(steps, dtype=np.int64), np.array(values))
+        if isinstance(jobids, int):
+            return arrays.get(jobids, (np.empty(0, dtype=np.int64), np.empty(0)))
+        return arrays
+
+    def get_handler(self, jobid, prefetch=None):
+        """Get a JobHandler for jobid (see `handlers.JobHandler` for prefetch)."""
+        h = handlers.JobHandler(self, jobid, prefetch=prefetch)
         self._child_handlers.append(h)
         return h
 
-    @protect_method_mt
     def __iter__(self):
-        self._cursor.execute("SELECT `id` FROM `%s`" % (self._table,))
-        return (res[0] for res in self._cursor.fetchall())
+        return (row[0] for row in self.iter_rows(fields=("id",)))
 
-    @protect_method_mt
     def __contains__(self, item):
-        self._cursor.execute(
-            "SELECT COUNT(*) FROM `%s` WHERE id = ?" % (self._table,), (item,)
-        )
-        return self._cursor.fetchone()[0] == 1
+        with self._read_cursor(self._has_pending(item)) as cursor:
+            cursor.execute(
+                "SELECT 1 FROM %s WHERE id = ?" % self._table_sql, (item,)
+            )
+            return cursor.fetchone() is not None
 
-    @protect_method_mt
     def __getitem__(self, item):
-        self._cursor.execute(
-            "SELECT * FROM `%s` WHERE id = ?" % (self._table,), (item,)
-        )
-        row_raw = self._cursor.fetchone()
+        decoder = self._get_row_decoder()
+        with self._read_cursor(self._has_pending(item)) as cursor:
+            cursor.execute(
+                "SELECT %s FROM %s WHERE id = ?"
+                % (self._select_list(decoder.fields), self._table_sql), (item,)
+            )
+            row_raw = cursor.fetchone()
 
         if row_raw is None:
-            return KeyError("No row with id=%s" % item)
-
-        row_namedtuple = self._get_row_namedtuple()
-        processed_values = list()
-        for field, value in zip(row_namedtuple._fields, row_raw):
-            if value is not None:
-                processed_values.append(
-                    self._get_field_transformer(field).from_db(value)
-                )
-            else:
-                processed_values.append(NULL_FIELD)
+            raise KeyError("No row with id=%s" % item)
 
-        return row_namedtuple(*processed_values)
+        return decoder(row_raw)
 
-    @protect_method_mt
     def __len__(self):
-        self._cursor.execute("SELECT COUNT(*) FROM `%s`" % (self._table,))
-        return self._cursor.fetchone()[0]
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM %s" % self._table_sql)
+            return cursor.fetchone()[0]
+
+
+def get_data_storage(table_name, path=None):
+    """Build the storage that jobs should use, according to the environment.
+
+    If $TAD4BJ_SERVER is set, operations go through the `tad4bj serve`
+    daemon listening there (see `client.RemoteDataStorage`). Otherwise, if
+    $TAD4BJ_SPOOL is set, writes are appended to journals in that directory
+    until `tad4bj merge` (see `spool.SpoolDataStorage`). Otherwise, the
+    database file is used directly.
+    """
+    server = os.getenv("TAD4BJ_SERVER")
+    if server:
+        from .client import RemoteDataStorage
+        return RemoteDataStorage(table_name, server)
+
+    spool_dir = os.getenv("TAD4BJ_SPOOL")
+    if spool_dir:
+        from .spool import SpoolDataStorage
+        return SpoolDataStorage(table_name, spool_dir, path)
+
+    return DataStorage(table_name, path)
 
 
 class DummyDataStorage(object):
@@ -351,23 +1857,44 @@ class DummyDataStorage(object):
     def close(self):
         pass
 
+    def flush(self):
+        pass
+
     def clear(self, remove_tables=False):
         pass
 
     def prepare(self, schema):
         raise NotImplementedError("Refusing to dummy-prepare a table. I am a dummy.")
 
+    def migrate(self):
+        return False
+
     def update(self, schema):
         pass
 
     def get_value(self, jobid, field, raw_return=False):
         return None
 
+    def get_values(self, jobid, fields=None, raw_return=False):
+        return dict.fromkeys(fields or ())
+
     def set_value(self, jobid, field, value, raw_parameter=False):
         pass
 
     def set_values(self, jobid, fields, values, raw_parameters=False):
         pass
 
-    def get_handler(self, jobid=1):
-        return handlers.JobHandler(self, jobid)
+    def set_many(self, rows, raw_parameters=False, chunk_size=None):
+        return sum(1 for _ in rows)
+
+    def append_series(self, rows):
+        return sum(1 for _ in rows)
+
+    def last_series_step(self, jobid, series):
+        return -1
+
+    def get_series(self, series, jobids=None):
+        return list()
+
+    def get_handler(self, jobid=1, prefetch=None):
+        return handlers.JobHandler(self, jobid, prefetch=prefetch)
@@ -0,0 +1,228 @@
+"""Streaming exporters of DataStorage tables into files for other tools.
+
+All of them read the table through `DataStorage.iter_rows`, so serialized
+columns are decoded and memory is bounded by the batch size.
+"""
+import csv
+import json
+from datetime import date, datetime
+from itertools import islice
+
+from . import transformers
+from .handlers import NULL_FIELD
+
+EXPORT_FORMATS = ("csv", "jsonl", "parquet")
+
+
+def guess_format(path):
+    if path.endswith(".csv"):
+        return "csv"
+    elif path.endswith(".parquet"):
+        return "parquet"
+    else:
+        return "jsonl"
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    elif isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    elif isinstance(obj, bytes):
+        return obj.decode("utf-8", "backslashreplace")
+    elif hasattr(obj, "tolist"):
+        # NumPy arrays and scalars
+        return obj.tolist()
+    return repr(obj)
+
+
+def _to_text(value):
+    """Flatten a decoded value into a string (None for NULL)."""
+    if value is NULL_FIELD or value is None:
+        return None
+    elif isinstance(value, str):
+        return value
+    elif isinstance(value, (datetime, date)):
+        return value.isoformat()
+    elif isinstance(value, (int, float)):
+        return str(value)
+    return json.dumps(value, default=_json_default)
+
+
+def _batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_csv(fp, fields, batches):
+    writer = csv.writer(fp)
+    writer.writerow(fields)
+    for batch in batches:
+        writer.writerows(
+            ["" if value is None else value
+             for value in (_to_text(v) for v in row)]
+            for row in batch
+        )
+
+
+_TSV_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def write_tsv(fp, fields, batches):
+    """Write a header and one line per row, tab-separated and unquoted.
+
+    Backslashes, tabs and newlines in the values are escaped as \\\\, \\t
+    and \\n, so that each row stays in one line; NULLs are left empty.
+    """
+    fp.write("\t".join(fields) + "\n")
+    for batch in batches:
+        fp.write("".join(
+            "\t".join("" if value is None else value.translate(_TSV_ESCAPES)
+                      for value in (_to_text(v) for v in row)) + "\n"
+            for row in batch
+        ))
+
+
+def write_json(fp, fields, batches):
+    """Write the rows as a single JSON array of objects, as they come."""
+    separator = "[\n"
+    for batch in batches:
+        for row in batch:
+            fp.write(separator)
+            fp.write(json.dumps({field: (None if value is NULL_FIELD else value)
+                                 for field, value in zip(fields, row)},
+                                default=_json_default))
+            separator = ",\n"
+    fp.write("[]\n" if separator == "[\n" else "\n]\n")
+
+
+def write_jsonl(fp, fields, batches):
+    for batch in batches:
+        fp.write("".join(
+            json.dumps({field: (None if value is NULL_FIELD else value)
+                        for field, value in zip(fields, row)},
+                       default=_json_default) + "\n"
+            for row in batch
+        ))
+
+
+def _arrow_type(pa, decltype):
+    base = transformers.base_decltype(decltype) or ""
+    if base in ("timestamp", "datetime"):
+        return pa.timestamp("us")
+    elif base == "date":
+        return pa.date32()
+    elif "int" in base:
+        return pa.int64()
+    elif any(t in base for t in ("real", "floa", "doub")):
+        return pa.float64()
+    return pa.string()
+
+
+def _arrow_column(pa, arrow_type, values):
+    values = [None if value is NULL_FIELD else value for value in values]
+    if arrow_type == pa.string():
+        values = [_to_text(value) for value in values]
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # SQLite is dynamically typed, some values do not match their column
+        return pa.array([_to_text(value) for value in values], type=pa.string())
+
+
+# Writers of rows to text streams, by format (see `tad4bj query`)
+TABLE_WRITERS = {
+    "tsv": write_tsv,
+    "csv": write_csv,
+    "json": write_json,
+    "jsonl": write_jsonl,
+}
+
+
+def write_parquet(path, fields, decltypes, batches):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("No pyarrow library available, cannot write Parquet files")
+
+    schema = pa.schema([(field, _arrow_type(pa, decltype))
+                        for field, decltype in zip(fields, decltypes)])
+    writer = None
+    try:
+        for batch in batches:
+            columns = [_arrow_column(pa, arrow_type, values)
+                       for arrow_type, values in zip(schema.types, zip(*batch))]
+            table = pa.Table.from_arrays(columns, names=list(fields))
+            if writer is None:
+                # Columns that did not match their declared type are strings
+                schema = table.schema
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(table.cast(schema))
+        if writer is None:
+            writer = pq.ParquetWriter(path, schema)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def export(data_storage, output, dialect, fields=None, where=None, params=None,
+           after_id=None, batch_size=None):
+    """Export (part of) a table into a file.
+
+    :param data_storage: DataStorage of the table.
+    :param output: Text file object for csv and jsonl, path for parquet.
+    :param dialect: One of EXPORT_FORMATS.
+    :param fields: Field names to export. Default: all of them.
+    :param where: SQL expression to filter the rows (see `iter_rows`).
+    :param params: Parameters for the where expression.
+    :param after_id: Only export rows with an id above this one.
+    :param batch_size: Rows per batch, defaults to DataStorage.ITER_CHUNK_SIZE.
+    :return: Tuple (number of rows exported, highest id exported or None).
+    """
+    if batch_size is None:
+        batch_size = data_storage.ITER_CHUNK_SIZE
+
+    params = list(params or ())
+    if after_id is not None:
+        if where:
+            where = "id > ? AND (%s)" % where
+        else:
+            where = "id > ?"
+        params.insert(0, after_id)
+
+    metadata = dict(data_storage.get_schema().fields)
+    if fields is None:
+        fields = list(metadata.keys())
+    else:
+        fields = list(fields)
+    # Need the ids to compute the watermark
+    query_fields = fields if "id" in fields else fields + ["id"]
+    id_index = query_fields.index("id")
+
+    stats = {"count": 0, "max_id": None}
+
+    def rows():
+        for row in data_storage.iter_rows(fields=query_fields, where=where,
+                                          params=params, chunk_size=batch_size):
+            stats["count"] += 1
+            jobid = row[id_index]
+            if stats["max_id"] is None or jobid > stats["max_id"]:
+                stats["max_id"] = jobid
+            yield row[:len(fields)]
+
+    batches = _batches(rows(), batch_size)
+    if dialect == "csv":
+        write_csv(output, fields, batches)
+    elif dialect == "jsonl":
+        write_jsonl(output, fields, batches)
+    elif dialect == "parquet":
+        write_parquet(output, fields, [metadata.get(f) for f in fields], batches)
+    else:
+        raise ValueError("Unknown export format: %s" % dialect)
+
+    return stats["count"], stats["max_id"]
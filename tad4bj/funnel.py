@@ -0,0 +1,221 @@
+"""Single writer for the annotations of many worker processes.
+
+A pool of processes writing into the same database contend for its lock
+(and, with enough of them, fail with "database is locked"). A WriterFunnel
+lives in the parent process: workers send their writes over a
+multiprocessing queue, and a thread of the parent commits them in batches,
+so there is a single writer no matter the number of workers.
+
+    funnel = WriterFunnel("mytable")
+    pool = multiprocessing.Pool(64, initializer=init_worker,
+                                initargs=(funnel.storage,))
+    pool.map(task, jobs)    # task calls worker_storage().set_value(...)
+    pool.close()
+    pool.join()
+    funnel.close()
+
+Writes are asynchronous: `set_value` returns once the write is queued,
+and a worker may not read its own writes back until the funnel commits
+them. Workers must exit cleanly (pool.close() and pool.join(), not
+terminate()) for the writes still in the queue to reach the parent.
+"""
+import multiprocessing
+import threading
+from queue import Empty
+
+from . import handlers
+from .dbconn import DataStorage, _coalesce_writes
+
+# Kinds of the messages of the queue
+_SET = "set"
+_SERIES = "series"
+_STOP = "stop"
+
+# Storage of this worker process, see init_worker
+_worker_storage = None
+
+
+class FunnelDataStorage(object):
+    """DataStorage look-alike for the workers of a WriterFunnel.
+
+    Writes go to the funnel, reads to a DataStorage opened (in each worker)
+    on first use. It can be passed to worker processes, as long as it is
+    when they are created (e.g. in the initargs of a Pool).
+    """
+
+    def __init__(self, queue, table_name, path=None):
+        self._queue = queue
+        self._table = table_name
+        self._path = path
+        self._reader = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_reader"] = None
+        return state
+
+    def _get_reader(self):
+        if self._reader is None:
+            self._reader = DataStorage(self._table, self._path)
+        return self._reader
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def get_value(self, jobid, field, raw_return=False):
+        return self._get_reader().get_value(jobid, field, raw_return)
+
+    def get_values(self, jobid, fields=None, raw_return=False):
+        return self._get_reader().get_values(jobid, fields, raw_return)
+
+    def set_value(self, jobid, field, parameter, raw_parameter=False):
+        self._queue.put((_SET, jobid, {field: parameter}, raw_parameter))
+
+    def set_values(self, jobid, fields, parameters, raw_parameters=False):
+        self._queue.put((_SET, jobid, dict(zip(fields, parameters)),
+                         raw_parameters))
+
+    def set_many(self, rows, raw_parameters=False, chunk_size=None):
+        count = 0
+        for jobid, mapping in rows:
+            self._queue.put((_SET, jobid, dict(mapping), raw_parameters))
+            count += 1
+        return count
+
+    def append_series(self, rows):
+        rows = [(jobid, series, step,
+                 value.item() if hasattr(value, "item") else value)
+                for jobid, series, step, value in rows]
+        self._queue.put((_SERIES, rows, None, False))
+        return len(rows)
+
+    def last_series_step(self, jobid, series):
+        return self._get_reader().last_series_step(jobid, series)
+
+    def get_series(self, series, jobids=None):
+        return self._get_reader().get_series(series, jobids)
+
+    def get_handler(self, jobid, prefetch=None):
+        return handlers.JobHandler(self, jobid, prefetch=prefetch)
+
+
+def init_worker(storage):
+    """Pool initializer that makes storage the one of `worker_storage`."""
+    global _worker_storage
+    _worker_storage = storage
+
+
+def worker_storage():
+    """Get the FunnelDataStorage given to `init_worker` in this process."""
+    if _worker_storage is None:
+        raise RuntimeError("No funnel storage, use init_worker as the "
+                           "initializer of the worker processes")
+    return _worker_storage
+
+
+class WriterFunnel(object):
+    """Commit the writes of worker processes from a thread of this one.
+
+    :param table_name:
+    :param path:
+    :param context: multiprocessing context of the workers (for its Queue).
+    :param max_batch: Maximum number of messages committed together.
+    :param kwargs: Other arguments of the DataStorage that writes.
+
+    Writes that fail are dropped (the rest of their batch is still
+    committed) and recorded in `errors`, as (jobid, field, exception)
+    tuples; `close` raises the first exception.
+    """
+    MAX_BATCH_DEFAULT = 5000
+
+    def __init__(self, table_name, path=None, context=None, max_batch=None,
+                 **kwargs):
+        context = context or multiprocessing
+        self._queue = context.Queue()
+        self._data_storage = DataStorage(table_name, path, **kwargs)
+        self._max_batch = max_batch or WriterFunnel.MAX_BATCH_DEFAULT
+        self.storage = FunnelDataStorage(self._queue, table_name, path)
+        self.stats = self._data_storage.stats
+        self.stats.setdefault("funnel_messages", 0)
+        self.stats.setdefault("funnel_batches", 0)
+        self.errors = list()
+        self._thread = threading.Thread(target=self._run, name="tad4bj-funnel",
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            messages = [self._queue.get()]
+            while len(messages) < self._max_batch:
+                try:
+                    messages.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            writes = list()
+            points = list()
+            for kind, payload, values, raw in messages:
+                if kind == _STOP:
+                    stop = True
+                    self.stats["funnel_messages"] -= 1
+                elif kind == _SET:
+                    writes.append((payload, values, raw))
+                else:
+                    points.extend(payload)
+
+            for raw, rows in _coalesce_writes(writes):
+                self._write(rows, raw)
+            if points:
+                try:
+                    self._data_storage.append_series(points)
+                except Exception as e:
+                    self.errors.append((None, None, e))
+            self.stats["funnel_messages"] += len(messages)
+            self.stats["funnel_batches"] += 1
+
+    def _write(self, rows, raw):
+        try:
+            self._data_storage.set_many(rows, raw_parameters=raw)
+            return
+        except Exception:
+            pass
+        # Some write is wrong: find it, and keep the rest of the batch
+        for jobid, values in rows:
+            try:
+                self._data_storage.set_many([(jobid, values)], raw_parameters=raw)
+                continue
+            except Exception:
+                pass
+            for field, value in values.items():
+                try:
+                    self._data_storage.set_many([(jobid, {field: value})],
+                                                raw_parameters=raw)
+                except Exception as e:
+                    self.errors.append((jobid, field, e))
+
+    def close(self):
+        """Commit everything sent so far and stop.
+
+        The workers must have exited (or at least stopped writing) before.
+        """
+        if self._thread is None:
+            return
+        self._queue.put((_STOP, None, None, False))
+        self._thread.join()
+        self._thread = None
+        self._queue.close()
+        self._data_storage.close()
+        if self.errors:
+            raise self.errors[0][2]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -3,7 +3,19 @@ try:
 except NameError:
     Text = (str, bytes)
 
-NULL_FIELD = object()
+
+class _NullField(object):
+    """Marker of NULL values, which unpickles as the same NULL_FIELD."""
+    __slots__ = ()
+
+    def __reduce__(self):
+        return "NULL_FIELD"
+
+    def __repr__(self):
+        return "NULL_FIELD"
+
+
+NULL_FIELD = _NullField()
 
 
 class BatchHandler(object):
@@ -25,22 +37,135 @@ class BatchHandler(object):
             self._h.write_all()
 
 
-class JobHandler(object):
-    """The elemental job handler, typically reused by a single job."""
-    def __init__(self, datastorage, jobid):
+# Values of these types cannot change in place, so they need no digest
+_IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes, _NullField)
+
+
+# hashlib.sha1 and pickle.dumps, imported on first use (but kept, as
+# handlers are often closed during interpreter shutdown)
+_sha1 = _dumps = None
+
+
+def _digest(value):
+    """Cheap fingerprint of the contents of a (mutable) value.
+
+    None if it cannot be computed, meaning that the value must be
+    considered changed.
+    """
+    global _sha1, _dumps
+    try:
+        if _dumps is None:
+            from hashlib import sha1 as _sha1
+            from pickle import dumps as _dumps
+        return _sha1(_dumps(value, -1)).digest()
+    except Exception:
+        return None
+
+
+class _ChangeTracking(object):
+    """Which in-memory values of a handler differ from the database.
+
+    Needs `_inmemory_objects`, `_dirty` (fields assigned but not written)
+    and `_digests` (of the mutable values as they are in the database).
+    """
+
+    def _mark_clean(self, field, value):
+        """Record that value is what the database holds for field."""
+        self._dirty.discard(field)
+        if isinstance(value, _IMMUTABLE_TYPES):
+            self._digests.pop(field, None)
+        else:
+            self._digests[field] = _digest(value)
+
+    def _has_changed(self, field):
+        if field in self._dirty:
+            return True
+        try:
+            digest = self._digests[field]
+        except KeyError:
+            return False
+        return digest is None or digest != _digest(self._inmemory_objects[field])
+
+
+class JobHandler(_ChangeTracking):
+    """The elemental job handler, typically reused by a single job.
+
+    The handler keeps in memory the values read from or assigned to it.
+    Only fields that have been assigned or deleted, or whose (mutable)
+    value has changed in place since it was read or written, are written
+    back by `write_all`.
+    """
+    # Points of time series (see `append`) written at once, at most
+    SERIES_BUFFER_SIZE = 1000
+
+    def __init__(self, datastorage, jobid, prefetch=None):
+        """
+        :param datastorage: DataStorage (or look-alike) of the table.
+        :param jobid:
+        :param prefetch: If True, the first read of a field not in memory
+        fetches the whole row in a single query; if it is a list of field
+        names, it fetches those. Default: fetch only the field being read.
+        """
         self._id = jobid
         self._data = datastorage
         self._inmemory_objects = dict()
+        # Fields assigned or deleted but not yet written
+        self._dirty = set()
+        # Digest of mutable values as they are in the database
+        self._digests = dict()
+        # Time series points not yet written: (series, step, value)
+        self._series_points = list()
+        # Last step of the series appended to
+        self._series_steps = dict()
         self.batch = BatchHandler(self)
         self._defer_write = False
         self._closed = False
+        if prefetch is True or not prefetch:
+            self._prefetch_fields = None
+        else:
+            self._prefetch_fields = list(prefetch)
+        self._pending_prefetch = bool(prefetch)
+
+    def _assign(self, field, value):
+        self._inmemory_objects[field] = value
+        if self._defer_write:
+            self._dirty.add(field)
+        else:
+            self._data.set_value(self._id, field, value)
+            self._mark_clean(field, value)
+
+    def prefetch(self, fields=None):
+        """Read several fields (default: the whole row) with a single query.
+
+        Fields already in memory (e.g. assigned but not yet written) keep
+        their in-memory value.
+        """
+        self._pending_prefetch = False
+        values = self._data.get_values(self._id, fields)
+        for field, value in values.items():
+            if field not in self._inmemory_objects:
+                self._inmemory_objects[field] = value
+                self._mark_clean(field, value)
+
+    def _fetch(self, item):
+        """Bring item into memory after a miss, return its (decoded) value."""
+        if self._pending_prefetch:
+            self.prefetch(self._prefetch_fields)
+            try:
+                return self._inmemory_objects[item]
+            except KeyError:
+                # Not among the prefetched fields
+                pass
+
+        data = self._data.get_value(self._id, item)
+        self._inmemory_objects[item] = data
+        self._mark_clean(item, data)
+        return data
 
     def __delitem__(self, key):
         if not isinstance(key, Text):
             raise ValueError("Field names must be strings")
-        self._inmemory_objects[key] = None
-        if not self._defer_write:
-            self._data.set_value(self._id, key, None, raw_parameter=True)
+        self._assign(key, NULL_FIELD)
 
     def __getitem__(self, item):
         if not isinstance(item, Text):
@@ -49,8 +174,7 @@ class JobHandler(object):
         try:
             data = self._inmemory_objects[item]
         except KeyError:
-            data = self._data.get_value(self._id, item)
-            self._inmemory_objects[item] = data
+            data = self._fetch(item)
 
         if data is NULL_FIELD:
             raise KeyError("Field %s is NULL" % item)
@@ -60,9 +184,7 @@ class JobHandler(object):
     def __setitem__(self, key, value):
         if not isinstance(key, Text):
             raise ValueError("Field names must be strings")
-
-        self._data.set_value(self._id, key, value)
-        self._inmemory_objects[key] = value
+        self._assign(key, value)
 
     def __contains__(self, item):
         if not isinstance(item, Text):
@@ -72,6 +194,8 @@ class JobHandler(object):
             value = self._inmemory_objects[item]
             return value is not NULL_FIELD
         except KeyError:
+            if self._pending_prefetch:
+                return self._fetch(item) is not NULL_FIELD
             # No need to transform, just check if it is set
             return self._data.get_value(self._id, item, raw_return=True) is not NULL_FIELD
 
@@ -88,19 +212,68 @@ class JobHandler(object):
         try:
             return self.__getitem__(item)
         except KeyError:
-            self._inmemory_objects[item] = default
-            if not self._defer_write:
-                self._data.set_value(self._id, item, default)
+            self._assign(item, default)
             return default
 
+    def append(self, series, value, step=None):
+        """Add a point to a time series of the job (e.g. a training curve).
+
+        Points are kept apart from the fields (see `DataStorage.append_series`),
+        buffered, and written together by `write_all` (i.e. on batch exits
+        and on close) or when SERIES_BUFFER_SIZE of them are pending.
+
+        :param series: Name of the series.
+        :param value: A number, a string or None.
+        :param step: Step of the point. Default: the step after the last
+        one of the series.
+        """
+        if not isinstance(series, Text):
+            raise ValueError("Series names must be strings")
+
+        if step is None:
+            try:
+                last = self._series_steps[series]
+            except KeyError:
+                last = max([self._data.last_series_step(self._id, series)] +
+                           [s for name, s, _ in self._series_points if name == series])
+            step = last + 1
+            self._series_steps[series] = step
+        elif series in self._series_steps:
+            self._series_steps[series] = max(step, self._series_steps[series])
+
+        self._series_points.append((series, step, value))
+        if len(self._series_points) >= self.SERIES_BUFFER_SIZE:
+            self._write_series()
+
+    def series(self, series):
+        """Get the points of a time series of the job, written or not.
+
+        :return: List of (step, value) tuples, sorted by step.
+        """
+        points = {step: value
+                  for _, step, value in self._data.get_series(series, self._id)}
+        points.update((step, value) for name, step, value in self._series_points
+                      if name == series)
+        return sorted(points.items())
+
+    def _write_series(self):
+        if self._series_points:
+            self._data.append_series([(self._id, series, step, value)
+                                      for series, step, value in self._series_points])
+            self._series_points = list()
+
     def write_all(self):
         if self._closed:
             raise ConnectionError("This handler has already been closed")
+        self._write_series()
+        changed = [field for field in self._inmemory_objects
+                   if self._has_changed(field)]
         # Avoid going into a set_values calls with no objects
-        if self._inmemory_objects:
-            self._data.set_values(self._id,
-                                  self._inmemory_objects.keys(),
-                                  self._inmemory_objects.values())
+        if changed:
+            values = [self._inmemory_objects[field] for field in changed]
+            self._data.set_values(self._id, changed, values)
+            for field, value in zip(changed, values):
+                self._mark_clean(field, value)
 
     def close(self):
         if not self._closed:
@@ -0,0 +1,157 @@
+"""Pooled mode of DataStorage: parallel readers and a single writer.
+
+By default a DataStorage has a single connection, and every method holds
+its lock, so a thread reading the configuration waits for another one that
+is committing metrics. With a pool size (see `DataStorage.pool_size`),
+reads are done on a bounded pool of read-only connections and run in
+parallel (under WAL, also with the writes), while writes keep going through
+the main connection, one at a time.
+
+The pool and the lock count how often, and how long, they are waited for;
+see `DataStorage.stats`.
+"""
+import sqlite3
+from contextlib import contextmanager
+from threading import Condition, RLock
+from time import perf_counter
+
+
+class ContentionLock(object):
+    """Reentrant lock that records how much it is waited for.
+
+    :param stats: Dictionary where the `<prefix>_acquisitions`,
+    `<prefix>_contended`, `<prefix>_wait` and `<prefix>_max_wait` counters
+    are kept.
+    """
+
+    def __init__(self, stats, prefix="lock"):
+        self._lock = RLock()
+        self._stats = stats
+        self._keys = tuple("%s_%s" % (prefix, key)
+                           for key in ("acquisitions", "contended", "wait", "max_wait"))
+        for key in self._keys:
+            stats.setdefault(key, 0)
+
+    def acquire(self, blocking=True, timeout=-1):
+        acquisitions, contended, wait, max_wait = self._keys
+        if self._lock.acquire(False):
+            # Counters are only updated by the holder of the lock
+            self._stats[acquisitions] += 1
+            return True
+        if not blocking:
+            return False
+
+        start = perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+        waited = perf_counter() - start
+        stats = self._stats
+        stats[acquisitions] += 1
+        stats[contended] += 1
+        stats[wait] += waited
+        if waited > stats[max_wait]:
+            stats[max_wait] = waited
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def connect_reader(path, timeout):
+    """Open a read-only connection in autocommit mode.
+
+    Autocommit means that a read transaction only lasts for a statement
+    (or until its cursor is exhausted), so readers do not keep old
+    snapshots alive.
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=timeout,
+                           isolation_level=None)
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class ConnectionPool(object):
+    """Bounded pool of connections, opened as they are needed.
+
+    :param connect: Function that opens a new connection.
+    :param size: Maximum number of connections.
+    :param stats: Dictionary for the `reader_*` counters (see ContentionLock).
+    """
+
+    def __init__(self, connect, size, stats):
+        if size < 1:
+            raise ValueError("The pool size must be positive")
+        self._connect = connect
+        self._size = size
+        self._idle = list()
+        self._open = 0
+        self._closed = False
+        self._cond = Condition()
+        self._stats = stats
+        for key in ("reader_connections", "reader_acquisitions",
+                    "reader_contended", "reader_wait", "reader_max_wait"):
+            stats.setdefault(key, 0)
+
+    def acquire(self):
+        stats = self._stats
+        with self._cond:
+            if self._closed:
+                raise sqlite3.ProgrammingError("The connection pool is closed")
+            stats["reader_acquisitions"] += 1
+            if not self._idle and self._open >= self._size:
+                start = perf_counter()
+                while not self._idle and self._open >= self._size and not self._closed:
+                    self._cond.wait()
+                waited = perf_counter() - start
+                stats["reader_contended"] += 1
+                stats["reader_wait"] += waited
+                if waited > stats["reader_max_wait"]:
+                    stats["reader_max_wait"] = waited
+                if self._closed:
+                    raise sqlite3.ProgrammingError("The connection pool is closed")
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+            stats["reader_connections"] = self._open
+
+        # Connecting may take a while, do not block the others meanwhile
+        try:
+            return self._connect()
+        except BaseException:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        with self._cond:
+            if self._closed:
+                self._open -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close the idle connections; those in use are closed when released."""
+        with self._cond:
+            self._closed = True
+            for conn in self._idle:
+                conn.close()
+            self._open -= len(self._idle)
+            self._idle = list()
+            # Waiters would wait forever
+            self._cond.notify_all()
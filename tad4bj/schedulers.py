@@ -1,6 +1,6 @@
 import os
 
-from .dbconn import DataStorage, DummyDataStorage
+from .dbconn import DummyDataStorage, _env_flag, get_data_storage
 
 
 class Slurm:
@@ -22,9 +22,10 @@ known_schedulers = [Slurm, Pbs, Custom]
 
 
 def prepare_handler(scheduler_environ_vars):
-    return DataStorage(
+    return get_data_storage(
         os.environ[scheduler_environ_vars.TABLE_NAME]
-    ).get_handler(int(os.environ[scheduler_environ_vars.JOB_ID]))
+    ).get_handler(int(os.environ[scheduler_environ_vars.JOB_ID]),
+                  prefetch=_env_flag("TAD4BJ_PREFETCH"))
 
 
 def prepare_dummy_handler():
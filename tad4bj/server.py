@@ -0,0 +1,139 @@
+"""The `tad4bj serve` daemon: a single owner of the database for many jobs.
+
+Jobs (through RemoteDataStorage) send their reads and writes to the daemon,
+which is the only process that opens the SQLite file. Writes go into a
+write-behind DataStorage per table, so the writes of all the jobs are
+committed together in group commits.
+
+Durability: a write is acknowledged as soon as the daemon has buffered it,
+and it is committed within the flush interval (or when the daemon stops
+cleanly with SIGTERM or SIGINT). If the daemon is killed, the writes
+buffered at that moment are lost.
+"""
+import os
+import pickle
+import signal
+import sys
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from threading import Lock, Thread
+
+from .client import RemoteError, get_authkey, parse_address
+from .dbconn import DataStorage
+
+# Methods of DataStorage that clients may call
+ALLOWED_METHODS = {
+    "get_value",
+    "get_values",
+    "set_value",
+    "set_values",
+    "set_many",
+    "append_series",
+    "last_series_step",
+    "get_series",
+    "flush",
+}
+
+
+class Server(object):
+    def __init__(self, address, path=None, flush_interval=None, flush_size=None):
+        """
+        :param address: Unix socket path or "host:port" to listen on.
+        :param path: Database path (default as in DataStorage).
+        :param flush_interval: Seconds between group commits.
+        :param flush_size: Buffered values that trigger a group commit.
+        """
+        self._address, self._family = parse_address(address)
+        self._path = path
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._storages = dict()
+        self._storages_lock = Lock()
+        self._listener = None
+
+    def _get_storage(self, table):
+        with self._storages_lock:
+            try:
+                return self._storages[table]
+            except KeyError:
+                pass
+            storage = DataStorage(table, self._path,
+                                  write_behind=True,
+                                  flush_interval=self._flush_interval,
+                                  flush_size=self._flush_size)
+            self._storages[table] = storage
+            return storage
+
+    def _handle(self, conn):
+        try:
+            while True:
+                try:
+                    method, table, args, kwargs = conn.recv()
+                except EOFError:
+                    return
+
+                try:
+                    if method not in ALLOWED_METHODS:
+                        raise ValueError("Method %s not allowed" % method)
+                    result = getattr(self._get_storage(table), method)(*args, **kwargs)
+                    response = ("ok", result)
+                except Exception as e:
+                    response = ("error", e)
+
+                try:
+                    conn.send(response)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    if response[0] == "ok":
+                        raise
+                    conn.send(("error", RemoteError(repr(response[1]))))
+        except (OSError, EOFError):
+            # Client gone
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        if self._family == "AF_UNIX" and os.path.exists(self._address):
+            # Stale socket from a previous run
+            os.unlink(self._address)
+
+        self._listener = Listener(self._address, family=self._family,
+                                  authkey=get_authkey(create=True))
+        if self._family == "AF_UNIX":
+            os.chmod(self._address, 0o600)
+
+        try:
+            while True:
+                try:
+                    conn = self._listener.accept()
+                except (AuthenticationError, OSError, EOFError):
+                    # Failed handshake (e.g. wrong authkey), keep serving
+                    continue
+                t = Thread(target=self._handle, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            self.close()
+
+    def close(self):
+        with self._storages_lock:
+            for storage in self._storages.values():
+                storage.close()
+            self._storages = dict()
+
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+
+def serve(address, path=None, flush_interval=None, flush_size=None):
+    """Run the daemon until SIGTERM or SIGINT, then flush and exit."""
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    server = Server(address, path, flush_interval, flush_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,324 @@
+"""Append-only spool storage, merged offline into the database.
+
+SpoolDataStorage has the same job-level interface as DataStorage, but the
+writes are appended to journal files in a spool directory (one per job and
+process, so there is no locking at all) instead of going to the database.
+`tad4bj merge` (see `merge`) later compacts those journals into the SQLite
+table in large transactions. It is used when $TAD4BJ_SPOOL is set, see
+`dbconn.get_data_storage`.
+
+Each record in a journal holds a timestamp, so when the same field of the
+same job is written several times (even from different processes), the
+last write wins. Records are appended without fsync: a write survives the
+crash of the job but not necessarily the crash of the node.
+"""
+import os
+import pickle
+import socket
+import struct
+from time import time
+
+from . import handlers
+from .handlers import NULL_FIELD
+
+SPOOL_SUFFIX = ".spool"
+_HEADER = struct.Struct("!I")
+
+
+def _table_dir(spool_dir, table_name):
+    return os.path.join(os.path.expanduser(spool_dir), table_name)
+
+
+def _journal_records(path, start=0):
+    """Yield (record, offset after it) for the records of a journal."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            size, = _HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                # The writer died (or is) in the middle of this record
+                return
+            offset += _HEADER.size + size
+            yield pickle.loads(payload), offset
+
+
+def read_journal(path):
+    """Yield the records of a journal file, skipping a truncated tail."""
+    for record, _ in _journal_records(path):
+        yield record
+
+
+def _merged_offset(path):
+    """Bytes of a journal being merged that an earlier merge already wrote."""
+    try:
+        with open(path + ".offset") as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+class SpoolDataStorage(object):
+    """DataStorage look-alike that appends writes to per-job journal files."""
+
+    def __init__(self, table_name, spool_dir=None, path=None):
+        """
+        :param table_name:
+        :param spool_dir: Spool directory. Default: $TAD4BJ_SPOOL.
+        :param path: Database path, only used to read fields not written by
+        this process (default as in DataStorage).
+        """
+        if spool_dir is None:
+            spool_dir = os.environ["TAD4BJ_SPOOL"]
+
+        self._table = table_name
+        self._dir = _table_dir(spool_dir, table_name)
+        if not os.path.isdir(self._dir):
+            try:
+                os.makedirs(self._dir)
+            except OSError:
+                # Some other job created it meanwhile
+                if not os.path.isdir(self._dir):
+                    raise
+        self._db_path = path
+        self._data_storage = None
+        self._suffix = "-%s-%d%s" % (socket.gethostname(), os.getpid(), SPOOL_SUFFIX)
+        self._seq = 0
+        # Values written by this process, jobid -> {field: value}
+        self._written = dict()
+        # Series points written by this process, (jobid, series) -> {step: value}
+        self._series = dict()
+        self._child_handlers = list()
+
+    def _append(self, jobid, fields, values, raw):
+        self._seq += 1
+        payload = pickle.dumps((time(), self._seq, jobid, fields, values, raw),
+                               pickle.HIGHEST_PROTOCOL)
+        # Opened on every write, so that `merge` can move the journal away
+        fd = os.open(os.path.join(self._dir, "%s%s" % (jobid, self._suffix)),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, _HEADER.pack(len(payload)) + payload)
+        finally:
+            os.close(fd)
+        if fields is None:
+            # Time series points, values are (series, step, value) tuples
+            for series, step, value in values:
+                self._series.setdefault((jobid, series), dict())[step] = value
+        else:
+            self._written.setdefault(jobid, dict()).update(zip(fields, values))
+
+    def close(self):
+        for h in self._child_handlers:
+            h.close()
+        self._child_handlers = list()
+
+        if self._data_storage is not None:
+            self._data_storage.close()
+            self._data_storage = None
+
+    def __del__(self):
+        self.close()
+
+    def flush(self):
+        pass
+
+    def _get_data_storage(self):
+        if self._data_storage is None:
+            from .dbconn import DataStorage
+            self._data_storage = DataStorage(self._table, self._db_path)
+        return self._data_storage
+
+    def get_value(self, jobid, field, raw_return=False):
+        """Get a value, as written by this process or else from the database.
+
+        Values written by other processes are only visible once merged.
+        """
+        try:
+            return self._written[jobid][field]
+        except KeyError:
+            pass
+
+        try:
+            return self._get_data_storage().get_value(jobid, field,
+                                                      raw_return=raw_return)
+        except Exception:
+            # Table not there yet (or not reachable): nothing has been merged
+            return NULL_FIELD
+
+    def get_values(self, jobid, fields=None, raw_return=False):
+        """Get several fields, with the values written by this process
+        taking precedence over those in the database (see `get_value`)."""
+        written = self._written.get(jobid, dict())
+        if fields is not None:
+            fields = list(fields)
+            missing = [field for field in fields if field not in written]
+        else:
+            missing = None
+
+        values = dict()
+        if missing is None or missing:
+            try:
+                values = self._get_data_storage().get_values(
+                    jobid, missing, raw_return=raw_return)
+            except Exception:
+                # Same as in get_value: nothing has been merged
+                values = dict.fromkeys(missing or (), NULL_FIELD)
+
+        values.update(written if fields is None else
+                      {field: written[field] for field in fields if field in written})
+        return values
+
+    def set_value(self, jobid, field, parameter, raw_parameter=False):
+        self._append(jobid, [field], [parameter], raw_parameter)
+
+    def set_values(self, jobid, fields, parameters, raw_parameters=False):
+        self._append(jobid, list(fields), list(parameters), raw_parameters)
+
+    def set_many(self, rows, raw_parameters=False, chunk_size=None):
+        count = 0
+        for jobid, mapping in rows:
+            self._append(jobid, list(mapping.keys()), list(mapping.values()),
+                         raw_parameters)
+            count += 1
+        return count
+
+    def append_series(self, rows):
+        points = dict()
+        count = 0
+        for jobid, series, step, value in rows:
+            points.setdefault(jobid, list()).append((series, step, value))
+            count += 1
+        for jobid, job_points in points.items():
+            self._append(jobid, None, job_points, False)
+        return count
+
+    def last_series_step(self, jobid, series):
+        try:
+            last = self._get_data_storage().last_series_step(jobid, series)
+        except Exception:
+            # Same as in get_value: nothing has been merged
+            last = -1
+        return max([last] + list(self._series.get((jobid, series), ())))
+
+    def get_series(self, series, jobids=None):
+        if jobids is not None and not isinstance(jobids, int):
+            jobids = set(jobids)
+        try:
+            points = self._get_data_storage().get_series(series, jobids)
+        except Exception:
+            points = list()
+
+        merged = {(jobid, step): value for jobid, step, value in points}
+        for (jobid, name), steps in self._series.items():
+            if name != series or not (jobids is None or jobid == jobids or
+                                      (not isinstance(jobids, int) and jobid in jobids)):
+                continue
+            merged.update(((jobid, step), value) for step, value in steps.items())
+        return [(jobid, step, value) for (jobid, step), value in sorted(merged.items())]
+
+    def get_handler(self, jobid, prefetch=None):
+        h = handlers.JobHandler(self, jobid, prefetch=prefetch)
+        self._child_handlers.append(h)
+        return h
+
+
+def merge(data_storage, spool_dir, keep=False, min_age=0, chunk_size=None):
+    """Merge the spooled writes of the data_storage table into the database.
+
+    :param data_storage: DataStorage of the table.
+    :param spool_dir: Spool directory (as given to SpoolDataStorage).
+    :param keep: Rename merged journals to *.merged instead of removing them.
+    :param min_age: Skip journals modified less than min_age seconds ago
+    (i.e. those of jobs that may still be writing).
+
+    A writer may have opened a journal just before it is moved away, and
+    append to it after it has been read. Such journals are not removed:
+    the records after what has been merged (kept in a `.offset` file) are
+    merged by the next merge.
+    :param chunk_size: Rows per transaction (see `DataStorage.set_many`).
+    :return: Tuple (number of journals merged, number of rows and series
+    points written).
+    """
+    table_dir = _table_dir(spool_dir, data_storage._table)
+    if not os.path.isdir(table_dir):
+        return 0, 0
+
+    now = time()
+    journals = list()
+    for name in sorted(os.listdir(table_dir)):
+        if not name.endswith(SPOOL_SUFFIX):
+            continue
+        path = os.path.join(table_dir, name)
+        if now - os.path.getmtime(path) < min_age:
+            continue
+        # Writers reopen the file on every write, so from now on they
+        # will create a new journal instead of appending to this one
+        merging = path + ".merging"
+        os.rename(path, merging)
+        journals.append(merging)
+
+    # Also pick up journals left by a merge that did not finish
+    journals.extend(os.path.join(table_dir, name)
+                    for name in sorted(os.listdir(table_dir))
+                    if name.endswith(SPOOL_SUFFIX + ".merging")
+                    and os.path.join(table_dir, name) not in journals)
+
+    # jobid -> {field: ((timestamp, seq), value, raw)}
+    latest = dict()
+    # (jobid, series, step) -> ((timestamp, seq), value)
+    series_points = dict()
+    # path -> bytes merged
+    merged = dict()
+    for path in journals:
+        merged[path] = _merged_offset(path)
+        for record, merged[path] in _journal_records(path, merged[path]):
+            timestamp, seq, jobid, fields, values, raw = record
+            if fields is None:
+                for series, step, value in values:
+                    key = (jobid, series, step)
+                    previous = series_points.get(key)
+                    if previous is None or previous[0] <= (timestamp, seq):
+                        series_points[key] = ((timestamp, seq), value)
+                continue
+
+            row = latest.setdefault(jobid, dict())
+            for field, value in zip(fields, values):
+                previous = row.get(field)
+                if previous is None or previous[0] <= (timestamp, seq):
+                    row[field] = ((timestamp, seq), value, raw)
+
+    def rows(raw):
+        for jobid, row in latest.items():
+            mapping = {field: value for field, (_, value, is_raw) in row.items()
+                       if is_raw == raw}
+            if mapping:
+                yield jobid, mapping
+
+    count = data_storage.set_many(rows(False), chunk_size=chunk_size)
+    count += data_storage.set_many(rows(True), raw_parameters=True,
+                                   chunk_size=chunk_size)
+    count += data_storage.append_series(
+        (jobid, series, step, value)
+        for (jobid, series, step), (_, value) in series_points.items()
+    )
+
+    for path in journals:
+        if os.path.getsize(path) != merged[path]:
+            # Written meanwhile (or a record still being written)
+            with open(path + ".offset.tmp", "w") as f:
+                f.write(str(merged[path]))
+            os.rename(path + ".offset.tmp", path + ".offset")
+            continue
+        if keep:
+            os.rename(path, path[:-len(".merging")] + ".merged")
+        else:
+            os.unlink(path)
+        if os.path.exists(path + ".offset"):
+            os.unlink(path + ".offset")
+
+    return len(journals), count
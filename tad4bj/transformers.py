@@ -1,56 +1,452 @@
-import sqlite3
-import json
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+# The serialization libraries are only imported when a column needs them,
+# so that short-lived processes (e.g. the CLI) do not pay for them.
+
 
-try:
-    import yaml
-except ImportError:
-    yaml = None
+def load_yaml_module():
+    """Import yaml on first use (raising ImportError if it is unavailable)."""
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError("No YAML library available, YAML is unsupported")
+    return yaml
 
 
 def convert_yaml(s):
-    if yaml is None:
-        raise ImportError("No YAML library available, YAML is unsupported")
-    return yaml.load(s)
+    yaml = load_yaml_module()
+    # Same trust model as pickle columns: the adapter dumps Python objects
+    return yaml.load(s, Loader=yaml.Loader)
 
 
 def yaml_adapter(obj):
-    if yaml is None:
-        raise ImportError("No YAML library available, YAML is unsupported")
-    return yaml.dump(obj)
+    return load_yaml_module().dump(obj)
 
 
 def convert_json(s):
+    import json
     return json.loads(s)
 
 
 def json_adapter(obj):
+    import json
     return json.dumps(obj)
 
 
+def _text_decoder(convert):
+    """Wrap a converter of text-based values for raw values read from SQLite.
+
+    Declared types like json or yaml have NUMERIC affinity, so SQLite stores
+    the serialization of a number as that number. Those are returned as is.
+    """
+    def decode(value):
+        if isinstance(value, (int, float)):
+            return value
+        return convert(value)
+    return decode
+
+
+def _lenient_decoder(convert):
+    """Wrap a converter so that unparseable values are returned untouched."""
+    def decode(value):
+        if not isinstance(value, (str, bytes)):
+            return value
+        try:
+            return convert(value)
+        except ValueError:
+            return value
+    return decode
+
+
 def convert_pickle(s):
+    import pickle
     return pickle.loads(s)
 
 
 def pickle_adapter(obj):
-    return pickle.dumps(obj)
+    import pickle
+    return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
 
 
 def identity_adapter(obj):
     return obj
 
 
+def convert_timestamp(s):
+    from datetime import datetime
+    if isinstance(s, bytes):
+        s = s.decode("utf-8")
+    return datetime.fromisoformat(s)
+
+
+def convert_date(s):
+    from datetime import date
+    if isinstance(s, bytes):
+        s = s.decode("utf-8")
+    return date.fromisoformat(s)
+
+
+# magic, offset of the data, length of the dtype description, ndim
+_NDARRAY_HEADER = "<4sIHB"
+_NDARRAY_MAGIC = b"NDA1"
+
+
+def ndarray_adapter(obj):
+    """Serialize an array as a small header and its raw C-ordered buffer."""
+    import struct
+    import numpy as np
+
+    array = np.asarray(obj)
+    if not array.flags.c_contiguous:
+        array = array.copy(order="C")
+    if array.dtype.hasobject:
+        raise TypeError("Arrays of Python objects cannot be stored as ndarray, "
+                        "use a pickle field instead")
+    descr = repr(np.lib.format.dtype_to_descr(array.dtype)).encode("ascii")
+    header_size = struct.calcsize(_NDARRAY_HEADER) + len(descr) + 8 * array.ndim
+    # Align the data to 16 bytes counting the tag, i.e. as it will be stored
+    tag_size = len(CODEC_TAG_MAGIC) + len(b"ndarray\x00")
+    offset = header_size + (-(header_size + tag_size) % 16)
+
+    header = bytearray(offset)
+    struct.pack_into(_NDARRAY_HEADER, header, 0,
+                     _NDARRAY_MAGIC, offset, len(descr), array.ndim)
+    position = struct.calcsize(_NDARRAY_HEADER)
+    header[position:position + len(descr)] = descr
+    struct.pack_into("<%dQ" % array.ndim, header, position + len(descr), *array.shape)
+    return b"".join((header, array.reshape(-1).view(np.uint8)))
+
+
+def convert_ndarray(s):
+    """Get the array of a serialized one, as a read-only view of s.
+
+    Nothing is copied; DataStorage(writable_arrays=True) copies them.
+    """
+    import struct
+    from ast import literal_eval
+    from math import prod
+    import numpy as np
+
+    magic, offset, descr_size, ndim = struct.unpack_from(_NDARRAY_HEADER, s)
+    if magic != _NDARRAY_MAGIC:
+        raise ValueError("Not a serialized ndarray")
+    position = struct.calcsize(_NDARRAY_HEADER)
+    descr = literal_eval(bytes(s[position:position + descr_size]).decode("ascii"))
+    shape = struct.unpack_from("<%dQ" % ndim, s, position + descr_size)
+
+    return np.frombuffer(s, dtype=np.lib.format.descr_to_dtype(descr),
+                         count=prod(shape), offset=offset).reshape(shape)
+
+
+def _module_function(module, function):
+    """Function of a module that is only imported when first called."""
+    def call(value):
+        return getattr(__import__(module), function)(value)
+    call.__name__ = "%s_%s" % (module, function)
+    return call
+
+
+# Codecs, by name: (encoder, decoder, whether the decoder accepts any
+# bytes-like object). A declared type may chain several of them with "+",
+# e.g. "pickle+zlib" pickles and then compresses.
+CODECS = {
+    "yaml": (yaml_adapter, convert_yaml, False),
+    "json": (json_adapter, convert_json, False),
+    "pickle": (pickle_adapter, convert_pickle, True),
+    "marshal": (_module_function("marshal", "dumps"),
+                _module_function("marshal", "loads"), True),
+    "zlib": (_module_function("zlib", "compress"),
+             _module_function("zlib", "decompress"), True),
+    "bz2": (_module_function("bz2", "compress"),
+            _module_function("bz2", "decompress"), True),
+    "lzma": (_module_function("lzma", "compress"),
+             _module_function("lzma", "decompress"), True),
+    "ndarray": (ndarray_adapter, convert_ndarray, True),
+}
+
+# Values of these codecs are stored as they always have been; the values of
+# any other codec are tagged with the codec that encoded them
+UNTAGGED_CODECS = {"yaml", "json", "pickle"}
+
+CODEC_TAG_MAGIC = b"\x00t4b"
+
+# Tag of the references to values kept out of the database (see blobs.py)
+BLOB_REF_MAGIC = CODEC_TAG_MAGIC + b"ref\x00"
+
+
+def register_codec(name, encoder, decoder, buffers=False):
+    """Register a codec, usable as declared type (alone or in a chain).
+
+    :param name: Name of the codec, without "+" (case insensitive).
+    :param encoder: Function from a Python object (or the output of the
+    previous codec in the chain) to bytes or str.
+    :param decoder: Inverse of encoder, receives bytes.
+    :param buffers: The decoder also accepts memoryview objects, which
+    saves a copy when decoding values kept out of the database.
+
+    Register codecs before opening the tables that use them, and in every
+    process that reads them.
+    """
+    name = name.lower()
+    if "+" in name or "\x00" in name or name == "ref":
+        raise ValueError("Invalid codec name %r" % name)
+    CODECS[name] = (encoder, decoder, buffers)
+    _codec_chains.clear()
+
+
+def _split_tag(value):
+    """Split a tagged value into (codec chain name, payload), None if untagged."""
+    if not isinstance(value, (bytes, memoryview)) or \
+            value[:len(CODEC_TAG_MAGIC)] != CODEC_TAG_MAGIC:
+        return None
+    start = len(CODEC_TAG_MAGIC)
+    header = bytes(value[start:start + 256])
+    end = header.index(b"\x00")
+    return header[:end].decode("ascii"), memoryview(value)[start + end + 1:]
+
+
+class CodecChain(object):
+    """Encoder and decoder of a declared type made of codecs.
+
+    Values are encoded by each codec of the chain in order and, unless the
+    chain is a single untagged codec, prefixed with a tag naming the chain.
+    When decoding, tagged values are decoded with the chain in their tag
+    (so the declared type of a column can change without rewriting it) and
+    untagged values with the first codec of the chain (i.e. what the column
+    held before becoming a compressed one).
+    """
+    __slots__ = ("name", "_encoders", "_decoders", "_buffers", "_tag",
+                 "_untagged_decoder", "_untagged_buffers")
+
+    def __init__(self, name):
+        self.name = name
+        codecs = [CODECS[codec] for codec in name.split("+")]
+        self._encoders = [encoder for encoder, _, _ in codecs]
+        self._decoders = [decoder for _, decoder, _ in reversed(codecs)]
+        self._buffers = codecs[-1][2]
+        if name in UNTAGGED_CODECS:
+            self._tag = None
+        else:
+            self._tag = CODEC_TAG_MAGIC + name.encode("ascii") + b"\x00"
+
+        first = name.split("+", 1)[0]
+        _, decoder, self._untagged_buffers = CODECS[first]
+        if first in ("json", "yaml"):
+            decoder = _text_decoder(decoder)
+        self._untagged_decoder = decoder
+
+    def encode(self, obj):
+        obj = self._encoders[0](obj)
+        for encoder in self._encoders[1:]:
+            if isinstance(obj, str):
+                obj = obj.encode("utf-8")
+            obj = encoder(obj)
+        if self._tag is None:
+            return obj
+        if isinstance(obj, str):
+            obj = obj.encode("utf-8")
+        return self._tag + obj
+
+    def _decode_payload(self, payload):
+        if not self._buffers:
+            payload = bytes(payload)
+        for decoder in self._decoders:
+            payload = decoder(payload)
+        return payload
+
+    def decode(self, value):
+        """Decode a raw value (or a memoryview of an out-of-line one)."""
+        tagged = _split_tag(value)
+        if tagged is not None:
+            name, payload = tagged
+            chain = self if name == self.name else get_codec_chain(name)
+            if chain is None:
+                raise ValueError("Unknown codec %s, register it first" % name)
+            return chain._decode_payload(payload)
+        if isinstance(value, memoryview) and not self._untagged_buffers:
+            value = bytes(value)
+        return self._untagged_decoder(value)
+
+
+def _resolving(convert, resolve):
+    """Wrap a converter so that references to blobs are resolved first."""
+    def decode(value):
+        if isinstance(value, bytes) and value.startswith(BLOB_REF_MAGIC):
+            value = resolve(value)
+        return convert(value)
+    return decode
+
+
+def _writable(convert):
+    """Wrap a converter so that the read-only arrays it returns are copied."""
+    def decode(value):
+        value = convert(value)
+        if type(value).__module__ == "numpy" and not value.flags.writeable:
+            value = value.copy()
+        return value
+    return decode
+
+
+def _serialized_converter(convert, decltype, resolve=None, writable_arrays=False):
+    """Add the blob and array options to the converter of a serialized type."""
+    if convert is None or get_codec_chain(decltype) is None:
+        return convert
+    if writable_arrays:
+        convert = _writable(convert)
+    if resolve is not None:
+        convert = _resolving(convert, resolve)
+    return convert
+
+
+_codec_chains = dict()
+
+
+def get_codec_chain(decltype):
+    """Get the CodecChain of a declared type, None if it is not made of codecs."""
+    name = base_decltype(decltype)
+    try:
+        return _codec_chains[name]
+    except KeyError:
+        pass
+    if not name or any(codec not in CODECS for codec in name.split("+")):
+        chain = None
+    else:
+        chain = CodecChain(name)
+    _codec_chains[name] = chain
+    return chain
+
+
 def register_converters():
-    sqlite3.register_converter("yaml", convert_yaml)
-    sqlite3.register_converter("json", convert_json)
-    sqlite3.register_converter("pickle", convert_pickle)
+    """Register the codecs as sqlite3 converters (for detect_types connections)."""
+    import sqlite3
+    for name in CODECS:
+        sqlite3.register_converter(name, get_codec_chain(name).decode)
 
 
-DECLTYPE_ADAPTERS = {
-    "yaml": yaml_adapter,
-    "json": json_adapter,
-    "pickle": pickle_adapter,
+# Converters of declared types that are not codecs
+DECLTYPE_CONVERTERS = {
+    "timestamp": _lenient_decoder(convert_timestamp),
+    "date": _lenient_decoder(convert_date),
 }
+
+
+def get_adapter(decltype):
+    """Get the function that adapts Python objects for a declared type.
+
+    None if values of that type are stored as they are.
+    """
+    chain = get_codec_chain(decltype)
+    if chain is None:
+        return None
+    return chain.encode
+
+
+def get_converter(decltype):
+    """Get the function that decodes raw values of a declared type.
+
+    None if values of that type are returned as they are.
+    """
+    try:
+        return DECLTYPE_CONVERTERS[base_decltype(decltype)]
+    except KeyError:
+        pass
+    chain = get_codec_chain(decltype)
+    if chain is None:
+        return None
+    return chain.decode
+
+
+def base_decltype(decltype):
+    """Normalize a declared type the same way that sqlite3 does for converters."""
+    if not decltype:
+        return decltype
+    return decltype.split("(", 1)[0].split(" ", 1)[0].strip("\"'`").lower()
+
+
+def _bulk_json(values):
+    import json
+    texts = list()
+    for value in values:
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        elif not isinstance(value, str):
+            value = repr(value)
+        texts.append(value)
+    return json.loads("[%s]" % ",".join(texts))
+
+
+def decode_column(decltype, values, null=None, resolve=None, writable_arrays=False):
+    """Decode all the raw values of a column at once.
+
+    JSON columns are parsed with a single json.loads call; other types go
+    through their converter in a single comprehension.
+
+    :param decltype: Declared type of the column.
+    :param values: Sequence of raw values, None for NULL.
+    :param null: Value that replaces NULLs.
+    :param resolve: Function that reads the blob of a reference, for
+    serialized columns.
+    :param writable_arrays: Copy the (read-only) arrays of ndarray values.
+    """
+    base = base_decltype(decltype)
+    convert = get_converter(base)
+    if convert is None:
+        return [null if value is None else value for value in values]
+    convert = _serialized_converter(convert, base, resolve, writable_arrays)
+
+    if base == "json":
+        present = [value for value in values if value is not None]
+        try:
+            decoded = iter(_bulk_json(present))
+        except ValueError:
+            # Some malformed value, let the per-value path report it
+            pass
+        else:
+            return [null if value is None else next(decoded) for value in values]
+
+    return [null if value is None else convert(value) for value in values]
+
+
+class RowDecoder(object):
+    """Decoding plan for rows of a given set of columns.
+
+    The converter of each column is resolved once, when building the plan,
+    and then each row is decoded in a single pass: NULLs are replaced by the
+    null marker and the values of columns with a converter are converted.
+    """
+    __slots__ = ("fields", "rowtuple", "_converted", "_null")
+
+    def __init__(self, rowtuple, decltypes, null, resolve=None, fields=None,
+                 writable_arrays=False):
+        """
+        :param rowtuple: namedtuple class for the decoded rows.
+        :param decltypes: Declared type of each column (None if unknown).
+        :param null: Value that replaces NULLs.
+        :param resolve: Function that reads the blob of a reference, for
+        serialized columns.
+        :param fields: Column names, if they are not the rowtuple fields
+        (which get renamed when they are not valid identifiers).
+        :param writable_arrays: Copy the (read-only) arrays of ndarray values.
+        """
+        self.fields = rowtuple._fields if fields is None else tuple(fields)
+        self.rowtuple = rowtuple
+        self._null = null
+        converters = [
+            _serialized_converter(get_converter(decltype), decltype, resolve,
+                                  writable_arrays)
+            for decltype in decltypes
+        ]
+        self._converted = tuple(
+            (i, convert) for i, convert in enumerate(converters)
+            if convert is not None
+        )
+
+    def decode_values(self, row):
+        null = self._null
+        values = [null if value is None else value for value in row]
+        for i, convert in self._converted:
+            value = values[i]
+            if value is not null:
+                values[i] = convert(value)
+        return values
+
+    def __call__(self, row):
+        return self.rowtuple._make(self.decode_values(row))
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tad4bj import DataSchema, DataStorage  # noqa: E402
+
+SCHEMA = DataSchema({
+    "fields": [["id", "integer"], ["accuracy", "real"], ["status", "text"],
+               ["config", "json"]]
+})
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Path of a database with the table `t` of SCHEMA."""
+    path = str(tmp_path / "test.db")
+    ds = DataStorage("t", path)
+    ds.prepare(SCHEMA)
+    ds.close()
+    return path
@@ -0,0 +1,51 @@
+import random
+import statistics
+
+import pytest
+
+from tad4bj import DataStorage
+
+
+@pytest.mark.parametrize("pool_size", [None, 2])
+def test_variance_with_large_offset(db_path, pool_size):
+    rng = random.Random(0)
+    values = [1e9 + i % 3 + rng.gauss(0, 0.1) for i in range(300)]
+    ds = DataStorage("t", db_path, pool_size=pool_size)
+    ds.set_many((i, {"accuracy": v, "status": "abc"[i % 2]})
+                for i, v in enumerate(values))
+
+    result, = ds.aggregate(metrics={"accuracy": ["mean", "var", "std"]})
+    assert result.accuracy_var == pytest.approx(statistics.variance(values), rel=1e-6)
+    assert result.accuracy_std == pytest.approx(statistics.stdev(values), rel=1e-6)
+
+    for row in ds.aggregate("status", {"accuracy": "var"}):
+        group = values[0 if row.status == "a" else 1::2]
+        assert row.accuracy_var == pytest.approx(statistics.variance(group), rel=1e-6)
+    ds.close()
+
+
+def test_variance_of_a_single_value(db_path):
+    ds = DataStorage("t", db_path)
+    ds.set_value(1, "accuracy", 0.5)
+    result, = ds.aggregate(metrics={"accuracy": ["var", "std"]})
+    assert result.accuracy_var is None and result.accuracy_std is None
+    ds.close()
+
+
+def test_json_path_columns_are_usable_by_name(db_path):
+    ds = DataStorage("t", db_path)
+    ds.set_many((i, {"accuracy": i / 10.0,
+                     "config": {"optimizer": "adam" if i % 2 else "sgd", "lr": 0.1}})
+                for i in range(10))
+
+    rows = ds.aggregate(["config.optimizer", "config.lr"],
+                        {"accuracy": "max", "config.lr": "mean"},
+                        order_by="-accuracy_max")
+    assert rows[0]._fields == ("config_optimizer", "config_lr", "accuracy_max",
+                               "config_lr_mean", "count")
+    assert (rows[0].config_optimizer, rows[0].accuracy_max, rows[0].count) == \
+        ("adam", 0.9, 5)
+
+    frame = ds.aggregate("config.optimizer", {"config.lr": "mean"}, dataframe=True)
+    assert list(frame.columns) == ["config.optimizer", "config.lr_mean", "count"]
+    ds.close()
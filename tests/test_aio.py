@@ -0,0 +1,75 @@
+import asyncio
+import sqlite3
+
+from tad4bj import DataStorage
+from tad4bj.aio import AsyncDataStorage
+
+
+async def _held_back(d, writes):
+    # Hold the worker thread back, so that all the writes get coalesced
+    d._storage.lock.acquire()
+    asyncio.get_running_loop().call_later(0.1, d._storage.lock.release)
+    return await asyncio.gather(*writes, return_exceptions=True)
+
+
+async def _write_all(db_path):
+    async with AsyncDataStorage("t", db_path) as d:
+        results = await _held_back(d, [d.set_value(i, "status", "ok")
+                                       for i in range(100, 110)])
+        assert results == [None] * 10
+        assert d.stats["coalesced_writes"] > 0
+
+        writes = [d.set_value(i, "typo" if i == 5 else "accuracy", i / 10.0)
+                  for i in range(20)]
+        writes.append(d.set_value(20, "config", '{"raw": 20}', raw_parameter=True))
+        writes.append(d.set_values(21, ["config"], [{"adapted": 21}]))
+        return await _held_back(d, writes)
+
+
+def test_coalesced_writes_fail_one_by_one(db_path):
+    results = asyncio.run(_write_all(db_path))
+
+    assert isinstance(results[5], sqlite3.OperationalError)
+    assert all(r is None for i, r in enumerate(results) if i != 5)
+
+    ds = DataStorage("t", db_path)
+    assert ds.get_value(4, "accuracy") == 0.4
+    assert ds.get_value(6, "accuracy") == 0.6
+    assert 5 not in ds
+    assert ds.get_value(20, "config") == {"raw": 20}
+    assert ds.get_value(21, "config") == {"adapted": 21}
+    ds.close()
+
+
+async def _handler_round_trip(db_path):
+    async with AsyncDataStorage("t", db_path) as d:
+        h = d.get_handler(1)
+        async with h.batch:
+            await h.set("config", {"items": [1]})
+            await h.set("status", "running")
+        (await h.get("config"))["items"].append(2)
+        await h.close()
+        return await d.get_values(1, ["config", "status"])
+
+
+def test_handler_writes_changes_in_place(db_path):
+    assert asyncio.run(_handler_round_trip(db_path)) == {
+        "config": {"items": [1, 2]}, "status": "running"}
+
+
+async def _handler_left_open(db_path):
+    async with AsyncDataStorage("t", db_path) as d:
+        h = d.get_handler(1)
+        await h.set("config", {"items": [1]})
+        (await h.get("config"))["items"].append(2)
+        await h.batch.__aenter__()
+        await h.set("status", "running")
+        # Neither the batch nor the handler are closed
+
+
+def test_close_writes_the_handlers(db_path):
+    asyncio.run(_handler_left_open(db_path))
+    ds = DataStorage("t", db_path)
+    assert ds.get_values(1, ["config", "status"]) == {
+        "config": {"items": [1, 2]}, "status": "running"}
+    ds.close()
@@ -0,0 +1,30 @@
+import sys
+
+import pytest
+
+from tad4bj import DataStorage
+from tad4bj.__main__ import main
+from tad4bj.handlers import NULL_FIELD
+
+
+def _tad4bj(monkeypatch, db_path, *argv):
+    monkeypatch.setattr(sys, "argv", ["tad4bj", "-d", db_path, "-t", "t"] + list(argv))
+    main()
+
+
+def test_import_reports_records_without_id(db_path, tmp_path, monkeypatch):
+    path = tmp_path / "rows.jsonl"
+    path.write_text('{"id": 1, "status": "ok"}\n\n{"status": "no id"}\n')
+    with pytest.raises(ValueError, match="Record 2: no id field"):
+        _tad4bj(monkeypatch, db_path, "import", str(path))
+
+
+def test_import(db_path, tmp_path, monkeypatch):
+    path = tmp_path / "rows.csv"
+    path.write_text("id,status,accuracy\n1,ok,0.5\n2,,0.25\n")
+    _tad4bj(monkeypatch, db_path, "import", str(path))
+
+    ds = DataStorage("t", db_path)
+    assert ds.get_values(2, ["status", "accuracy"]) == {
+        "status": NULL_FIELD, "accuracy": 0.25}
+    ds.close()
@@ -0,0 +1,36 @@
+import gc
+import sqlite3
+import sys
+
+import pytest
+
+from tad4bj import DataStorage
+from tad4bj.dbconn import ConcurrencyProfile
+
+
+def test_unknown_profile_fails_cleanly(tmp_path):
+    unraisable = list()
+    hook, sys.unraisablehook = sys.unraisablehook, unraisable.append
+    try:
+        with pytest.raises(ValueError, match="Unknown concurrency profile"):
+            DataStorage("t", str(tmp_path / "test.db"), profile="nonsense")
+        gc.collect()
+    finally:
+        sys.unraisablehook = hook
+    # Nothing from __del__
+    assert unraisable == []
+
+
+def test_execute_with_retry_max_retries(db_path):
+    blocker = sqlite3.connect(db_path)
+    blocker.execute("BEGIN EXCLUSIVE")
+    ds = DataStorage("t", db_path, profile=ConcurrencyProfile(busy_timeout=0))
+    with pytest.raises(sqlite3.OperationalError):
+        ds.execute_with_retry("DELETE FROM t", max_retries=1)
+    assert ds.stats["write_retries"] == 1
+    blocker.rollback()
+    blocker.close()
+
+    ds.execute_with_retry("INSERT INTO t (id) VALUES (?)", (1,), max_retries=5)
+    assert 1 in ds
+    ds.close()
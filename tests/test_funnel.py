@@ -0,0 +1,63 @@
+import multiprocessing
+import sqlite3
+
+import pytest
+
+from tad4bj import DataStorage
+from tad4bj.funnel import WriterFunnel, init_worker, worker_storage
+
+
+def _task(jobid):
+    storage = worker_storage()
+    storage.set_values(jobid, ["accuracy", "config"], [jobid / 10.0, {"n": jobid}])
+    storage.set_value(jobid, "status", "raw", raw_parameter=True)
+
+
+def test_raw_and_adapted_round_trips(db_path):
+    funnel = WriterFunnel("t", db_path)
+    storage = funnel.storage
+    storage.set_value(1, "config", {"lr": 0.1})
+    storage.set_value(2, "config", '{"raw": 1}', raw_parameter=True)
+    storage.set_values(3, ["config"], ['{"raw": 3}'], raw_parameters=True)
+    storage.set_many([(4, {"config": '{"raw": 4}'})], raw_parameters=True)
+    # The latest write of a field wins, raw or not
+    storage.set_value(5, "config", '{"raw": 5}', raw_parameter=True)
+    storage.set_value(5, "config", {"adapted": 5})
+    funnel.close()
+
+    ds = DataStorage("t", db_path)
+    assert ds.get_value(1, "config") == {"lr": 0.1}
+    assert ds.get_value(2, "config") == {"raw": 1}
+    assert ds.get_value(3, "config") == {"raw": 3}
+    assert ds.get_value(4, "config") == {"raw": 4}
+    assert ds.get_value(5, "config") == {"adapted": 5}
+    ds.close()
+
+
+def test_bad_write_only_drops_itself(db_path):
+    funnel = WriterFunnel("t", db_path)
+    funnel.storage.set_value(1, "status", "ok")
+    funnel.storage.set_values(2, ["status", "typo"], ["ok", 1])
+    funnel.storage.set_value(3, "status", "ok")
+    with pytest.raises(sqlite3.OperationalError):
+        funnel.close()
+    assert [(jobid, field) for jobid, field, _ in funnel.errors] == [(2, "typo")]
+
+    ds = DataStorage("t", db_path)
+    assert [ds.get_value(i, "status") for i in (1, 2, 3)] == ["ok"] * 3
+    ds.close()
+
+
+def test_worker_processes(db_path):
+    context = multiprocessing.get_context("fork")
+    with WriterFunnel("t", db_path, context=context) as funnel:
+        pool = context.Pool(4, initializer=init_worker, initargs=(funnel.storage,))
+        pool.map(_task, range(50))
+        pool.close()
+        pool.join()
+
+    ds = DataStorage("t", db_path)
+    assert ds.get_values(7, ["accuracy", "status", "config"]) == {
+        "accuracy": 0.7, "status": "raw", "config": {"n": 7}}
+    assert len(ds) == 50
+    ds.close()
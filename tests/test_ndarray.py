@@ -0,0 +1,36 @@
+import pytest
+
+from tad4bj import DataSchema, DataStorage
+
+np = pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def array_db(tmp_path):
+    path = str(tmp_path / "arrays.db")
+    ds = DataStorage("a", path)
+    ds.prepare(DataSchema({"fields": [["id", "integer"], ["weights", "ndarray"],
+                                      ["packed", "ndarray+zlib"]]}))
+    ds.set_values(1, ["weights", "packed"], [np.arange(6.0).reshape(2, 3), np.ones(4)])
+    ds.close()
+    return path
+
+
+def test_arrays_are_read_only_views_by_default(array_db):
+    ds = DataStorage("a", array_db)
+    weights = ds.get_value(1, "weights")
+    assert weights.shape == (2, 3) and not weights.flags.writeable
+    ds.close()
+
+
+def test_writable_arrays_is_per_storage(array_db):
+    writable = DataStorage("a", array_db, writable_arrays=True)
+    default = DataStorage("a", array_db)
+
+    for value in (writable.get_value(1, "weights"), writable[1].packed,
+                  writable.to_dataframe()["packed"][0]):
+        value[0] = 42
+    assert not default.get_value(1, "weights").flags.writeable
+    assert default.get_value(1, "weights")[0, 0] == 0
+    writable.close()
+    default.close()
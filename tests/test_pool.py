@@ -0,0 +1,41 @@
+import threading
+
+from tad4bj import DataStorage
+
+
+def test_readers_see_the_commits_of_the_writer(db_path):
+    ds = DataStorage("t", db_path, pool_size=2)
+    assert ds.journal_mode == "wal"
+
+    ds.set_value(1, "status", "running")
+    assert ds.get_value(1, "status") == "running"
+    ds.set_values(1, ["status", "accuracy"], ["done", 0.5])
+    assert ds.get_values(1, ["status", "accuracy"]) == {"status": "done", "accuracy": 0.5}
+    assert ds.stats["reader_acquisitions"] >= 2
+    ds.close()
+
+
+def test_readers_in_threads(db_path):
+    ds = DataStorage("t", db_path, pool_size=2)
+    ds.set_many((i, {"accuracy": i / 100.0}) for i in range(100))
+    errors = list()
+
+    def read():
+        try:
+            for i in range(100):
+                assert ds.get_value(i, "accuracy") == i / 100.0
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for i in range(100, 200):
+        ds.set_value(i, "accuracy", i / 100.0)
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert ds.stats["reader_connections"] <= 2
+    assert len(ds) == 200
+    ds.close()
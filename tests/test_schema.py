@@ -0,0 +1,38 @@
+import sqlite3
+
+from tad4bj import DataSchema, DataStorage
+
+
+def _index_names(path):
+    conn = sqlite3.connect(path)
+    names = {name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")}
+    conn.close()
+    return names
+
+
+def test_migrate_keeps_indexes(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    # As created by older versions, without a primary key
+    conn.execute("CREATE TABLE t (id integer, s text, cfg json)")
+    conn.executemany("INSERT INTO t VALUES (?, ?, ?)",
+                     [(1, "a", '{"lr": 0.1}'), (2, "b", '{"lr": 0.2}'),
+                      (2, None, '{"lr": 0.3}')])
+    conn.commit()
+    conn.close()
+
+    ds = DataStorage("t", path)
+    ds.update(DataSchema({"fields": [["id", "integer"], ["s", "text"], ["cfg", "json"]],
+                          "indexes": ["s", "cfg.lr"]}))
+    indexes = _index_names(path)
+    assert indexes == {"t__s", "t__cfg.lr"}
+
+    assert ds.migrate()
+    assert _index_names(path) == indexes
+    assert ds.get_values(2, ["s", "cfg"]) == {"s": "b", "cfg": {"lr": 0.3}}
+    assert [row.id for row in ds.iter_rows(where={"cfg.lr": ("<", 0.25)})] == [1]
+
+    ds._cursor.execute("EXPLAIN QUERY PLAN SELECT id FROM t WHERE `cfg.lr` = 0.1")
+    assert any("t__cfg.lr" in row[-1] for row in ds._cursor.fetchall())
+    ds.close()
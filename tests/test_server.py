@@ -0,0 +1,62 @@
+import sqlite3
+import threading
+
+import pytest
+
+from tad4bj.client import RemoteDataStorage
+from tad4bj.server import Server
+
+
+@pytest.fixture
+def server(db_path, tmp_path, monkeypatch):
+    monkeypatch.setenv("TAD4BJ_AUTHKEY", "test-key")
+    server = Server(str(tmp_path / "tad4bj.sock"), db_path, flush_interval=60,
+                    flush_size=10000)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if server._listener is not None:
+            break
+        thread.join(0.01)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def address(server):
+    return server._address
+
+
+def test_unknown_field_fails_for_its_client_only(address):
+    bad = RemoteDataStorage("t", address)
+    good = RemoteDataStorage("t", address)
+
+    good.set_value(1, "status", "running")
+    with pytest.raises(sqlite3.OperationalError, match="typo"):
+        bad.set_value(2, "typo", 1)
+
+    good.set_value(1, "accuracy", 0.5)
+    assert good.get_values(1, ["status", "accuracy"]) == {
+        "status": "running", "accuracy": 0.5}
+    bad.close()
+    good.close()
+
+
+def test_reads_do_not_commit_the_writes_of_others(server, address):
+    clients = [RemoteDataStorage("t", address) for _ in range(5)]
+    for jobid, client in enumerate(clients):
+        client.set_value(jobid, "config", {"lr": jobid})
+    clients[0].flush()
+    transactions = server._storages["t"].stats["write_transactions"]
+
+    for step in range(20):
+        for jobid, client in enumerate(clients):
+            client.set_value(jobid, "accuracy", step / 20.0)
+            assert client.get_value(jobid, "config") == {"lr": jobid}
+    assert server._storages["t"].stats["write_transactions"] == transactions
+
+    # Reading a pending value does flush
+    assert clients[3].get_value(3, "accuracy") == 19 / 20.0
+    assert server._storages["t"].stats["write_transactions"] == transactions + 1
+    for client in clients:
+        client.close()
@@ -0,0 +1,53 @@
+import os
+import pickle
+from time import time
+
+from tad4bj import DataStorage
+from tad4bj.spool import _HEADER, SpoolDataStorage, merge
+
+
+def _record(seq, jobid, fields, values):
+    payload = pickle.dumps((time(), seq, jobid, fields, values, False))
+    return _HEADER.pack(len(payload)) + payload
+
+
+class _LateWriter(object):
+    """DataStorage whose first write lets a journal writer append a record
+    (as one that opened the journal before merge moved it away)."""
+
+    def __init__(self, ds, fd, data):
+        self._ds = ds
+        self._table = ds._table
+        self._late = [(fd, data)]
+
+    def set_many(self, rows, **kwargs):
+        while self._late:
+            fd, data = self._late.pop()
+            os.write(fd, data)
+        return self._ds.set_many(rows, **kwargs)
+
+    def append_series(self, rows):
+        return self._ds.append_series(rows)
+
+
+def test_merge_keeps_what_is_written_meanwhile(db_path, tmp_path):
+    spool_dir = str(tmp_path / "spool")
+    spool = SpoolDataStorage("t", spool_dir, path=db_path)
+    spool.set_value(1, "status", "running")
+    journal, = [os.path.join(spool._dir, name) for name in os.listdir(spool._dir)]
+
+    ds = DataStorage("t", db_path)
+    fd = os.open(journal, os.O_WRONLY | os.O_APPEND)
+    late_record = _record(100, 1, ["accuracy"], [0.5])
+    # A record being written: only half of it is there during the merge
+    writer = _LateWriter(ds, fd, late_record[:10])
+    assert merge(writer, spool_dir) == (1, 1)
+    assert ds.get_value(1, "status") == "running"
+
+    os.write(fd, late_record[10:])
+    os.close(fd)
+    assert merge(ds, spool_dir) == (1, 1)
+    assert ds.get_values(1, ["status", "accuracy"]) == {"status": "running",
+                                                        "accuracy": 0.5}
+    assert os.listdir(spool._dir) == []
+    ds.close()
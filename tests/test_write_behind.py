@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from tad4bj import DataStorage
+from tad4bj.dbconn import ConcurrencyProfile
+
+
+def test_failing_flush_does_not_block_later_writes(db_path):
+    other = sqlite3.connect(db_path)
+    other.execute("ALTER TABLE t ADD COLUMN extra INTEGER")
+    other.commit()
+    ds = DataStorage("t", db_path, write_behind=True, flush_size=1000)
+    ds.set_value(1, "extra", 1)
+    ds.set_value(2, "accuracy", 0.5)
+    # Gone before the flush
+    other.execute("ALTER TABLE t DROP COLUMN extra")
+    other.commit()
+    other.close()
+
+    with pytest.raises(sqlite3.OperationalError):
+        ds.flush()
+    assert ds.stats["write_dropped"] == 1
+
+    # The good write made it, and the buffer is usable again
+    assert ds.get_value(2, "accuracy") == 0.5
+    ds.set_value(3, "status", "done")
+    ds.close()
+
+    ds = DataStorage("t", db_path)
+    assert ds.get_value(3, "status") == "done"
+    ds.close()
+
+
+def test_locked_flush_keeps_the_writes(db_path):
+    ds = DataStorage("t", db_path, write_behind=True, flush_size=1000,
+                     profile=ConcurrencyProfile(busy_timeout=0, max_retries=0))
+    ds.set_value(1, "status", "running")
+
+    blocker = sqlite3.connect(db_path)
+    blocker.execute("BEGIN EXCLUSIVE")
+    with pytest.raises(sqlite3.OperationalError):
+        ds.flush()
+    blocker.rollback()
+    blocker.close()
+
+    ds.flush()
+    assert ds.get_value(1, "status") == "running"
+    ds.close()
+
+
+def _in_child(func):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func()
+        except BaseException:
+            os._exit(1)
+        os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+@pytest.mark.parametrize("timed", [False, True])
+def test_forked_child_commits_its_buffered_writes(db_path, timed):
+    ds = DataStorage("t", db_path, write_behind=True, flush_interval=0.05)
+    # Metadata cached before the fork, so the child writes without a query
+    ds.set_value(1, "status", "parent")
+    ds.flush()
+    assert ds._metadata
+
+    def child():
+        ds.set_value(300, "status", "x")
+        if timed:
+            time.sleep(0.5)
+            assert ds._pending == {}
+        ds.close()
+
+    _in_child(child)
+    ds.close()
+
+    ds = DataStorage("t", db_path)
+    assert ds.get_value(300, "status") == "x"
+    ds.close()